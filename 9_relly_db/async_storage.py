@@ -0,0 +1,275 @@
+import asyncio
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+from buffer import Buffer, BufferPoolManager, NoFreeBufferError
+from disk import DiskManager, PageId, PAGE_SIZE
+from btree import BPlusTree, NodeType, SearchMode
+
+"""
+asyncioから使うためのストレージAPI
+なぜ: DiskManager / BufferPoolManager / BPlusTree はすべてブロッキングなので、
+asyncioのサービスに組み込むと、バッファミス1回でイベントループ全体が止まってしまう
+どうやって: ディスクI/Oだけを上限付きのスレッドプールに送り、バッファプールの管理(ページテーブルやフレーム)は
+すべてイベントループのスレッドで行う。バッファヒットはイベントループから出ずにそのまま返す。
+同じページへの同時のミスは1回の読み込みにまとめる(single-flight)
+"""
+
+# ディスクI/Oに使うスレッド数の既定値
+DEFAULT_IO_WORKERS = 4
+
+
+class AsyncDiskManager:
+    """
+    DiskManager の読み書きをスレッドプールで実行し、コルーチンとして待てるようにするラッパー。
+    書き込み・ページの割り当て・同期はヘッダページなどを更新するので1つずつ実行する。
+    読み込みは DiskManager が対応していれば(concurrent_reads)並行して実行する。
+    """
+    def __init__(self, disk: DiskManager, max_workers: int = DEFAULT_IO_WORKERS,
+                 lock: Optional[threading.Lock] = None):
+        self.disk = disk
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="relly-io")
+        # 書き込みの排他。BufferPoolManager と同じディスクを使うときは、その io_lock を共有する
+        self.lock = lock if lock is not None else threading.Lock()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _locked(self, func, *args):
+        with self.lock:
+            return func(*args)
+
+    async def read_page_data(self, page_id: PageId, data: bytearray) -> None:
+        """指定したページIDのデータを読み込む"""
+        await self.read_pages([(page_id, data)])
+
+    async def read_pages(self, pages: Sequence[Tuple[PageId, bytearray]]) -> None:
+        """複数ページをまとめて読み込む"""
+        if self.disk.concurrent_reads:
+            await self._run(self.disk.read_pages, pages)
+        else:
+            await self._run(self._locked, self.disk.read_pages, pages)
+
+    async def write_page_data(self, page_id: PageId, data: bytes) -> None:
+        """指定したページIDにデータを書き込む"""
+        await self.write_pages([(page_id, data)])
+
+    async def write_pages(self, pages: Sequence[Tuple[PageId, bytes]]) -> None:
+        """複数ページをまとめて書き込む"""
+        await self._run(self._locked, self.disk.write_pages, pages)
+
+    async def allocate_page(self) -> PageId:
+        """ページを割り当てる(フリーリストの読み込みが起こりうるのでスレッドプールで実行する)"""
+        return await self._run(self._locked, self.disk.allocate_page)
+
+    async def sync(self) -> None:
+        """データをディスクに書き込む(永続化)"""
+        await self._run(self._locked, self.disk.sync)
+
+    def close(self) -> None:
+        """スレッドプールを終了する(DiskManager自体は閉じない)"""
+        self.executor.shutdown(wait=True)
+
+
+class AsyncBufferPoolManager:
+    """
+    BufferPoolManager をasyncioから使うためのマネージャ。
+    ページテーブルとフレームの更新はイベントループのスレッドだけで行い、
+    ディスクの読み書きは AsyncDiskManager のスレッドプールに任せる。
+    loading は読み込み中のページ、writing は書き戻し中のページの完了を待つための Future で、
+    同じページへの同時のミスはこれを待つことで1回の読み込みにまとめる。
+    """
+    def __init__(self, bufmgr: BufferPoolManager, max_workers: int = DEFAULT_IO_WORKERS):
+        self.bufmgr = bufmgr
+        self.pool = bufmgr.pool
+        self.disk = AsyncDiskManager(bufmgr.disk, max_workers, bufmgr.io_lock)
+        self.loading: Dict[PageId, asyncio.Future] = {}
+        self.writing: Dict[PageId, asyncio.Future] = {}
+
+    async def fetch_page(self, page_id: PageId) -> Buffer:
+        """
+        指定した page_id のページをピン留めして返す。使い終わったら unpin_page() で外す。
+        バッファプールにあればイベントループから出ずに返し、
+        他のコルーチンが読み込み中ならその完了を待ち、無ければスレッドプールで読み込む。
+        """
+        while True:
+            buffer_id = self.bufmgr.page_table.get(page_id)
+            if buffer_id is not None:
+                frame = self.pool.buffers[buffer_id.buffer_id]
+                self.pool.policy.on_hit(buffer_id.buffer_id, page_id)
+                frame.pin_count += 1
+                if self.bufmgr.io_stats is not None:
+                    self.bufmgr.io_stats.event("hit", page_id)
+                return frame.buffer
+
+            future = self.loading.get(page_id)
+            if future is None:
+                break
+            # 読み込みが終わったらページテーブルから取り直す(その間に追い出されていればもう一度読み込む)
+            await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self.loading[page_id] = future
+        if self.bufmgr.io_stats is not None:
+            self.bufmgr.io_stats.event("miss", page_id)
+        try:
+            buffer = await self._load(page_id)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # 待っているコルーチンが居なくても警告を出さない
+            raise
+        else:
+            future.set_result(buffer)
+            return buffer
+        finally:
+            del self.loading[page_id]
+
+    async def _reserve_frame(self, page_id: Optional[PageId] = None):
+        """
+        置換対象のフレームを選んで古いページをページテーブルから外す。page_id はこれから載せるページ。
+        古いページが dirty なら書き戻し、書き戻しが終わるまでそのページの読み込みを待たせる。
+        """
+        buffer_id = self.pool.evict(page_id)
+        if buffer_id is None:
+            raise NoFreeBufferError("No free buffer available in buffer pool")
+        frame = self.pool.buffers[buffer_id.buffer_id]
+        evict_page_id = frame.buffer.page_id
+        self.bufmgr.page_table.pop(evict_page_id, None)
+        old_data = bytes(frame.buffer.page) if frame.buffer.is_dirty else None
+        # 読み込み中に他のコルーチンの置換対象にならないよう、ピン留めしてcleanにしておく
+        frame.buffer.page_id = PageId(PageId.INVALID_PAGE_ID)
+        frame.buffer.is_dirty = False
+        frame.pin_count = 1
+        frame.strategy = None
+        if old_data is not None:
+            await self._write_back([(evict_page_id, old_data)])
+        return buffer_id, frame
+
+    async def _write_back(self, pages: Sequence[Tuple[PageId, bytes]]) -> None:
+        """ページを書き戻す。書き戻し中にそのページを読み込もうとしたコルーチンは完了を待つ"""
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for page_id, _ in pages:
+            if page_id not in self.writing:
+                futures[page_id] = self.writing[page_id] = loop.create_future()
+        try:
+            await self.disk.write_pages(pages)
+        finally:
+            for page_id, future in futures.items():
+                del self.writing[page_id]
+                future.set_result(None)
+
+    async def _load(self, page_id: PageId) -> Buffer:
+        buffer_id, frame = await self._reserve_frame(page_id)
+        try:
+            pending_write = self.writing.get(page_id)
+            if pending_write is not None:
+                await pending_write
+            await self.disk.read_page_data(page_id, frame.buffer.page)
+        except BaseException:
+            # 読み込めなかったフレームは空きに戻す
+            frame.pin_count = 0
+            self.pool.policy.on_free(buffer_id.buffer_id)
+            raise
+        frame.buffer.page_id = page_id
+        self.pool.policy.on_load(buffer_id.buffer_id, page_id)
+        self.bufmgr.page_table[page_id] = buffer_id
+        return frame.buffer
+
+    async def create_page(self) -> Buffer:
+        """新たにページをディスクに確保して、それをバッファプールに(ピン留めして)載せる"""
+        buffer_id, frame = await self._reserve_frame()
+        try:
+            page_id = await self.disk.allocate_page()
+        except BaseException:
+            frame.pin_count = 0
+            self.pool.policy.on_free(buffer_id.buffer_id)
+            raise
+        frame.buffer.page_id = page_id
+        frame.buffer.page[:] = bytes(PAGE_SIZE)
+        frame.buffer.is_dirty = True
+        self.pool.policy.on_load(buffer_id.buffer_id, page_id)
+        self.bufmgr.page_table[page_id] = buffer_id
+        return frame.buffer
+
+    def unpin_page(self, page_id: PageId, is_dirty: bool = False) -> None:
+        """fetch_page / create_page で付けたピンを1つ外す"""
+        self.bufmgr.unpin_page(page_id, is_dirty)
+
+    async def flush(self) -> None:
+        """
+        バッファプール上の全ての dirty ページをまとめて書き戻して同期する。
+        書き込むデータはイベントループ上で写し取るので、書き込み中もページを変更してよい。
+        """
+        pages = []
+        for page_id, buffer_id in self.bufmgr.page_table.items():
+            frame = self.pool.buffers[buffer_id.buffer_id]
+            if frame.buffer.is_dirty:
+                pages.append((page_id, bytes(frame.buffer.page)))
+                frame.buffer.is_dirty = False
+        await self._write_back(pages)
+        await self.disk.sync()
+
+    def close(self) -> None:
+        """スレッドプールを終了する"""
+        self.disk.close()
+
+
+class AsyncBPlusTree:
+    """
+    BPlusTree をasyncioから使うためのラッパー。
+    根から葉までのページを AsyncBufferPoolManager で(必要ならスレッドプールで読み込んで)取得してから、
+    ノード内の処理は BPlusTree のメソッドをそのまま使う。
+    insert は挿入先の経路と、リーフの分割で書き換える次のリーフ(FORMAT_LINKED)をバッファプールに載せてピン留めしてから
+    同期的に挿入するので、分割で触るページでミスは起きない。
+    ただしノードの分割で新しいページを作るときは、置換と追い出すページの書き戻しが同期的に行われ、その間イベントループが止まる。
+    """
+    def __init__(self, btree: BPlusTree, bufmgr: AsyncBufferPoolManager):
+        self.btree = btree
+        self.bufmgr = bufmgr
+
+    async def _fetch_path(self, key: bytes) -> List[Buffer]:
+        """
+        key が属する葉までの経路をバッファプールに載せてピン留めし、メタデータページから葉までのバッファを返す。
+        返したバッファのピンは呼び出し元が _unpin_path() で外す。
+        """
+        path = [await self.bufmgr.fetch_page(self.btree.meta_page_id)]
+        try:
+            page_id = self.btree.read_meta(path[0])
+            path.append(await self.bufmgr.fetch_page(page_id))
+            while struct.unpack('>I', path[-1].page[:4])[0] == NodeType.BRANCH:
+                page_id = self.btree.find_child(path[-1], key, len(path) - 2)
+                path.append(await self.bufmgr.fetch_page(page_id))
+        except BaseException:
+            self._unpin_path(path)
+            raise
+        return path
+
+    def _unpin_path(self, path: List[Buffer]) -> None:
+        for buffer in path:
+            self.bufmgr.unpin_page(buffer.page_id)
+
+    async def search(self, search_mode: SearchMode) -> Optional[Tuple[bytes, bytes]]:
+        """B+ツリー内で指定された検索モードに基づいて検索を行う"""
+        path = await self._fetch_path(search_mode.key)
+        try:
+            # 葉ノードの検索はI/Oを伴わない
+            return self.btree.search_internal(self.bufmgr.bufmgr, path[-1], search_mode, len(path) - 2)
+        finally:
+            self._unpin_path(path)
+
+    async def insert(self, key: bytes, value: bytes) -> None:
+        """B+ツリーにキーと値のペアを挿入する"""
+        path = await self._fetch_path(key)
+        try:
+            if self.btree.has_leaf_links():
+                # リーフが分割されると次のリーフの前へのリンクも書き換える。同期的な fetch_page で読み込むと
+                # イベントループが止まり、書き戻し中(writing)のページなら古い内容を読んでしまうので、先に載せておく
+                next_page_id = self.btree.leaf_node(path[-1].page).links()[1]
+                if next_page_id.page_id != PageId.INVALID_PAGE_ID:
+                    path.append(await self.bufmgr.fetch_page(next_page_id))
+            self.btree.insert(self.bufmgr.bufmgr, key, value)
+        finally:
+            self._unpin_path(path)
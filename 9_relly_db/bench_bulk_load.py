@@ -0,0 +1,57 @@
+import os
+import struct
+import sys
+import tempfile
+import time
+from buffer import BufferPool, BufferPoolManager
+from disk import DiskManager
+from btree import BPlusTree
+
+"""
+一括ロードのベンチマーク
+同じキーの昇順のペアを、insert() の繰り返しと BPlusTree.bulk_load() でそれぞれ新しいファイルに入れ、
+1秒あたりのペア数と、できたファイルのページ数を比べる(書き戻しのI/Oも含む)。
+使い方: python bench_bulk_load.py [ペアの数] [バッファプールのページ数]
+"""
+
+
+def sorted_pairs(num_pairs: int):
+    for i in range(num_pairs):
+        yield struct.pack('>Q', i), b"value-%d" % i
+
+
+def run(heap_file_path: str, method: str, num_pairs: int, pool_size: int):
+    """(ペア/秒, ページ数) を返す"""
+    disk = DiskManager.open(heap_file_path)
+    bufmgr = BufferPoolManager(disk, BufferPool(pool_size))
+    start = time.perf_counter()
+    if method == "insert":
+        btree = BPlusTree.create(bufmgr)
+        for key, value in sorted_pairs(num_pairs):
+            btree.insert(bufmgr, key, value)
+    else:
+        BPlusTree.bulk_load(bufmgr, sorted_pairs(num_pairs))
+    bufmgr.flush(verbose=False)
+    rate = num_pairs / (time.perf_counter() - start)
+    pages = disk.next_page_id
+    disk.close()
+    return rate, pages
+
+
+def main():
+    num_pairs = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    pool_size = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print(f"{'method':<10}{'pairs/s':>12}{'pages':>10}")
+        for method in ("insert", "bulk_load"):
+            rate, pages = run(os.path.join(temp_dir, f"{method}.rly"), method, num_pairs, pool_size)
+            print(f"{method:<10}{rate:>12.0f}{pages:>10}")
+    finally:
+        for name in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, name))
+        os.rmdir(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
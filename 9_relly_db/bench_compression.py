@@ -0,0 +1,65 @@
+import os
+import struct
+import sys
+import tempfile
+import time
+from buffer import BufferPool, BufferPoolManager
+from disk import CompressedDiskManager, DiskManager, PageId, PAGE_SIZE
+from btree import BPlusTree
+
+"""
+ページ圧縮(io_mode="compressed")のベンチマーク
+B+ツリーにデータを挿入してディスクに書き出し、
+ディスク上のサイズ・書き込んだバイト数と、OSのキャッシュを捨てた状態(コールド)での全ページ読み込みの速さを比べる。
+使い方: python bench_compression.py [挿入するキーの数]
+"""
+
+
+def build_tree(heap_file_path: str, io_mode: str, num_keys: int) -> DiskManager:
+    disk = DiskManager.open(heap_file_path, io_mode=io_mode)
+    # 途中で追い出しが起きないよう、全ページが載る大きさのバッファプールを使う(各ページはflushで1回だけ書かれる)
+    bufmgr = BufferPoolManager(disk, BufferPool(num_keys * 2))
+    btree = BPlusTree.create(bufmgr)
+    for i in range(num_keys):
+        btree.insert(bufmgr, struct.pack('>Q', (i * 7919) % num_keys), b"value-%d" % i)
+    bufmgr.flush(verbose=False)
+    return disk
+
+
+def cold_scan(heap_file_path: str, io_mode: str) -> float:
+    disk = DiskManager.open(heap_file_path, io_mode=io_mode)
+    # OSのページキャッシュからファイルを追い出してコールドな状態にする
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(disk.file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    page = bytearray(PAGE_SIZE)
+    start = time.perf_counter()
+    for page_no in range(disk.next_page_id):
+        disk.read_page_data(PageId(page_no), page)
+    elapsed = time.perf_counter() - start
+    disk.close()
+    return elapsed
+
+
+def main():
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print(f"{'mode':<12}{'pages':>8}{'on disk(KiB)':>14}{'written(KiB)':>14}{'cold scan(MiB/s)':>18}")
+        for io_mode in ("file", "compressed"):
+            heap_file_path = os.path.join(temp_dir, f"{io_mode}.rly")
+            disk = build_tree(heap_file_path, io_mode, num_keys)
+            pages = disk.next_page_id
+            on_disk = disk.physical_size()
+            written = disk.bytes_written if isinstance(disk, CompressedDiskManager) else pages * PAGE_SIZE
+            disk.close()
+            elapsed = cold_scan(heap_file_path, io_mode)
+            throughput = pages * PAGE_SIZE / elapsed / (1024 * 1024)
+            print(f"{io_mode:<12}{pages:>8}{on_disk // 1024:>14}{written // 1024:>14}{throughput:>18.1f}")
+    finally:
+        for name in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, name))
+        os.rmdir(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from buffer import BufferPool, BufferPoolManager
+from concurrent_buffer import ConcurrentBufferPoolManager
+from disk import DiskManager, PAGE_SIZE
+
+"""
+バッファプールマネージャのスレッド数によるスループットのベンチマーク
+各スレッドがランダムなページを fetch_page / unpin_page し続け、
+BufferPoolManager(全体を1つのロックで守る) と ConcurrentBufferPoolManager(シャード分割) の1秒あたりの操作数を比べる。
+バッファプールは全てのページが載る大きさ(ヒットだけ)と、ページ数の半分の大きさ(半分がミス)の2通りで測る。
+どちらもPythonのコードはGILを持って1スレッドずつ動くので、ロックを分けてもヒットの処理は並列にならず、
+ヒットだけなら2つのマネージャの差は小さい。
+ミスでは ConcurrentBufferPoolManager が Future の登録(single-flight)やシャード・プール全体のロックを何度も取る分だけ遅い。
+このベンチマークのファイルはOSのページキャッシュに載っていて、読み込みがすぐ終わるので、
+読み込みの間にGILを手放して他のスレッドを進められる利点が出ない。
+ディスクの読み込みに時間がかかるほど(キャッシュに載らない大きなファイルなど)、シャード分割の方が伸びる。
+使い方: python bench_concurrency.py [ページ数] [スレッドあたりの操作数]
+"""
+
+THREAD_COUNTS = (1, 2, 4, 8)
+
+
+def run(bufmgr, page_ids, num_threads: int, ops_per_thread: int) -> float:
+    """num_threads 個のスレッドで fetch_page / unpin_page を繰り返し、1秒あたりの操作数を返す"""
+    barrier = threading.Barrier(num_threads + 1)
+
+    def worker(seed: int):
+        rng = random.Random(seed)
+        barrier.wait()
+        for _ in range(ops_per_thread):
+            page_id = rng.choice(page_ids)
+            buffer = bufmgr.fetch_page(page_id)
+            bufmgr.unpin_page(buffer.page_id)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return num_threads * ops_per_thread / elapsed
+
+
+def main():
+    num_pages = int(sys.argv[1]) if len(sys.argv) > 1 else 2048
+    ops_per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        heap_file_path = temp_file.name
+    try:
+        disk = DiskManager.open(heap_file_path)
+        page_ids = [disk.allocate_page() for _ in range(num_pages)]
+        disk.write_pages([(page_id, bytes(PAGE_SIZE)) for page_id in page_ids])
+
+        for pool_size in (num_pages, num_pages // 2):
+            print(f"pool size: {pool_size} / {num_pages} pages")
+            print(f"{'threads':>8}{'BufferPoolManager(ops/s)':>28}{'Concurrent(ops/s)':>22}")
+            for num_threads in THREAD_COUNTS:
+                single = run(BufferPoolManager(disk, BufferPool(pool_size)), page_ids, num_threads, ops_per_thread)
+                sharded = run(ConcurrentBufferPoolManager(disk, BufferPool(pool_size)), page_ids, num_threads, ops_per_thread)
+                print(f"{num_threads:>8}{single:>28.0f}{sharded:>22.0f}")
+        disk.close()
+    finally:
+        os.remove(heap_file_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+from buffer import BufferPool, BufferPoolManager
+from disk import DiskManager
+from btree import BPlusTree, FORMAT_LINKED, FORMAT_PICKLE, FORMAT_SLOTTED
+
+"""
+ノードのページフォーマットのベンチマーク
+同じキーと値を pickle のフォーマットとスロット化ページのフォーマット(リーフのリンクの有無)のB+ツリーに挿入し、
+全ページがバッファプールに載った状態での点検索と範囲スキャンの1秒あたりの件数を比べる(ノードのデコードのCPUコスト)。
+リーフのリンクが無いフォーマットの範囲スキャンは、リーフを移るたびにルートからたどり直す。
+使い方: python bench_node_format.py [挿入するキーの数] [点検索の回数]
+"""
+
+FORMATS = {"pickle": FORMAT_PICKLE, "slotted": FORMAT_SLOTTED, "linked": FORMAT_LINKED}
+
+
+def run(heap_file_path: str, format_version: int, num_keys: int, num_lookups: int):
+    """(挿入/秒, 点検索/秒, 範囲スキャンのペア/秒) を返す"""
+    disk = DiskManager.open(heap_file_path)
+    bufmgr = BufferPoolManager(disk, BufferPool(num_keys * 2))
+    btree = BPlusTree.create(bufmgr, format_version)
+    rng = random.Random(42)
+    keys = [struct.pack('>Q', key) for key in range(num_keys)]
+    rng.shuffle(keys)
+
+    start = time.perf_counter()
+    for key in keys:
+        btree.insert(bufmgr, key, b"value-" + key)
+    inserts = num_keys / (time.perf_counter() - start)
+
+    lookup_keys = [rng.choice(keys) for _ in range(num_lookups)]
+    start = time.perf_counter()
+    for key in lookup_keys:
+        assert btree.get(bufmgr, key) is not None
+    lookups = num_lookups / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    rows = len(btree.search_range(bufmgr, struct.pack('>Q', 0), struct.pack('>Q', num_keys)))
+    scan = rows / (time.perf_counter() - start)
+    disk.close()
+    return inserts, lookups, scan
+
+
+def main():
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    num_lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print(f"{'format':<10}{'inserts/s':>12}{'lookups/s':>12}{'scan pairs/s':>14}")
+        for name, format_version in FORMATS.items():
+            inserts, lookups, scan = run(os.path.join(temp_dir, f"{name}.rly"), format_version, num_keys, num_lookups)
+            print(f"{name:<10}{inserts:>12.0f}{lookups:>12.0f}{scan:>14.0f}")
+    finally:
+        for name in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, name))
+        os.rmdir(temp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+from buffer import BufferPool, BufferPoolManager
+from disk import DiskManager, PAGE_SIZE
+from btree import BPlusTree, LEAF_SLOT, LeafNode, NODE_HEADER, Pair
+
+"""
+ノード内の探索のマイクロベンチマーク
+1. 8バイトのキーと値を1ページに詰めたリーフノードで、スロットの配列の二分探索(lower_bound)と
+   先頭からの線形探索の、1秒あたりの探索回数と1回あたりの比較回数を比べる
+2. B+ツリーに点検索を行い、レベルごとのノードのエントリ数と比較回数の平均(SearchStats)を表示する
+使い方: python bench_node_search.py [挿入するキーの数] [点検索の回数]
+"""
+
+
+def linear_lower_bound(leaf: LeafNode, key: bytes) -> int:
+    """二分探索を使う前の探索: key 以上の最初のキーを先頭から順に探す"""
+    for index in range(leaf.count):
+        leaf.comparisons += 1
+        if bytes(leaf.key(index)) >= key:
+            return index
+    return leaf.count
+
+
+def bench_leaf(num_lookups: int):
+    """リーフノード1つでの {探索の名前: (探索/秒, 1回あたりの比較回数)} とエントリ数を返す"""
+    page = memoryview(bytearray(PAGE_SIZE))
+    count = (PAGE_SIZE - NODE_HEADER.size) // (LEAF_SLOT.size + 16)
+    LeafNode.write(page, [Pair(struct.pack('>Q', i * 2), bytes(8)) for i in range(count)])
+    rng = random.Random(1)
+    probes = [struct.pack('>Q', rng.randrange(count * 2)) for _ in range(num_lookups)]
+
+    results = {}
+    for name, lower_bound in (("binary", LeafNode.lower_bound), ("linear", linear_lower_bound)):
+        leaf = LeafNode(page)
+        start = time.perf_counter()
+        for probe in probes:
+            lower_bound(leaf, probe)
+        results[name] = (num_lookups / (time.perf_counter() - start), leaf.comparisons / num_lookups)
+    return count, results
+
+
+def bench_tree(heap_file_path: str, num_keys: int, num_lookups: int):
+    """B+ツリーの点検索の (検索/秒, レベルごとの SearchStats.snapshot()) を返す"""
+    disk = DiskManager.open(heap_file_path)
+    bufmgr = BufferPoolManager(disk, BufferPool(num_keys))
+    btree = BPlusTree.create(bufmgr)
+    rng = random.Random(42)
+    keys = [struct.pack('>Q', key) for key in range(num_keys)]
+    rng.shuffle(keys)
+    for key in keys:
+        btree.insert(bufmgr, key, b"value-" + key)
+
+    stats = btree.enable_search_stats()
+    lookup_keys = [rng.choice(keys) for _ in range(num_lookups)]
+    start = time.perf_counter()
+    for key in lookup_keys:
+        assert btree.get(bufmgr, key) is not None
+    lookups = num_lookups / (time.perf_counter() - start)
+    disk.close()
+    return lookups, stats.snapshot()
+
+
+def main():
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+
+    count, results = bench_leaf(num_lookups)
+    print(f"leaf node with {count} entries")
+    print(f"{'search':<10}{'lookups/s':>12}{'comparisons':>14}")
+    for name, (rate, comparisons) in results.items():
+        print(f"{name:<10}{rate:>12.0f}{comparisons:>14.1f}")
+
+    temp_dir = tempfile.mkdtemp()
+    heap_file_path = os.path.join(temp_dir, "search.rly")
+    try:
+        lookups, levels = bench_tree(heap_file_path, num_keys, num_lookups)
+    finally:
+        if os.path.exists(heap_file_path):
+            os.remove(heap_file_path)
+        os.rmdir(temp_dir)
+    print(f"\nB+tree with {num_keys} keys: {lookups:.0f} lookups/s")
+    print(f"{'level':<8}{'nodes':>10}{'entries/node':>14}{'comparisons/node':>18}")
+    for level, stats in enumerate(levels):
+        print(f"{level:<8}{stats['nodes']:>10}{stats['entries_per_node']:>14.1f}{stats['comparisons_per_node']:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
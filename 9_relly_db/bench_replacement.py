@@ -0,0 +1,122 @@
+import os
+import random
+import struct
+import sys
+import tempfile
+import time
+from typing import Dict, List
+from buffer import BufferPool, BufferPoolManager
+from disk import DiskManager
+from btree import BPlusTree
+from replacement import POLICIES, ReplacementPolicy
+
+"""
+ページ置換アルゴリズムのベンチマーク
+B+ツリーへの点検索・範囲スキャン・挿入でどのページが読まれたかをトレースフックで記録し、
+そのページアクセスの列を置換アルゴリズムごとにいくつかの大きさのバッファプールで再生して、
+ヒット率と1アクセスあたりの置換アルゴリズムの処理時間を比べる。
+使い方: python bench_replacement.py [挿入するキーの数]
+"""
+
+# バッファプールの大きさ(トレースに出てくるページ数に対する割合)
+POOL_FRACTIONS = (0.05, 0.1, 0.25)
+
+
+def record_traces(heap_file_path: str, num_keys: int) -> Dict[str, List[int]]:
+    """B+ツリーを作り、操作の種類ごとに fetch_page されたページ番号の列を記録して返す"""
+    disk = DiskManager.open(heap_file_path)
+    # 記録するのは要求されたページなので、記録用のバッファプールは全ページが載る大きさにする
+    bufmgr = BufferPoolManager(disk, BufferPool(num_keys * 4))
+    btree = BPlusTree.create(bufmgr)
+    rng = random.Random(42)
+    keys = list(range(0, num_keys * 2, 2))
+    rng.shuffle(keys)
+    for key in keys:
+        btree.insert(bufmgr, struct.pack('>Q', key), b"value-%d" % key)
+
+    trace: List[int] = []
+    bufmgr.enable_stats(lambda op, page_id, seconds: trace.append(page_id.page_id) if op in ("hit", "miss") else None,
+                        include_disk=False)
+    traces = {}
+
+    # 点検索: 2割のキーに8割のアクセスが集中する
+    hot_keys = keys[:num_keys // 5]
+    for _ in range(num_keys * 2):
+        key = rng.choice(hot_keys) if rng.random() < 0.8 else rng.choice(keys)
+        btree.get(bufmgr, struct.pack('>Q', key))
+    traces["point"], trace[:] = list(trace), []
+
+    # 範囲スキャン: ランダムな位置から連続した50キーを読む
+    for _ in range(num_keys // 50):
+        start = rng.randrange(num_keys * 2)
+        btree.search_range(bufmgr, struct.pack('>Q', start), struct.pack('>Q', start + 100))
+    traces["scan"], trace[:] = list(trace), []
+
+    # 点検索の合間に範囲スキャンが走る
+    for i in range(num_keys * 2):
+        key = rng.choice(hot_keys) if rng.random() < 0.8 else rng.choice(keys)
+        btree.get(bufmgr, struct.pack('>Q', key))
+        if i % 200 == 0:
+            start = rng.randrange(num_keys * 2)
+            btree.search_range(bufmgr, struct.pack('>Q', start), struct.pack('>Q', start + 100))
+    traces["point+scan"], trace[:] = list(trace), []
+
+    # 挿入: まだ無い(奇数の)キーをランダムな順に挿入する
+    new_keys = list(range(1, num_keys * 2, 2))
+    rng.shuffle(new_keys)
+    for key in new_keys[:num_keys // 2]:
+        btree.insert(bufmgr, struct.pack('>Q', key), b"value-%d" % key)
+    traces["insert"], trace[:] = list(trace), []
+
+    disk.close()
+    return traces
+
+
+def replay(trace: List[int], policy: ReplacementPolicy, pool_size: int):
+    """トレースを置換アルゴリズムで再生し、(ヒット率, 1アクセスあたりの秒数) を返す"""
+    BufferPool(pool_size, policy)
+    page_table: Dict[int, int] = {}
+    hits = 0
+    start = time.perf_counter()
+    for page_id in trace:
+        buffer_id = page_table.get(page_id)
+        if buffer_id is not None:
+            hits += 1
+            policy.on_hit(buffer_id, page_id)
+            continue
+        buffer_id = policy.victim(page_id)
+        old_page_id = policy.pages[buffer_id]
+        if old_page_id is not None:
+            del page_table[old_page_id]
+        policy.on_load(buffer_id, page_id)
+        page_table[page_id] = buffer_id
+    elapsed = time.perf_counter() - start
+    return hits / len(trace), elapsed / len(trace)
+
+
+def main():
+    num_keys = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    temp_dir = tempfile.mkdtemp()
+    try:
+        traces = record_traces(os.path.join(temp_dir, "replacement.rly"), num_keys)
+    finally:
+        for name in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, name))
+        os.rmdir(temp_dir)
+
+    print(f"{'workload':<12}{'accesses':>10}{'pages':>8}{'pool':>6}  "
+          + "".join(f"{name:>16}" for name in POLICIES))
+    for workload, trace in traces.items():
+        distinct = len(set(trace))
+        for fraction in POOL_FRACTIONS:
+            pool_size = max(4, int(distinct * fraction))
+            cells = []
+            for policy_class in POLICIES.values():
+                hit_ratio, seconds = replay(trace, policy_class(), pool_size)
+                # ヒット率(%) と 1アクセスあたりのナノ秒
+                cells.append(f"{hit_ratio * 100:6.1f}%/{seconds * 1e9:6.0f}ns")
+            print(f"{workload:<12}{len(trace):>10}{distinct:>8}{pool_size:>6}  " + "".join(f"{cell:>16}" for cell in cells))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+import threading
+from typing import List, Tuple
+from disk import PageId
+
+"""
+バックグラウンドライター
+なぜ: dirty なページが置換対象になると、fetch_page / create_page の中で書き戻しを待つことになり、
+読み込みのミスなのに書き込みの時間まで払うことになる
+どうやって: 別スレッドで、置換対象になりそうな順(置換アルゴリズムの candidates())にフレームを見て、
+ピン留めされていない dirty ページを先回りして書き戻しておく。置換のときにはほとんど clean なページが見つかる
+1回に書くページ数(max_pages)と、書き戻しの間隔(interval)で、フォアグラウンドのI/Oを邪魔しすぎないようにする
+(BufferPoolManager の lock / io_lock を使うので、AsyncBufferPoolManager と一緒には使わない)
+"""
+
+
+class BackgroundWriter(threading.Thread):
+    """
+    BufferPoolManager の dirty ページを定期的に書き戻すスレッド。
+    ページの内容はマネージャの lock を持って写し取り、ページID順に並べて1回の write_pages で書く。
+    書いている間にページが変更された(内容が写し取ったものと違う)場合は is_dirty を下ろさない。
+    """
+    def __init__(self, bufmgr, max_pages: int, interval: float):
+        super().__init__(name="relly-bgwriter", daemon=True)
+        self.bufmgr = bufmgr
+        self.max_pages = max_pages
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self.stop_event.is_set():
+            written = self.run_round()
+            # 書くものが無いときだけ休み、書き戻しが追いついていないときはすぐ次を書く
+            if written < self.max_pages:
+                self.stop_event.wait(self.interval)
+
+    def stop(self) -> None:
+        """スレッドを止めて終了を待つ"""
+        self.stop_event.set()
+        self.join()
+
+    def run_round(self) -> int:
+        """dirty ページを最大 max_pages 個書き戻し、書き戻したページ数を返す"""
+        bufmgr = self.bufmgr
+        pages: List[Tuple[PageId, bytes]] = []
+        with bufmgr.lock:
+            for buffer_id in bufmgr.pool.policy.candidates():
+                frame = bufmgr.pool.buffers[buffer_id]
+                if frame.pin_count == 0 and frame.buffer.is_dirty:
+                    pages.append((frame.buffer.page_id, bytes(frame.buffer.page)))
+                    if len(pages) >= self.max_pages:
+                        break
+            if not pages:
+                return 0
+            # 写し取った順に書き込まれるよう、lock を持っている間に io_lock を取る
+            bufmgr.io_lock.acquire()
+        try:
+            pages.sort(key=lambda page: page[0].to_u64())
+            bufmgr.disk.write_pages(pages)
+        finally:
+            bufmgr.io_lock.release()
+
+        with bufmgr.lock:
+            for page_id, data in pages:
+                buffer_id = bufmgr.page_table.get(page_id)
+                if buffer_id is None:
+                    continue
+                buffer = bufmgr.pool.buffers[buffer_id.buffer_id].buffer
+                if buffer.is_dirty and buffer.page == data:
+                    buffer.is_dirty = False
+            if bufmgr.io_stats is not None:
+                bufmgr.io_stats.count("bgwriter_pages", len(pages))
+        return len(pages)
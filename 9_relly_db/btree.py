@@ -1,6 +1,8 @@
 import struct
-from typing import Optional, Tuple, List
-from buffer import BufferPoolManager, Buffer
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import Iterable, Optional, Tuple, List
+from buffer import BufferAccessStrategy, BufferPoolManager, Buffer
 from disk import PageId, PAGE_SIZE
 import pickle
 import os
@@ -14,6 +16,10 @@ class DuplicateKeyError(BTreeError):
     """重複するキーの挿入を試みた際に発生する例外"""
     pass
 
+class NodeOverflowError(BTreeError):
+    """ノードの内容が1ページに収まらない場合に発生する例外"""
+    pass
+
 # ノードタイプ定義
 class NodeType:
     LEAF = 0    # リーフノード
@@ -80,78 +86,420 @@ class Pair:
         """
         return pickle.loads(data)
 
+# ノードのページフォーマット
+# FORMAT_PICKLE: 以前のフォーマット。リーフのペアを pickle で直列化して先頭から詰める
+# FORMAT_SLOTTED: スロット化ページ。ヘッダの後ろにスロット(セルの位置と長さ)の配列を置き、
+#                 キーと値の生のバイト列(セル)をページの末尾から詰める
+# FORMAT_LINKED: スロット化ページで、リーフのヘッダの後ろに前後のリーフのページIDを置く(範囲スキャンでリーフをたどる)
+FORMAT_PICKLE = 0
+FORMAT_SLOTTED = 1
+FORMAT_LINKED = 2
+CURRENT_FORMAT_VERSION = FORMAT_LINKED
+# メタデータページ: [0:8] ルートページID, [8:12] META_MAGIC, [12:16] フォーマットのバージョン
+# (META_MAGIC が無いのは FORMAT_PICKLE の頃に作られたファイル)
+META_MAGIC = b"RLYT"
+
+# スロット化ページのヘッダ: ノードタイプ, スロット数, セル領域の先頭(空き領域の終わり)
+NODE_HEADER = struct.Struct('>III')
+# リーフのスロット: セルの位置, キーの長さ, 値の長さ(セルはキーと値を続けて置く)
+LEAF_SLOT = struct.Struct('>HHH')
+# ブランチのスロット: セルの位置, キーの長さ, キーより右の子ページID
+# 一番左の子ページIDはヘッダの直後に置く
+BRANCH_SLOT = struct.Struct('>HHQ')
+BRANCH_LEFTMOST = struct.Struct('>Q')
+BRANCH_SLOTS_START = NODE_HEADER.size + BRANCH_LEFTMOST.size
+# FORMAT_LINKED のリーフでヘッダの直後に置く、前と次のリーフのページID(無ければ INVALID_PAGE_ID)
+LEAF_LINKS = struct.Struct('>QQ')
+
+
+class LeafNode:
+    """
+    スロット化ページのリーフノードを読むためのビュー。
+    キーと値はページの memoryview のスライスとして返す(コピーしない)ので、
+    ページのピンを外した後や、ページを書き換えた後には使わない。
+    """
+    __slots__ = ('page', 'count', 'comparisons')
+    # スロットの配列の開始位置
+    SLOTS_START = NODE_HEADER.size
+
+    def __init__(self, page: memoryview):
+        self.page = page
+        self.count = NODE_HEADER.unpack_from(page, 0)[1]
+        self.comparisons = 0  # このビューで行ったキーの比較の回数
+
+    def key(self, index: int) -> memoryview:
+        offset, key_size, _ = LEAF_SLOT.unpack_from(self.page, self.SLOTS_START + index * LEAF_SLOT.size)
+        return self.page[offset:offset + key_size]
+
+    def value(self, index: int) -> memoryview:
+        offset, key_size, value_size = LEAF_SLOT.unpack_from(self.page, self.SLOTS_START + index * LEAF_SLOT.size)
+        return self.page[offset + key_size:offset + key_size + value_size]
+
+    def pair(self, index: int) -> 'Pair':
+        """index 番目のペアを(ページから切り離した bytes で)返す"""
+        offset, key_size, value_size = LEAF_SLOT.unpack_from(self.page, self.SLOTS_START + index * LEAF_SLOT.size)
+        return Pair(bytes(self.page[offset:offset + key_size]),
+                    bytes(self.page[offset + key_size:offset + key_size + value_size]))
+
+    def pairs(self) -> List['Pair']:
+        return [self.pair(index) for index in range(self.count)]
+
+    def lower_bound(self, key: bytes) -> int:
+        """key 以上の最初のキーのスロット番号を返す(全てのキーより大きければ count)。スロットの配列を二分探索する"""
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            offset, key_size, _ = LEAF_SLOT.unpack_from(self.page, self.SLOTS_START + mid * LEAF_SLOT.size)
+            self.comparisons += 1
+            if self.page[offset:offset + key_size].tobytes() < key:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def find(self, key: bytes) -> Optional[int]:
+        """key と等しいキーのスロット番号を返す(無ければ None)"""
+        index = self.lower_bound(key)
+        if index < self.count and self.key(index) == key:
+            return index
+        return None
+
+    def insert(self, index: int, key: bytes, value: bytes) -> bool:
+        """
+        index 番目にペアを挿入する。スロットの配列を1つずらし、セルは空き領域の末尾に詰める。
+        空き領域に収まらなければページを変更せずに False を返す
+        """
+        _, _, free_end = NODE_HEADER.unpack_from(self.page, 0)
+        slots_end = self.SLOTS_START + LEAF_SLOT.size * (self.count + 1)
+        start = free_end - len(key) - len(value)
+        if start < slots_end:
+            return False
+        self.page[start:start + len(key)] = key
+        self.page[start + len(key):free_end] = value
+        slot = self.SLOTS_START + index * LEAF_SLOT.size
+        self.page[slot + LEAF_SLOT.size:slots_end] = self.page[slot:slots_end - LEAF_SLOT.size].tobytes()
+        LEAF_SLOT.pack_into(self.page, slot, start, len(key), len(value))
+        self.count += 1
+        NODE_HEADER.pack_into(self.page, 0, NodeType.LEAF, self.count, start)
+        return True
+
+    @classmethod
+    def write(cls, page: memoryview, pairs: List['Pair']) -> None:
+        """ペアリストをページに書き込む。収まらなければページを変更せずに NodeOverflowError を送出する"""
+        slots_end = cls.SLOTS_START + LEAF_SLOT.size * len(pairs)
+        cells_size = sum(len(pair.key) + len(pair.value) for pair in pairs)
+        if slots_end + cells_size > PAGE_SIZE:
+            raise NodeOverflowError(f"{len(pairs)} pairs ({cells_size} bytes) do not fit in a leaf page")
+        end = PAGE_SIZE
+        for index, pair in enumerate(pairs):
+            key_size = len(pair.key)
+            end -= key_size + len(pair.value)
+            page[end:end + key_size] = pair.key
+            page[end + key_size:end + key_size + len(pair.value)] = pair.value
+            LEAF_SLOT.pack_into(page, cls.SLOTS_START + index * LEAF_SLOT.size, end, key_size, len(pair.value))
+        NODE_HEADER.pack_into(page, 0, NodeType.LEAF, len(pairs), end)
+
+
+class LinkedLeafNode(LeafNode):
+    """
+    FORMAT_LINKED のリーフノードのビュー。ヘッダとスロットの配列の間に前後のリーフのページIDを持つ。
+    write() はこの領域を変更しないので、ペアを書き換えてもリンクは残る。
+    """
+    __slots__ = ()
+    SLOTS_START = NODE_HEADER.size + LEAF_LINKS.size
+
+    def links(self) -> Tuple[PageId, PageId]:
+        """(前のリーフ, 次のリーフ) のページIDを返す"""
+        prev_page_id, next_page_id = LEAF_LINKS.unpack_from(self.page, NODE_HEADER.size)
+        return PageId(prev_page_id), PageId(next_page_id)
+
+    def set_links(self, prev_page_id: PageId, next_page_id: PageId) -> None:
+        LEAF_LINKS.pack_into(self.page, NODE_HEADER.size, prev_page_id.page_id, next_page_id.page_id)
+
+    def set_prev(self, prev_page_id: PageId) -> None:
+        LEAF_LINKS.pack_into(self.page, NODE_HEADER.size, prev_page_id.page_id, self.links()[1].page_id)
+
+
+def leaf_node_class(format_version: int) -> type:
+    """スロット化ページのフォーマットのバージョンに対応するリーフノードのビューのクラス"""
+    return LinkedLeafNode if format_version >= FORMAT_LINKED else LeafNode
+
+
+class BranchNode:
+    """スロット化ページのブランチノードを読むためのビュー。キーは memoryview のスライスとして返す"""
+    __slots__ = ('page', 'count', 'comparisons')
+
+    def __init__(self, page: memoryview):
+        self.page = page
+        self.count = NODE_HEADER.unpack_from(page, 0)[1]
+        self.comparisons = 0  # このビューで行ったキーの比較の回数
+
+    def key(self, index: int) -> memoryview:
+        offset, key_size, _ = BRANCH_SLOT.unpack_from(self.page, BRANCH_SLOTS_START + index * BRANCH_SLOT.size)
+        return self.page[offset:offset + key_size]
+
+    def child(self, index: int) -> PageId:
+        """index 番目の子ページID (0 が一番左、count が一番右)"""
+        if index == 0:
+            return PageId(BRANCH_LEFTMOST.unpack_from(self.page, NODE_HEADER.size)[0])
+        return PageId(BRANCH_SLOT.unpack_from(self.page, BRANCH_SLOTS_START + (index - 1) * BRANCH_SLOT.size)[2])
+
+    def keys(self) -> List[bytes]:
+        return [bytes(self.key(index)) for index in range(self.count)]
+
+    def children(self) -> List[PageId]:
+        return [self.child(index) for index in range(self.count + 1)]
+
+    def child_index(self, key: bytes) -> int:
+        """key が属する子ノードのインデックス(key より大きい最初のキーの位置)を返す。スロットの配列を二分探索する"""
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            offset, key_size, _ = BRANCH_SLOT.unpack_from(self.page, BRANCH_SLOTS_START + mid * BRANCH_SLOT.size)
+            self.comparisons += 1
+            if key < self.page[offset:offset + key_size].tobytes():
+                high = mid
+            else:
+                low = mid + 1
+        return low
+
+    @staticmethod
+    def write(page: memoryview, keys: List[bytes], children: List[PageId]) -> None:
+        """キーリストと子ページIDリストをページに書き込む。収まらなければページを変更せずに NodeOverflowError を送出する"""
+        slots_end = BRANCH_SLOTS_START + BRANCH_SLOT.size * len(keys)
+        cells_size = sum(len(key) for key in keys)
+        if slots_end + cells_size > PAGE_SIZE:
+            raise NodeOverflowError(f"{len(keys)} keys ({cells_size} bytes) do not fit in a branch page")
+        BRANCH_LEFTMOST.pack_into(page, NODE_HEADER.size, children[0].page_id)
+        end = PAGE_SIZE
+        for index, key in enumerate(keys):
+            end -= len(key)
+            page[end:end + len(key)] = key
+            BRANCH_SLOT.pack_into(page, BRANCH_SLOTS_START + index * BRANCH_SLOT.size,
+                                  end, len(key), children[index + 1].page_id)
+        NODE_HEADER.pack_into(page, 0, NodeType.BRANCH, len(keys), end)
+
+
+class SearchStats:
+    """
+    ノード内の探索の計測。木のレベル(ルートが0)ごとに、訪れたノード数・ノードのエントリ数の合計・キーの比較回数の合計を数える。
+    スロット化ページのノードだけを数える(pickle のフォーマットはノード全体をデコードするので数えない)。
+    """
+    def __init__(self):
+        self.levels: List[List[int]] = []  # [訪れたノード数, エントリ数の合計, 比較回数の合計]
+
+    def record(self, level: int, node) -> None:
+        """level のノード(LeafNode か BranchNode)で行った比較を記録する"""
+        while len(self.levels) <= level:
+            self.levels.append([0, 0, 0])
+        stats = self.levels[level]
+        stats[0] += 1
+        stats[1] += node.count
+        stats[2] += node.comparisons
+
+    def snapshot(self) -> List[dict]:
+        """レベルごとの値と、ノードあたりの平均を辞書のリストで返す"""
+        return [{"nodes": nodes, "entries": entries, "comparisons": comparisons,
+                 "entries_per_node": entries / nodes if nodes else 0.0,
+                 "comparisons_per_node": comparisons / nodes if nodes else 0.0}
+                for nodes, entries, comparisons in self.levels]
+
+
+# ノードを分割するとき、右端への挿入(キーの昇順の挿入)なら左のノードにこの割合まで詰める
+# (昇順に挿入し続けても、ノードが半分ずつしか埋まらないことを防ぐ。ランダムな挿入では半分ずつに分ける)
+DEFAULT_FILL_FACTOR = 0.9
+
+
 # B+Treeクラス
 class BPlusTree:
-    LEAF_NODE_MAX_PAIRS = 2    # リーフノードの最大ペア数
-    BRANCH_NODE_MAX_KEYS = 2   # ブランチノードの最大キー数
+    # ノードの最大ペア数・最大キー数。None ならページに収まるだけ詰める(テストで浅い木を深くするときに使う)
+    LEAF_NODE_MAX_PAIRS: Optional[int] = None
+    BRANCH_NODE_MAX_KEYS: Optional[int] = None
 
-    def __init__(self, meta_page_id: PageId):
+    def __init__(self, meta_page_id: PageId, format_version: Optional[int] = None,
+                 fill_factor: float = DEFAULT_FILL_FACTOR):
         """
         B+ツリーの初期化
 
         Args:
             meta_page_id (PageId): メタデータページのページID
+            format_version (Optional[int]): ノードのページフォーマット。None ならメタデータページから読み取る
+            fill_factor (float): 右端のノードを分割するときに左のノードに詰める割合(0.5～1.0)
         """
+        if not 0.5 <= fill_factor <= 1.0:
+            raise ValueError(f"fill_factor must be between 0.5 and 1.0: {fill_factor}")
         self.meta_page_id = meta_page_id  # メタデータページIDの保存
+        self.format_version = format_version
+        self.fill_factor = fill_factor
+        self.search_stats: Optional[SearchStats] = None  # enable_search_stats() を呼ぶまでは計測しない
+
+    def enable_search_stats(self) -> SearchStats:
+        """ノード内の探索の計測を有効にして、計測結果のオブジェクトを返す"""
+        if self.search_stats is None:
+            self.search_stats = SearchStats()
+        return self.search_stats
+
+    def leaf_node(self, page: memoryview) -> LeafNode:
+        """スロット化ページのリーフノードのビューを返す"""
+        return leaf_node_class(self.format_version)(page)
+
+    def has_leaf_links(self) -> bool:
+        """リーフが前後のリーフのページIDを持つフォーマットか"""
+        return self.format_version >= FORMAT_LINKED
+
+    def _record(self, level: int, node) -> None:
+        if self.search_stats is not None:
+            self.search_stats.record(level, node)
 
     @staticmethod
-    def create(bufmgr: BufferPoolManager) -> 'BPlusTree':
+    def create(bufmgr: BufferPoolManager, format_version: int = CURRENT_FORMAT_VERSION,
+               fill_factor: float = DEFAULT_FILL_FACTOR) -> 'BPlusTree':
         """
         新しいB+ツリーを作成し、初期化する
 
         Args:
             bufmgr (BufferPoolManager): バッファプールマネージャ
+            format_version (int): ノードのページフォーマット(比較用に FORMAT_PICKLE でも作れる)
+            fill_factor (float): 右端のノードを分割するときに左のノードに詰める割合
 
         Returns:
             BPlusTree: 作成されたB+ツリーのインスタンス
         """
-        # メタデータとルートノードの作成
-        meta_buffer = bufmgr.create_page()  # メタデータページを新規作成
-        root_buffer = bufmgr.create_page()  # ルートノードページを新規作成
+        btree = BPlusTree(PageId(PageId.INVALID_PAGE_ID), format_version, fill_factor)
+        # メタデータとルートノードの作成(with を抜けるとピンが外れる)
+        with bufmgr.create_page() as meta_buffer, bufmgr.create_page() as root_buffer:
+            # ルートノードを空のリーフノードとして初期化
+            btree.set_leaf(root_buffer, [])
+            if btree.has_leaf_links():
+                # 前後のリーフは無い
+                invalid = PageId(PageId.INVALID_PAGE_ID)
+                btree.leaf_node(root_buffer.page).set_links(invalid, invalid)
+
+            # メタデータページにルートノードのページIDとフォーマットのバージョンを保存
+            meta_buffer.page[:8] = root_buffer.page_id.to_bytes()
+            if format_version != FORMAT_PICKLE:
+                meta_buffer.page[8:12] = META_MAGIC
+                meta_buffer.page[12:16] = struct.pack('>I', format_version)
+
+            # バッファのダーティフラグを設定（変更があったことを示す）
+            meta_buffer.is_dirty = True
+            root_buffer.is_dirty = True
 
-        # ルートノードをリーフノードとして初期化
-        root_buffer.page[:4] = struct.pack('>I', NodeType.LEAF)  # ノードタイプをリーフに設定
-        root_buffer.page[4:8] = struct.pack('>I', 0)  # ペア数を0に初期化
+        # 新しいB+ツリーのインスタンスを返す
+        btree.meta_page_id = meta_buffer.page_id
+        return btree
 
-        # メタデータページにルートノードのページIDを保存
-        meta_buffer.page[:8] = root_buffer.page_id.to_bytes()
+    @classmethod
+    def bulk_load(cls, bufmgr: BufferPoolManager, sorted_pairs: Iterable[Tuple[bytes, bytes]],
+                  fill_factor: float = DEFAULT_FILL_FACTOR, format_version: int = CURRENT_FORMAT_VERSION,
+                  strategy: Optional[BufferAccessStrategy] = None) -> 'BPlusTree':
+        """
+        キーの昇順に並んだペアから、新しいB+ツリーを下から組み立てる
 
-        # バッファのダーティフラグを設定（変更があったことを示す）
-        meta_buffer.is_dirty = True
-        root_buffer.is_dirty = True
+        Args:
+            bufmgr (BufferPoolManager): バッファプールマネージャ
+            sorted_pairs (Iterable[Tuple[bytes, bytes]]): キーの昇順の (キー, 値)。ジェネレータでもよい
+            fill_factor (float): 各ノードに詰める割合(0.5～1.0)。後から挿入するなら空きを残す
+            format_version (int): ノードのページフォーマット
+            strategy (Optional[BufferAccessStrategy]): ページの作成に使うリング。
+                None なら BufferAccessStrategy() を使い、バッファプールの他のページを追い出さない
 
-        # 新しいB+ツリーのインスタンスを返す
-        return BPlusTree(meta_page_id=meta_buffer.page_id)
+        Returns:
+            BPlusTree: 作成されたB+ツリーのインスタンス
 
-    def fetch_root_page(self, bufmgr: BufferPoolManager) -> Buffer:
+        Raises:
+            DuplicateKeyError: 同じキーが続いた場合
+            BTreeError: キーが昇順に並んでいない場合
+            NodeOverflowError: ペアが大きすぎる(max_pair_size() を超える)場合
+        """
+        btree = cls(PageId(PageId.INVALID_PAGE_ID), format_version, fill_factor)
+        if strategy is None:
+            strategy = BufferAccessStrategy()
+        # メタデータページを最初に確保し、ルートページIDは組み立て終わってから書く
+        with bufmgr.create_page(strategy) as meta_buffer:
+            meta_buffer.is_dirty = True
+        btree.meta_page_id = meta_buffer.page_id
+        root_page_id = BulkLoader(btree, bufmgr, strategy).load(sorted_pairs)
+        with bufmgr.fetch_page(btree.meta_page_id) as meta_buffer:
+            meta_buffer.page[:8] = root_page_id.to_bytes()
+            if format_version != FORMAT_PICKLE:
+                meta_buffer.page[8:12] = META_MAGIC
+                meta_buffer.page[12:16] = struct.pack('>I', format_version)
+            meta_buffer.is_dirty = True
+        return btree
+
+    def read_meta(self, meta_buffer: Buffer) -> PageId:
+        """
+        メタデータページからフォーマットのバージョンを読み取り、ルートページIDを返す
+
+        Args:
+            meta_buffer (Buffer): メタデータページのバッファ
+
+        Returns:
+            PageId: ルートページのページID
+        """
+        if self.format_version is None:
+            if bytes(meta_buffer.page[8:12]) == META_MAGIC:
+                format_version = struct.unpack('>I', meta_buffer.page[12:16])[0]
+            else:
+                format_version = FORMAT_PICKLE
+            if format_version > CURRENT_FORMAT_VERSION:
+                raise BTreeError(f"unsupported B+tree format version {format_version}")
+            self.format_version = format_version
+        return PageId.from_bytes(meta_buffer.page[:8])
+
+    def fetch_root_page(self, bufmgr: BufferPoolManager, strategy: Optional[BufferAccessStrategy] = None) -> Buffer:
         """
         ルートページを取得する
 
         Args:
             bufmgr (BufferPoolManager): バッファプールマネージャ
+            strategy (Optional[BufferAccessStrategy]): ページの読み込みに使うリング(スキャン用)
 
         Returns:
-            Buffer: ルートページのバッファ
+            Buffer: ルートページのバッファ(ピン留めされているので、呼び出し元が with 文などで外す)
         """
-        meta_buffer = bufmgr.fetch_page(self.meta_page_id)  # メタデータページを取得
-        root_page_id = PageId.from_bytes(meta_buffer.page[:8])  # メタデータからルートページIDを読み取る
-        return bufmgr.fetch_page(root_page_id)  # ルートページのバッファを返す
+        with bufmgr.fetch_page(self.meta_page_id, strategy) as meta_buffer:  # メタデータページを取得
+            root_page_id = self.read_meta(meta_buffer)  # メタデータからルートページIDを読み取る
+        return bufmgr.fetch_page(root_page_id, strategy)  # ルートページのバッファを返す
 
-    def search(self, bufmgr: BufferPoolManager, search_mode: SearchMode) -> Optional[Tuple[bytes, bytes]]:
+    def search(self, bufmgr: BufferPoolManager, search_mode: SearchMode, end_key: Optional[bytes] = None,
+               strategy: Optional[BufferAccessStrategy] = None) -> 'Iter':
         """
-        B+ツリー内で指定された検索モードに基づいて検索を行う
+        B+ツリー内で指定された検索モードの位置を指すカーソルを返す
 
         Args:
             bufmgr (BufferPoolManager): バッファプールマネージャ
-            search_mode (SearchMode): 検索モード
+            search_mode (SearchMode): 検索モード(KEY ならそのキー以上の最初のペア、START なら最初のペアを指す)
+            end_key (Optional[bytes]): このキーより大きいペアに来たらカーソルを止める
+            strategy (Optional[BufferAccessStrategy]): ページの読み込みに使うリング(スキャン用)
+
+        Returns:
+            Iter: カーソル。get() で今のペアを、next() でペアを順に取り出す
+        """
+        iter = Iter(self, bufmgr, end_key, strategy)
+        if search_mode.mode == SearchMode.START:
+            iter.seek_first()
+        else:
+            iter.seek(search_mode.key)
+        return iter
+
+    def get(self, bufmgr: BufferPoolManager, key: bytes) -> Optional[Tuple[bytes, bytes]]:
+        """
+        キーが key のペアを探す(カーソルを作らない点検索)
+
+        Args:
+            bufmgr (BufferPoolManager): バッファプールマネージャ
+            key (bytes): 探すキー
 
         Returns:
             Optional[Tuple[bytes, bytes]]: 見つかったキーと値のタプル、見つからなければNone
         """
-        root_page = self.fetch_root_page(bufmgr)  # ルートページを取得
-        return self.search_internal(bufmgr, root_page, search_mode)  # 内部検索メソッドを呼び出す
+        with self.fetch_root_page(bufmgr) as root_page:  # ルートページを取得
+            return self.search_internal(bufmgr, root_page, SearchMode.Key(key))  # 内部検索メソッドを呼び出す
 
-    def search_internal(self, bufmgr: BufferPoolManager, node_buffer: Buffer, search_mode: SearchMode) -> Optional[Tuple[bytes, bytes]]:
+    def search_internal(self, bufmgr: BufferPoolManager, node_buffer: Buffer, search_mode: SearchMode,
+                        level: int = 0) -> Optional[Tuple[bytes, bytes]]:
         """
         再帰的にB+ツリーを探索し、指定されたキーを検索する
 
@@ -159,6 +507,7 @@ class BPlusTree:
             bufmgr (BufferPoolManager): バッファプールマネージャ
             node_buffer (Buffer): 現在探索中のノードのバッファ
             search_mode (SearchMode): 検索モード
+            level (int): node_buffer の木の中のレベル(ルートが0。探索の計測に使う)
 
         Returns:
             Optional[Tuple[bytes, bytes]]: 見つかったキーと値のタプル、見つからなければNone
@@ -167,25 +516,204 @@ class BPlusTree:
         node_type = struct.unpack('>I', node_buffer.page[:4])[0]
 
         if node_type == NodeType.LEAF:
-            # リーフノードの場合、ペアを取得してキーを検索
-            pairs = self.get_pairs(node_buffer)
-            for pair in pairs:
-                if search_mode.key and pair.key == search_mode.key:
-                    return pair.key, pair.value  # キーが一致した場合、キーと値を返す
-            return None  # 見つからなかった場合
+            if self.format_version == FORMAT_PICKLE:
+                # リーフノードの場合、ペアを取得してキーを検索
+                pairs = self.get_pairs(node_buffer)
+                for pair in pairs:
+                    if search_mode.key and pair.key == search_mode.key:
+                        return pair.key, pair.value  # キーが一致した場合、キーと値を返す
+                return None  # 見つからなかった場合
+            # スロット化ページはキーだけをページ上で二分探索し、一致したペアだけを取り出す
+            if not search_mode.key:
+                return None
+            leaf = self.leaf_node(node_buffer.page)
+            index = leaf.find(search_mode.key)
+            self._record(level, leaf)
+            if index is None:
+                return None
+            return bytes(leaf.key(index)), bytes(leaf.value(index))
         else:
             # ブランチノードの場合、キーに基づいて適切な子ノードを選択
-            keys, children = self.get_branch(node_buffer)
-            for i, key in enumerate(keys):
-                if search_mode.key < key:
-                    # 指定されたキーが現在のキーより小さい場合、対応する子ノードに進む
-                    child_page_id = children[i]
-                    child_buffer = bufmgr.fetch_page(child_page_id)
-                    return self.search_internal(bufmgr, child_buffer, search_mode)
-            # 全てのキーよりも大きい場合、最後の子ノードに進む
-            child_page_id = children[-1]
-            child_buffer = bufmgr.fetch_page(child_page_id)
-            return self.search_internal(bufmgr, child_buffer, search_mode)
+            child_page_id = self.find_child(node_buffer, search_mode.key, level)
+            with bufmgr.fetch_page(child_page_id) as child_buffer:
+                return self.search_internal(bufmgr, child_buffer, search_mode, level + 1)
+
+    def find_child(self, buffer: Buffer, key: Optional[bytes], level: int = 0) -> PageId:
+        """
+        ブランチノードで key が属する子ノードのページIDを返す
+
+        Args:
+            buffer (Buffer): ブランチノードのバッファ
+            key (Optional[bytes]): 探すキー。None なら一番左の子ノード
+            level (int): ブランチノードの木の中のレベル(探索の計測に使う)
+
+        Returns:
+            PageId: 子ノードのページID
+        """
+        if self.format_version == FORMAT_PICKLE:
+            keys, children = self.get_branch(buffer)
+            return children[0 if key is None else self.child_index(keys, key)]
+        # スロット化ページはキーのリストを作らずに、スロットの配列を二分探索する
+        branch = BranchNode(buffer.page)
+        if key is None:
+            return branch.child(0)
+        child_page_id = branch.child(branch.child_index(key))
+        self._record(level, branch)
+        return child_page_id
+
+    def find_leaf(self, bufmgr: BufferPoolManager, key: Optional[bytes],
+                  strategy: Optional[BufferAccessStrategy] = None) -> PageId:
+        """key が属するリーフノード(key が None なら一番左のリーフノード)のページIDを返す"""
+        with self.fetch_root_page(bufmgr, strategy) as buffer:
+            page_id = buffer.page_id
+            is_leaf = struct.unpack('>I', buffer.page[:4])[0] == NodeType.LEAF
+            child_page_id = None if is_leaf else self.find_child(buffer, key)
+        level = 1
+        while child_page_id is not None:
+            page_id = child_page_id
+            with bufmgr.fetch_page(page_id, strategy) as buffer:
+                is_leaf = struct.unpack('>I', buffer.page[:4])[0] == NodeType.LEAF
+                child_page_id = None if is_leaf else self.find_child(buffer, key, level)
+            level += 1
+        return page_id
+
+    def neighbor_leaf(self, bufmgr: BufferPoolManager, key: bytes, forward: bool,
+                      strategy: Optional[BufferAccessStrategy] = None) -> Optional[PageId]:
+        """
+        key を含むリーフノードの次(forward が False なら前)のリーフノードのページIDを返す(無ければ None)。
+        リーフのリンクが無いフォーマットのために、ルートからたどり直して求める。
+        たどった経路で隣の子ノードがある一番深いブランチノードから、その子ノードの一番端のリーフまで下りる。
+        """
+        neighbor = None
+        with self.fetch_root_page(bufmgr, strategy) as buffer:
+            page_id = buffer.page_id
+        while True:
+            with bufmgr.fetch_page(page_id, strategy) as buffer:
+                if struct.unpack('>I', buffer.page[:4])[0] == NodeType.LEAF:
+                    break
+                keys, children = self.get_branch(buffer)
+            index = self.child_index(keys, key)
+            if forward and index < len(keys):
+                neighbor = children[index + 1]
+            elif not forward and index > 0:
+                neighbor = children[index - 1]
+            page_id = children[index]
+        if neighbor is None:
+            return None
+        page_id = neighbor
+        while True:
+            with bufmgr.fetch_page(page_id, strategy) as buffer:
+                if struct.unpack('>I', buffer.page[:4])[0] == NodeType.LEAF:
+                    return page_id
+                _, children = self.get_branch(buffer)
+            page_id = children[0] if forward else children[-1]
+
+    @staticmethod
+    def child_index(keys: List[bytes], key: bytes) -> int:
+        """
+        ブランチノードで key が属する子ノードのインデックスを返す
+
+        Args:
+            keys (List[bytes]): ブランチノードのキーリスト(昇順)
+            key (bytes): 探すキー
+
+        Returns:
+            int: key より大きい最初のキーの位置(全てのキー以上なら len(keys) で最後の子ノード)
+        """
+        return bisect_right(keys, key)
+
+    def pair_size(self, pair: Pair) -> int:
+        """ペア1つがリーフノードで使うバイト数"""
+        if self.format_version == FORMAT_PICKLE:
+            return 4 + len(pair.to_bytes())
+        return LEAF_SLOT.size + len(pair.key) + len(pair.value)
+
+    def key_size(self, key: bytes) -> int:
+        """キー1つ(とその右の子ページID)がブランチノードで使うバイト数"""
+        if self.format_version == FORMAT_PICKLE:
+            return 4 + len(key) + 8
+        return BRANCH_SLOT.size + len(key)
+
+    def leaf_header_size(self) -> int:
+        # ヘッダ(と FORMAT_LINKED なら前後のリーフのページID)
+        return 8 if self.format_version == FORMAT_PICKLE else leaf_node_class(self.format_version).SLOTS_START
+
+    def branch_header_size(self) -> int:
+        # ヘッダと一番左の子ページID
+        return 16 if self.format_version == FORMAT_PICKLE else BRANCH_SLOTS_START
+
+    def leaf_fits(self, sizes: List[int]) -> bool:
+        """ペアのバイト数のリスト sizes のリーフノードが1ページに収まるか"""
+        if self.LEAF_NODE_MAX_PAIRS is not None and len(sizes) > self.LEAF_NODE_MAX_PAIRS:
+            return False
+        return self.leaf_header_size() + sum(sizes) <= PAGE_SIZE
+
+    def branch_fits(self, sizes: List[int]) -> bool:
+        """キーのバイト数のリスト sizes のブランチノードが1ページに収まるか"""
+        if self.BRANCH_NODE_MAX_KEYS is not None and len(sizes) > self.BRANCH_NODE_MAX_KEYS:
+            return False
+        return self.branch_header_size() + sum(sizes) <= PAGE_SIZE
+
+    def max_pair_size(self) -> int:
+        """
+        挿入できるペアの最大のバイト数。
+        どのペアもノードの空き領域の1/3以下なら、あふれたノードを2つに分けると必ずどちらも1ページに収まり、
+        そこから昇格するキーも、ブランチノードに3つ以上入る。
+        """
+        return (PAGE_SIZE - max(self.leaf_header_size(), self.branch_header_size())) // 3
+
+    def split_point(self, sizes: List[int], fits, ratio: float, promote: bool) -> int:
+        """
+        あふれたノードの分割位置を選ぶ。左のノードは sizes[:index]、右のノードは sizes[index:] (promote なら index 番目は昇格させて除く)。
+        両方のノードが収まる位置のうち、左のノードのバイト数が全体の ratio 倍に最も近いものを返す。
+        左のノードは index が大きいほど、右のノードは index が小さいほど大きくなるので、
+        両方が収まる位置は連続した範囲になる。その両端と、目標のバイト数に最も近い位置をそれぞれ二分探索で求める。
+
+        Args:
+            sizes (List[int]): エントリごとのバイト数
+            fits: バイト数のリストを受け取り、ノードが収まるかを返す関数
+            ratio (float): 左のノードに入れるバイト数の割合
+            promote (bool): ブランチノードの分割(分割位置のキーは親に昇格させる)かどうか
+
+        Returns:
+            int: 分割位置
+        """
+        last = len(sizes) - (2 if promote else 1)
+        # 左のノードが収まる最大の位置
+        low, high = 1, last + 1
+        while low < high:
+            mid = (low + high) // 2
+            if fits(sizes[:mid]):
+                low = mid + 1
+            else:
+                high = mid
+        left_limit = low - 1
+        # 右のノードが収まる最小の位置
+        low, high = 1, last + 1
+        while low < high:
+            mid = (low + high) // 2
+            if fits(sizes[mid + 1:] if promote else sizes[mid:]):
+                high = mid
+            else:
+                low = mid + 1
+        right_limit = low
+        if right_limit > left_limit:
+            raise NodeOverflowError("cannot split the node into two pages")
+
+        # prefix[i] は左のノードを sizes[:i] にしたときのバイト数
+        prefix = list(accumulate(sizes, initial=0))
+        target = prefix[-1] * ratio
+        low, high = right_limit, left_limit
+        while low < high:
+            mid = (low + high) // 2
+            if prefix[mid] < target:
+                low = mid + 1
+            else:
+                high = mid
+        # target 以上になる最初の位置と、その1つ前のうち近い方(同じなら前の方)
+        if low > right_limit and target - prefix[low - 1] <= prefix[low] - target:
+            return low - 1
+        return low
 
     def insert(self, bufmgr: BufferPoolManager, key: bytes, value: bytes) -> None:
         """
@@ -195,24 +723,33 @@ class BPlusTree:
             bufmgr (BufferPoolManager): バッファプールマネージャ
             key (bytes): 挿入するキー
             value (bytes): 挿入する値
+
+        Raises:
+            DuplicateKeyError: 同じキーが既にある場合
+            NodeOverflowError: ペアが大きすぎる(max_pair_size() を超える)場合
         """
-        root_page = self.fetch_root_page(bufmgr)  # ルートページを取得
-        new_child = self.insert_internal(bufmgr, root_page, key, value)  # 内部挿入処理を呼び出す
+        with self.fetch_root_page(bufmgr) as root_page:  # ルートページを取得
+            size = self.pair_size(Pair(key, value))
+            if size > self.max_pair_size():
+                raise NodeOverflowError(f"pair of {size} bytes exceeds the maximum of {self.max_pair_size()} bytes")
+            new_child = self.insert_internal(bufmgr, root_page, key, value)  # 内部挿入処理を呼び出す
+            root_page_id = root_page.page_id
 
         if new_child is not None:
             # 挿入後、ルートノードが分割された場合、新しいルートノードを作成
-            new_root_buffer = bufmgr.create_page()  # 新しいルートページを作成
-            new_root_buffer.page[:4] = struct.pack('>I', NodeType.BRANCH)  # ノードタイプをブランチに設定
-            new_root_buffer.is_dirty = True  # ダーティフラグを設定
+            with bufmgr.create_page() as new_root_buffer:  # 新しいルートページを作成
+                new_root_buffer.page[:4] = struct.pack('>I', NodeType.BRANCH)  # ノードタイプをブランチに設定
+                new_root_buffer.is_dirty = True  # ダーティフラグを設定
 
-            meta_buffer = bufmgr.fetch_page(self.meta_page_id)  # メタデータページを取得
-            meta_buffer.page[:8] = new_root_buffer.page_id.to_bytes()  # メタデータに新しいルートページIDを設定
-            meta_buffer.is_dirty = True  # ダーティフラグを設定
+                with bufmgr.fetch_page(self.meta_page_id) as meta_buffer:  # メタデータページを取得
+                    meta_buffer.page[:8] = new_root_buffer.page_id.to_bytes()  # メタデータに新しいルートページIDを設定
+                    meta_buffer.is_dirty = True  # ダーティフラグを設定
 
-            new_key, new_page_id = new_child  # 分割によって昇格したキーと新しいページIDを取得
-            self.set_branch(new_root_buffer, [new_key], [root_page.page_id, new_page_id])  # 新しいルートノードに設定
+                new_key, new_page_id = new_child  # 分割によって昇格したキーと新しいページIDを取得
+                self.set_branch(new_root_buffer, [new_key], [root_page_id, new_page_id])  # 新しいルートノードに設定
 
-    def insert_internal(self, bufmgr: BufferPoolManager, node_buffer: Buffer, key: bytes, value: bytes) -> Optional[Tuple[bytes, PageId]]:
+    def insert_internal(self, bufmgr: BufferPoolManager, node_buffer: Buffer, key: bytes, value: bytes,
+                        level: int = 0) -> Optional[Tuple[bytes, PageId]]:
         """
         再帰的にB+ツリーにキーと値のペアを挿入し、必要に応じてノードを分割する
 
@@ -221,6 +758,7 @@ class BPlusTree:
             node_buffer (Buffer): 現在挿入対象のノードのバッファ
             key (bytes): 挿入するキー
             value (bytes): 挿入する値
+            level (int): node_buffer の木の中のレベル(ルートが0。探索の計測に使う)
 
         Returns:
             Optional[Tuple[bytes, PageId]]: 分割が発生した場合、昇格したキーと新しいページIDのタプル。それ以外はNone
@@ -229,61 +767,81 @@ class BPlusTree:
         node_type = struct.unpack('>I', node_buffer.page[:4])[0]
 
         if node_type == NodeType.LEAF:
-            # リーフノードの場合、ペアを取得
-            pairs = self.get_pairs(node_buffer)
-
-            # 重複キーのチェック
-            for pair in pairs:
-                if pair.key == key:
+            if self.format_version == FORMAT_PICKLE:
+                # リーフノードの場合、ペアを取得して挿入位置を探す
+                pairs = self.get_pairs(node_buffer)
+                index = bisect_right([pair.key for pair in pairs], key)
+                if index > 0 and pairs[index - 1].key == key:
                     raise DuplicateKeyError("Duplicate key")
+            else:
+                # スロット化ページは挿入位置をスロットの配列の二分探索で求める
+                leaf = self.leaf_node(node_buffer.page)
+                index = leaf.lower_bound(key)
+                self._record(level, leaf)
+                # 重複キーのチェック
+                if index < leaf.count and leaf.key(index) == key:
+                    raise DuplicateKeyError("Duplicate key")
+                # 収まればスロットとセルだけをその場で書き足す(ペアリストは分割するときだけ作る)
+                if (self.LEAF_NODE_MAX_PAIRS is None or leaf.count < self.LEAF_NODE_MAX_PAIRS) \
+                        and leaf.insert(index, key, value):
+                    node_buffer.is_dirty = True
+                    return None
+                pairs = leaf.pairs()
 
-            # 新しいペアを追加
-            pairs.append(Pair(key, value))
-            # キーの昇順にソート
-            pairs.sort(key=lambda p: p.key)
+            # 新しいペアをキーの順序を保つ位置に追加
+            pairs.insert(index, Pair(key, value))
 
-            if len(pairs) <= self.LEAF_NODE_MAX_PAIRS:
-                # オーバーフローしない場合、リーフノードを更新
+            sizes = [self.pair_size(pair) for pair in pairs]
+            if self.leaf_fits(sizes):
+                # ページに収まる場合、リーフノードを更新
                 self.set_leaf(node_buffer, pairs)
                 node_buffer.is_dirty = True
                 return None  # 分割は不要
             else:
-                # リーフノードがオーバーフローした場合、分割処理を行う
-                return self.split_leaf(bufmgr, node_buffer, pairs)
+                # リーフノードがページからあふれる場合、分割処理を行う
+                return self.split_leaf(bufmgr, node_buffer, pairs, sizes, rightmost=index == len(pairs) - 1)
         else:
             # ブランチノードの場合、キーに基づいて適切な子ノードを選択
-            keys, children = self.get_branch(node_buffer)
-            index = 0
-            # 挿入するキーがどの範囲に属するかを決定
-            while index < len(keys) and key >= keys[index]:
-                index += 1
-
-            # 選択された子ノードのページIDを取得
-            child_page_id = children[index]
-            child_buffer = bufmgr.fetch_page(child_page_id)
+            if self.format_version == FORMAT_PICKLE:
+                keys, children = self.get_branch(node_buffer)
+                # 挿入するキーがどの範囲に属するかを決定
+                index = self.child_index(keys, key)
+                child_page_id = children[index]
+            else:
+                # スロット化ページはキーのリストを作らずに子ノードを選ぶ(リストはこのノードを書き換えるときだけ作る)
+                branch = BranchNode(node_buffer.page)
+                index = branch.child_index(key)
+                child_page_id = branch.child(index)
+                self._record(level, branch)
 
             # 選択された子ノードに再帰的に挿入処理を行う
-            result = self.insert_internal(bufmgr, child_buffer, key, value)
+            with bufmgr.fetch_page(child_page_id) as child_buffer:
+                result = self.insert_internal(bufmgr, child_buffer, key, value, level + 1)
 
             if result is None:
                 # 子ノードが分割されなかった場合、何も返さない
                 return None
             else:
                 # 子ノードが分割され、新しいキーとページIDが昇格された場合、親ノードに挿入
+                if self.format_version != FORMAT_PICKLE:
+                    keys, children = self.get_branch(node_buffer)
                 new_key, new_page_id = result
                 keys.insert(index, new_key)           # 昇格キーを親ノードのキーリストに挿入
                 children.insert(index + 1, new_page_id)  # 新しい子ノードのページIDを子リストに挿入
 
-                if len(keys) <= self.BRANCH_NODE_MAX_KEYS:
-                    # ブランチノードがオーバーフローしない場合、ノードを更新
+                sizes = [self.key_size(key) for key in keys]
+                if self.branch_fits(sizes):
+                    # ページに収まる場合、ノードを更新
                     self.set_branch(node_buffer, keys, children)
                     node_buffer.is_dirty = True
                     return None  # 分割は不要
                 else:
-                    # ブランチノードがオーバーフローした場合、分割処理を行う
-                    return self.split_branch(bufmgr, node_buffer, keys, children)
+                    # ブランチノードがページからあふれる場合、分割処理を行う
+                    return self.split_branch(bufmgr, node_buffer, keys, children, sizes,
+                                             rightmost=index == len(keys) - 1)
 
-    def split_leaf(self, bufmgr: BufferPoolManager, node_buffer: Buffer, pairs: List[Pair]) -> Tuple[bytes, PageId]:
+    def split_leaf(self, bufmgr: BufferPoolManager, node_buffer: Buffer, pairs: List[Pair],
+                   sizes: List[int], rightmost: bool = False) -> Tuple[bytes, PageId]:
         """
         リーフノードを分割し、昇格させるキーと新しいリーフノードのページIDを返す
 
@@ -291,12 +849,14 @@ class BPlusTree:
             bufmgr (BufferPoolManager): バッファプールマネージャ
             node_buffer (Buffer): 分割対象のリーフノードのバッファ
             pairs (List[Pair]): リーフノード内のペアリスト
+            sizes (List[int]): ペアごとのバイト数
+            rightmost (bool): 新しいペアが右端に挿入されたか(なら左のノードに fill_factor まで詰める)
 
         Returns:
             Tuple[bytes, PageId]: 昇格させるキーと新しいリーフノードのページID
         """
-        # リーフノードのペアを半分に分割
-        mid = len(pairs) // 2
+        # リーフノードのペアをバイト数で分割
+        mid = self.split_point(sizes, self.leaf_fits, self.fill_factor if rightmost else 0.5, promote=False)
         left_pairs = pairs[:mid]   # 左側のペア
         right_pairs = pairs[mid:]  # 右側のペア
 
@@ -305,10 +865,20 @@ class BPlusTree:
         node_buffer.is_dirty = True
 
         # 新しいリーフノードを作成し、右側のペアを設定
-        new_leaf_buffer = bufmgr.create_page()
-        new_leaf_buffer.page[:4] = struct.pack('>I', NodeType.LEAF)  # ノードタイプをリーフに設定
-        self.set_leaf(new_leaf_buffer, right_pairs)
-        new_leaf_buffer.is_dirty = True
+        with bufmgr.create_page() as new_leaf_buffer:
+            new_leaf_buffer.page[:4] = struct.pack('>I', NodeType.LEAF)  # ノードタイプをリーフに設定
+            self.set_leaf(new_leaf_buffer, right_pairs)
+            new_leaf_buffer.is_dirty = True
+            if self.has_leaf_links():
+                # 新しいリーフを元のリーフと、その次のリーフの間につなぐ
+                left = self.leaf_node(node_buffer.page)
+                prev_page_id, next_page_id = left.links()
+                self.leaf_node(new_leaf_buffer.page).set_links(node_buffer.page_id, next_page_id)
+                left.set_links(prev_page_id, new_leaf_buffer.page_id)
+                if next_page_id.page_id != PageId.INVALID_PAGE_ID:
+                    with bufmgr.fetch_page(next_page_id) as next_buffer:
+                        self.leaf_node(next_buffer.page).set_prev(new_leaf_buffer.page_id)
+                        next_buffer.is_dirty = True
 
         # 昇格させるキーは右側のリーフノードの最初のキー
         promote_key = right_pairs[0].key
@@ -316,7 +886,8 @@ class BPlusTree:
         # 新しいリーフノードのページIDを返す
         return promote_key, new_leaf_buffer.page_id
 
-    def split_branch(self, bufmgr: BufferPoolManager, node_buffer: Buffer, keys: List[bytes], children: List[PageId]) -> Tuple[bytes, PageId]:
+    def split_branch(self, bufmgr: BufferPoolManager, node_buffer: Buffer, keys: List[bytes], children: List[PageId],
+                     sizes: List[int], rightmost: bool = False) -> Tuple[bytes, PageId]:
         """
         ブランチノードを分割し、昇格させるキーと新しいブランチノードのページIDを返す
 
@@ -325,12 +896,14 @@ class BPlusTree:
             node_buffer (Buffer): 分割対象のブランチノードのバッファ
             keys (List[bytes]): ブランチノード内のキーリスト
             children (List[PageId]): ブランチノード内の子ページIDリスト
+            sizes (List[int]): キーごとのバイト数
+            rightmost (bool): 新しいキーが右端に挿入されたか(なら左のノードに fill_factor まで詰める)
 
         Returns:
             Tuple[bytes, PageId]: 昇格させるキーと新しいブランチノードのページID
         """
-        # ブランチノードのキーを半分に分割
-        mid = len(keys) // 2
+        # ブランチノードのキーをバイト数で分割
+        mid = self.split_point(sizes, self.branch_fits, self.fill_factor if rightmost else 0.5, promote=True)
         promote_key = keys[mid]  # 昇格させるキー
 
         left_keys = keys[:mid]         # 左側のキー
@@ -344,10 +917,10 @@ class BPlusTree:
         node_buffer.is_dirty = True
 
         # 新しいブランチノードを作成し、右側のキーと子ページIDを設定
-        new_branch_buffer = bufmgr.create_page()
-        new_branch_buffer.page[:4] = struct.pack('>I', NodeType.BRANCH)  # ノードタイプをブランチに設定
-        self.set_branch(new_branch_buffer, right_keys, right_children)
-        new_branch_buffer.is_dirty = True
+        with bufmgr.create_page() as new_branch_buffer:
+            new_branch_buffer.page[:4] = struct.pack('>I', NodeType.BRANCH)  # ノードタイプをブランチに設定
+            self.set_branch(new_branch_buffer, right_keys, right_children)
+            new_branch_buffer.is_dirty = True
 
         # 昇格させるキーと新しいブランチノードのページIDを返す
         return promote_key, new_branch_buffer.page_id
@@ -362,6 +935,8 @@ class BPlusTree:
         Returns:
             List[Pair]: リーフノード内のペアリスト
         """
+        if self.format_version != FORMAT_PICKLE:
+            return self.leaf_node(buffer.page).pairs()
         # ペア数を読み取る（ページの4～8バイト目）
         num_pairs = struct.unpack('>I', buffer.page[4:8])[0]
         pairs = []
@@ -390,15 +965,20 @@ class BPlusTree:
             buffer (Buffer): リーフノードのバッファ
             pairs (List[Pair]): 設定するペアリスト
         """
+        if self.format_version != FORMAT_PICKLE:
+            leaf_node_class(self.format_version).write(buffer.page, pairs)
+            return
+        # ペアをバイト列にシリアライズ
+        pair_datas = [pair.to_bytes() for pair in pairs]
+        if self.leaf_header_size() + sum(4 + len(pair_data) for pair_data in pair_datas) > PAGE_SIZE:
+            raise NodeOverflowError(f"{len(pairs)} pairs do not fit in a leaf page")
         # ノードタイプをリーフに設定（ページの最初の4バイト）
         buffer.page[:4] = struct.pack('>I', NodeType.LEAF)
         # ペア数を設定（ページの4～8バイト目）
         buffer.page[4:8] = struct.pack('>I', len(pairs))
         offset = 8  # ペアデータの開始オフセット
 
-        for pair in pairs:
-            # ペアをバイト列にシリアライズ
-            pair_data = pair.to_bytes()
+        for pair_data in pair_datas:
             pair_size = len(pair_data)
             # ペアのサイズを設定（4バイト）
             buffer.page[offset:offset+4] = struct.pack('>I', pair_size)
@@ -417,6 +997,9 @@ class BPlusTree:
         Returns:
             Tuple[List[bytes], List[PageId]]: キーリストと子ページIDリスト
         """
+        if self.format_version != FORMAT_PICKLE:
+            branch = BranchNode(buffer.page)
+            return branch.keys(), branch.children()
         # キー数を読み取る（ページの4～8バイト目）
         num_keys = struct.unpack('>I', buffer.page[4:8])[0]
         keys = []
@@ -431,7 +1014,8 @@ class BPlusTree:
             # キーのサイズを読み取る（4バイト）
             key_size = struct.unpack('>I', buffer.page[offset:offset+4])[0]
             # キーのデータを読み取る
-            key = buffer.page[offset+4:offset+4+key_size]
+            # ページの memoryview のままだと比較できず、ページを書き換えると中身も変わるので bytes にする
+            key = bytes(buffer.page[offset+4:offset+4+key_size])
             keys.append(key)
             # オフセットを更新
             offset += 4 + key_size
@@ -458,6 +1042,11 @@ class BPlusTree:
             keys (List[bytes]): 設定するキーリスト
             children (List[PageId]): 設定する子ページIDリスト
         """
+        if self.format_version != FORMAT_PICKLE:
+            BranchNode.write(buffer.page, keys, children)
+            return
+        if self.branch_header_size() + sum(self.key_size(key) for key in keys) > PAGE_SIZE:
+            raise NodeOverflowError(f"{len(keys)} keys do not fit in a branch page")
         # ノードタイプをブランチに設定（ページの最初の4バイト）
         buffer.page[:4] = struct.pack('>I', NodeType.BRANCH)
         # キー数を設定（ページの4～8バイト目）
@@ -467,8 +1056,6 @@ class BPlusTree:
         # キーを設定
         for key in keys:
             key_size = len(key)
-            if offset + 4 + key_size > PAGE_SIZE:
-                break  # ページの範囲外を防ぐ
 
             # キーのサイズを設定（4バイト）
             buffer.page[offset:offset+4] = struct.pack('>I', key_size)
@@ -479,66 +1066,309 @@ class BPlusTree:
 
         # 子ページIDを設定
         for child in children:
-            if offset + 8 > PAGE_SIZE:
-                break  # ページの範囲外を防ぐ
-
             # 子ページIDを設定（8バイト）
             buffer.page[offset:offset+8] = child.to_bytes()
             # オフセットを更新
             offset += 8
 
-    def search_range(self, bufmgr: BufferPoolManager, start_key: bytes, end_key: bytes) -> List[Tuple[bytes, bytes]]:
+    def search_range(self, bufmgr: BufferPoolManager, start_key: bytes, end_key: bytes,
+                     strategy: Optional[BufferAccessStrategy] = None) -> List[Tuple[bytes, bytes]]:
         """
         指定された範囲内のキーと値を検索する（オプション）
+        結果を全てリストにするので、大きな範囲は search() のカーソルで少しずつ読む
 
         Args:
             bufmgr (BufferPoolManager): バッファプールマネージャ
             start_key (bytes): 範囲の開始キー
             end_key (bytes): 範囲の終了キー
+            strategy (Optional[BufferAccessStrategy]): ページの読み込みに使うリング。
+                大きな範囲を読むときに BufferAccessStrategy() を渡すと、よく使われるページを追い出さない
 
         Returns:
             List[Tuple[bytes, bytes]]: 範囲内のキーと値のタプルのリスト
         """
-        # ルートページを取得
-        root_buffer = self.fetch_root_page(bufmgr)
-        # 開始キーから範囲検索を開始
-        return self.search_range_internal(bufmgr, root_buffer, start_key, end_key)
-
-    def search_range_internal(self, bufmgr: BufferPoolManager, node_buffer: Buffer, start_key: bytes, end_key: bytes) -> List[Tuple[bytes, bytes]]:
+        return list(self.search(bufmgr, SearchMode.Key(start_key), end_key, strategy))
+
+
+# 以前のバージョンとの互換のための別名
+BTree = BPlusTree
+
+
+class BulkLoader:
+    """
+    BPlusTree.bulk_load() の本体。キーの昇順のペアを1つずつ受け取り、リーフを fill_factor まで詰めては書き出す。
+    書き出したリーフは、各レベルの書きかけのブランチノード(木の右端の経路)に子として加え、
+    ブランチノードが fill_factor まで詰まったら書き出して1つ上のレベルに加える。
+    詰め終わったノードは各レベルで1つだけ書かずに持っておき、入力の終わりで最後のノードが半分も埋まっていなければ、
+    その1つ前のノードと合わせて均等に分け直す。子が1つだけのブランチノードは作らない。
+    持っているのは各レベルのノード2つずつだけなので、入力の大きさによらずメモリは木の高さ分で済む。
+    ページは書き出す順に確保するので、リーフはディスク上でほぼ連続し(間にブランチノードが挟まる)、子は親より前に並ぶ。
+    """
+    def __init__(self, btree: BPlusTree, bufmgr: BufferPoolManager, strategy: Optional[BufferAccessStrategy]):
+        self.btree = btree
+        self.bufmgr = bufmgr
+        self.strategy = strategy
+        self.pairs: List[Pair] = []  # 書きかけのリーフのペア
+        self.leaf_bytes = 0          # 書きかけのリーフのペアのバイト数
+        self.full_pairs: Optional[List[Pair]] = None  # 詰め終わってまだ書いていないリーフのペア
+        # レベルごとの書きかけのブランチノード: [部分木の最小のキー, キーリスト, 子ページIDリスト, キーのバイト数]
+        self.levels: List[list] = []
+        # レベルごとの詰め終わってまだ書いていないブランチノード(まだ無ければ None)
+        self.full_branches: List[Optional[list]] = []
+        self.prev_leaf: Optional[Buffer] = None  # 次のリーフのページIDを書き込むまでピン留めしておく前のリーフ
+
+    def _budget(self, header_size: int) -> float:
+        """fill_factor まで詰めたノードの、ヘッダを除いたバイト数(ページの大きさ以下)"""
+        return (PAGE_SIZE - header_size) * self.btree.fill_factor
+
+    def load(self, sorted_pairs: Iterable[Tuple[bytes, bytes]]) -> PageId:
+        """ペアを全て書き出し、ルートページIDを返す"""
+        btree = self.btree
+        max_size = btree.max_pair_size()
+        leaf_budget = self._budget(btree.leaf_header_size())
+        max_pairs = btree.LEAF_NODE_MAX_PAIRS
+        last_key = None
+        try:
+            for key, value in sorted_pairs:
+                if last_key is not None and key <= last_key:
+                    if key == last_key:
+                        raise DuplicateKeyError("Duplicate key")
+                    raise BTreeError("bulk_load input must be sorted by key")
+                last_key = key
+                pair = Pair(key, value)
+                size = btree.pair_size(pair)
+                if size > max_size:
+                    raise NodeOverflowError(f"pair of {size} bytes exceeds the maximum of {max_size} bytes")
+                # 予算はページの大きさ以下なので、ページに収まるかはペアの数の上限だけ確かめる
+                if self.pairs and (self.leaf_bytes + size > leaf_budget
+                                   or (max_pairs is not None and len(self.pairs) >= max_pairs)):
+                    if self.full_pairs is not None:
+                        self._write_leaf(self.full_pairs)
+                    self.full_pairs = self.pairs
+                    self.pairs = []
+                    self.leaf_bytes = 0
+                self.pairs.append(pair)
+                self.leaf_bytes += size
+
+            # 最後のリーフ(空の入力なら空のルート)が半分も埋まっていなければ、1つ前のリーフと均等に分け直す
+            if self.full_pairs is not None:
+                if self.leaf_bytes < leaf_budget / 2 or (max_pairs is not None and len(self.pairs) < max_pairs // 2):
+                    pairs = self.full_pairs + self.pairs
+                    mid = btree.split_point([btree.pair_size(pair) for pair in pairs], btree.leaf_fits, 0.5, promote=False)
+                    self.full_pairs, self.pairs = pairs[:mid], pairs[mid:]
+                self._write_leaf(self.full_pairs)
+            self._write_leaf(self.pairs)
+        finally:
+            if self.prev_leaf is not None:
+                self.bufmgr.unpin_page(self.prev_leaf.page_id, is_dirty=True)
+                self.prev_leaf = None
+
+        # 残っているブランチノードを下から書き出す
+        level = 0
+        while True:
+            node, full = self.levels[level], self.full_branches[level]
+            if full is None:
+                # まだ1つも詰め終わっていないレベルが一番上。子が1つだけならブランチノードを作らずにその子をルートにする
+                children = node[2]
+                return children[0] if len(children) == 1 else self._write_branch(node)
+            for last in self._rebalance_branches(full, node):
+                self._add_child(level + 1, last[0], self._write_branch(last))
+            level += 1
+
+    def _rebalance_branches(self, full: list, node: list) -> List[list]:
         """
-        再帰的に範囲検索を行う内部メソッド
-
-        Args:
-            bufmgr (BufferPoolManager): バッファプールマネージャ
-            node_buffer (Buffer): 現在探索中のノードのバッファ
-            start_key (bytes): 範囲の開始キー
-            end_key (bytes): 範囲の終了キー
-
-        Returns:
-            List[Tuple[bytes, bytes]]: 範囲内のキーと値のタプルのリスト
+        レベルの最後の2つのブランチノードを返す。最後のノードが半分も埋まっていなければ均等に分け直し、
+        2つに分けると子が1つのノードができてしまうなら1つにまとめる。
         """
-        node_type = struct.unpack('>I', node_buffer.page[:4])[0]
-        results = []
+        btree = self.btree
+        max_keys = btree.BRANCH_NODE_MAX_KEYS
+        low_key, keys, children, size = node
+        if len(children) >= 2 and size >= self._budget(btree.branch_header_size()) / 2 \
+                and (max_keys is None or len(keys) >= max_keys // 2):
+            return [full, node]
+        # 最後のノードの最小のキーが、2つのノードの間のキーになる
+        keys = full[1] + [low_key] + keys
+        children = full[2] + children
+        sizes = [btree.key_size(key) for key in keys]
+        if len(keys) < 3:
+            return [[full[0], keys, children, sum(sizes)]]
+        mid = btree.split_point(sizes, btree.branch_fits, 0.5, promote=True)
+        return [[full[0], keys[:mid], children[:mid + 1], sum(sizes[:mid])],
+                [keys[mid], keys[mid + 1:], children[mid + 1:], sum(sizes[mid + 1:])]]
+
+    def _write_leaf(self, pairs: List[Pair]) -> None:
+        btree = self.btree
+        with self.bufmgr.create_page(self.strategy) as buffer:
+            buffer.page[:4] = struct.pack('>I', NodeType.LEAF)
+            btree.set_leaf(buffer, pairs)
+            buffer.is_dirty = True
+            if btree.has_leaf_links():
+                invalid = PageId(PageId.INVALID_PAGE_ID)
+                if self.prev_leaf is None:
+                    btree.leaf_node(buffer.page).set_links(invalid, invalid)
+                else:
+                    # 前のリーフの次にこのリーフをつなぐ
+                    prev_node = btree.leaf_node(self.prev_leaf.page)
+                    btree.leaf_node(buffer.page).set_links(self.prev_leaf.page_id, invalid)
+                    prev_node.set_links(prev_node.links()[0], buffer.page_id)
+                    self.bufmgr.unpin_page(self.prev_leaf.page_id, is_dirty=True)
+                # with を抜けてもピンが残るように、もう1回ピン留めする
+                self.prev_leaf = self.bufmgr.fetch_page(buffer.page_id, self.strategy)
+        self._add_child(0, pairs[0].key if pairs else b"", buffer.page_id)
+
+    def _add_child(self, level: int, low_key: bytes, page_id: PageId) -> None:
+        """level の書きかけのブランチノードに、最小のキーが low_key の子を加える"""
+        if level == len(self.levels):
+            self.levels.append([low_key, [], [page_id], 0])
+            self.full_branches.append(None)
+            return
+        btree = self.btree
+        node = self.levels[level]
+        _, keys, children, size = node
+        size += btree.key_size(low_key)
+        max_keys = btree.BRANCH_NODE_MAX_KEYS
+        if size > self._budget(btree.branch_header_size()) \
+                or (max_keys is not None and len(keys) >= max_keys):
+            # 詰め終わったノードは、最後のノードと分け直せるように次のノードが詰まるまで書かずに持っておく
+            full = self.full_branches[level]
+            if full is not None:
+                self._add_child(level + 1, full[0], self._write_branch(full))
+            self.full_branches[level] = node
+            self.levels[level] = [low_key, [], [page_id], 0]
+            return
+        keys.append(low_key)
+        children.append(page_id)
+        node[3] = size
+
+    def _write_branch(self, node: list) -> PageId:
+        """ブランチノードを書き出し、そのページIDを返す"""
+        _, keys, children, _ = node
+        with self.bufmgr.create_page(self.strategy) as buffer:
+            buffer.page[:4] = struct.pack('>I', NodeType.BRANCH)
+            self.btree.set_branch(buffer, keys, children)
+            buffer.is_dirty = True
+        return buffer.page_id
+
+
+class Iter:
+    """
+    B+ツリーのペアをキー順にたどるカーソル。BPlusTree.search() で作る。
+    リーフを1つずつ読んでペアをコピーして持ち、ページのピンは持たないので、使うメモリはリーフ1つ分で済む。
+    FORMAT_LINKED のツリーではリーフのリンクで隣のリーフに移り、古いフォーマットではルートからたどり直す。
+    end_key を指定すると、それより大きいキーのペアは返さずに止まる。
+    カーソルはペアの間の位置を指す: next() は次のペアを返して進み、prev() は1つ戻って前のペアを返す。
+    読み込み済みのリーフへの挿入はカーソルから見えないので、ツリーを変更したら seek() し直す。
+    """
+    def __init__(self, btree: BPlusTree, bufmgr: BufferPoolManager, end_key: Optional[bytes] = None,
+                 strategy: Optional[BufferAccessStrategy] = None):
+        self.btree = btree
+        self.bufmgr = bufmgr
+        self.end_key = end_key
+        self.strategy = strategy
+        self.pairs: List[Pair] = []  # 今のリーフのペア
+        self.index = 0               # 次に返すペアの位置
+        self.prev_page_id: Optional[PageId] = None  # FORMAT_LINKED の前後のリーフ
+        self.next_page_id: Optional[PageId] = None
+        self.page_id: Optional[PageId] = None  # 今のリーフ
+        self.skipped = 0             # 今のリーフの先頭の、pairs にコピーしなかったペアの数
+
+    def _load_leaf(self, page_id: PageId, key: Optional[bytes] = None) -> int:
+        """
+        リーフを読み込み、key 以上の最初のペアの位置を返す(key が None なら0)。
+        FORMAT_LINKED のリーフはピンを持つ間にスロットの配列を二分探索し、その位置より後ろのペアだけをコピーする
+        """
+        start = 0
+        with self.bufmgr.fetch_page(page_id, self.strategy) as buffer:
+            if self.btree.has_leaf_links():
+                leaf = self.btree.leaf_node(buffer.page)
+                if key is not None:
+                    start = leaf.lower_bound(key)
+                self.pairs = [leaf.pair(index) for index in range(start, leaf.count)]
+                prev_page_id, next_page_id = leaf.links()
+                self.prev_page_id = None if prev_page_id.page_id == PageId.INVALID_PAGE_ID else prev_page_id
+                self.next_page_id = None if next_page_id.page_id == PageId.INVALID_PAGE_ID else next_page_id
+            else:
+                self.pairs = self.btree.get_pairs(buffer)
+                if key is not None:
+                    start = bisect_left([pair.key for pair in self.pairs], key)
+        self.page_id = page_id
+        self.skipped = 0 if start == 0 or not self.btree.has_leaf_links() else start
+        if self.next_page_id is not None and not self._reached_end():
+            # 範囲が次のリーフに続くなら、次のリーフを先読みしてもらう(先読みが無効なら何もしない)
+            self.bufmgr.prefetch([self.next_page_id])
+        return start - self.skipped
+
+    def _reached_end(self) -> bool:
+        """今のリーフに end_key 以上のキーがあり、次のリーフを読む必要が無いか"""
+        return self.end_key is not None and bool(self.pairs) and self.pairs[-1].key >= self.end_key
+
+    def _neighbor(self, forward: bool) -> Optional[PageId]:
+        if self.btree.has_leaf_links():
+            return self.next_page_id if forward else self.prev_page_id
+        if not self.pairs:
+            return None
+        key = self.pairs[-1].key if forward else self.pairs[0].key
+        return self.btree.neighbor_leaf(self.bufmgr, key, forward, self.strategy)
+
+    def _skip_forward(self) -> None:
+        """今のリーフを読み終えていたら、ペアのある次のリーフに移る"""
+        while self.index >= len(self.pairs) and not self._reached_end():
+            page_id = self._neighbor(True)
+            if page_id is None:
+                return
+            self._load_leaf(page_id)
+            self.index = 0
+
+    def seek(self, key: bytes) -> None:
+        """key 以上の最初のペアの前に移る"""
+        self.index = self._load_leaf(self.btree.find_leaf(self.bufmgr, key, self.strategy), key)
+
+    def seek_first(self) -> None:
+        """最初のペアの前に移る"""
+        self._load_leaf(self.btree.find_leaf(self.bufmgr, None, self.strategy))
+        self.index = 0
+
+    def get(self) -> Optional[Tuple[bytes, bytes]]:
+        """次のペアを進まずに返す(終わりか、end_key より大きければ None)"""
+        self._skip_forward()
+        if self.index >= len(self.pairs):
+            return None
+        pair = self.pairs[self.index]
+        if self.end_key is not None and pair.key > self.end_key:
+            return None
+        return pair.key, pair.value
+
+    def next(self) -> Optional[Tuple[bytes, bytes]]:
+        """次のペアを返して進む(終わりか、end_key より大きければ None で進まない)"""
+        result = self.get()
+        if result is not None:
+            self.index += 1
+        return result
+
+    def prev(self) -> Optional[Tuple[bytes, bytes]]:
+        """1つ前に戻り、そのペアを返す(最初のペアの前なら None で戻らない)"""
+        if self.index == 0 and self.skipped:
+            # seek() で飛ばした今のリーフの先頭のペアを読み直す
+            self.index = self.skipped
+            self._load_leaf(self.page_id)
+        while self.index == 0:
+            page_id = self._neighbor(False)
+            if page_id is None:
+                return None
+            self._load_leaf(page_id)
+            self.index = len(self.pairs)
+        self.index -= 1
+        pair = self.pairs[self.index]
+        return pair.key, pair.value
 
-        if node_type == NodeType.LEAF:
-            # リーフノードの場合、ペアを取得して範囲内のペアを収集
-            pairs = self.get_pairs(node_buffer)
-            for pair in pairs:
-                if start_key <= pair.key <= end_key:
-                    results.append((pair.key, pair.value))
-            return results
-        else:
-            # ブランチノードの場合、範囲内の子ノードを探索
-            keys, children = self.get_branch(node_buffer)
-            for i, key in enumerate(keys):
-                if start_key < key:
-                    # 指定された範囲内に含まれる子ノードを再帰的に探索
-                    child_buffer = bufmgr.fetch_page(children[i])
-                    results.extend(self.search_range_internal(bufmgr, child_buffer, start_key, end_key))
-            # 最後の子ノードも探索
-            child_buffer = bufmgr.fetch_page(children[-1])
-            results.extend(self.search_range_internal(bufmgr, child_buffer, start_key, end_key))
-            return results
+    def __iter__(self) -> 'Iter':
+        return self
+
+    def __next__(self) -> Tuple[bytes, bytes]:
+        result = self.next()
+        if result is None:
+            raise StopIteration
+        return result
 
 # 実行部分
 if __name__ == "__main__":
@@ -573,7 +1403,7 @@ if __name__ == "__main__":
         print("Searching data in B+Tree...")
         for key in [1, 2, 3, 4, 5, 6, 7]:
             key_bytes = struct.pack('>Q', key)  # キーをバイト列にパック
-            result = btree.search(bufmgr, SearchMode.Key(key_bytes))  # 検索実行
+            result = btree.get(bufmgr, key_bytes)  # 検索実行
             if result:
                 found_key, value = result
                 print(f"Key: {struct.unpack('>Q', found_key)[0]}, Value: {value.decode()}")
@@ -588,6 +1418,11 @@ if __name__ == "__main__":
         for found_key, value in range_results:
             print(f"Range Key: {struct.unpack('>Q', found_key)[0]}, Value: {value.decode()}")
 
+        # カーソルで1件ずつ読むテスト
+        print("Scanning B+Tree with a cursor...")
+        for found_key, value in btree.search(bufmgr, SearchMode.Start()):
+            print(f"Cursor Key: {struct.unpack('>Q', found_key)[0]}, Value: {value.decode()}")
+
         print("B+Tree tests passed.")
     finally:
         # 一時ファイルを削除
@@ -1,8 +1,16 @@
+import builtins
+import mmap
 import os
 import struct
+import threading
+import time
+from array import array
 from collections import defaultdict
-from typing import Dict, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Sequence, Set, Tuple
 from disk import DiskManager, PageId, PAGE_SIZE
+from replacement import MAX_USAGE_COUNT, ClockSweep, ReplacementPolicy
+from stats import IOStats, TraceHook
 
 
 """
@@ -10,10 +18,24 @@ from disk import DiskManager, PageId, PAGE_SIZE
 バッファプールの目的: ディスクアクセスを効率化するために、ディスクから読み込んだページをメモリ上に保持しておく
 なぜ: ディスクアクセスはメモリアクセスよりも遅いため、ディスクアクセスを減らすことでパフォーマンス向上が期待できる
 ファイルシステムのキャッシュ機能を使えばいい？: それでも良い、しかしファイルシステムのキャッシュを無効にしRDBMSの独自のタイミングを使用する方が賢い場合もあるため、多くのRDBMSは独自のバッファプールを持っている
+(DiskManager.open(..., io_mode="direct") で開くと O_DIRECT でファイルシステムのキャッシュを経由しなくなり、ページがバッファプールとOSの二重にキャッシュされなくなる)
 (わからないこと: DiskMagerでは、このファイルシステムのブロックサイズが4kbだったことで、ページサイズも4kbにしていたが、もしファイルシステムを使わないのなら、ブロックサイズを4kbにしなくてもいいのでは？)
 どうやってメモリ上に保持するか: バッファは複数あり、ディスクマネージャから読み込んだページをバッファに格納する。どのページがどのバッファに格納されているかは、PageIdとBufferIdのマッピングテーブルしたページテーブルで管理する
 """
 
+# バックグラウンドライターが1回に書き戻す最大ページ数と、書き戻しの間隔(秒)
+BGWRITER_MAX_PAGES = 64
+BGWRITER_INTERVAL = 0.2
+# 先読み(read-ahead)で先に読み込むページ数の既定値と、同じ間隔のアクセスが何回続いたら先読みを始めるか
+READ_AHEAD_WINDOW = 8
+READ_AHEAD_TRIGGER = 2
+# スキャン用のリング(BufferAccessStrategy)の既定のフレーム数
+BULK_READ_RING_SIZE = 16
+# ダーティな置換対象を書き戻すとき、前後に連続するダーティページも一緒に書き戻す最大ページ数
+WRITE_BACK_CLUSTER_SIZE = 16
+# バッファプールを縮小するとき、ピン留めされたフレームが空くのを待つ時間(秒)の既定値
+RESIZE_TIMEOUT = 10.0
+
 
 # バッファ関連の例外クラス
 class BufferError(Exception):
@@ -26,6 +48,11 @@ class NoFreeBufferError(BufferError):
     pass
 
 
+def frames_for_memory_budget(memory_budget: int) -> int:
+    """ページデータが memory_budget バイトに収まるフレーム数(最低1)を返す"""
+    return max(1, memory_budget // PAGE_SIZE)
+
+
 # バッファプール内部で使用するID関連クラス
 class BufferId:
     """
@@ -51,73 +78,250 @@ class Buffer:
     """
     1ページ分のデータを保持するクラス。
     page_id: ディスク上のどのページに対応しているか
-    page: 実際のページデータ（バイナリ配列）
+    page: 実際のページデータ（バッファプールのアリーナの、このフレームの部分の memoryview）
     is_dirty: 変更済みかどうかのフラグ
+    fetch_page / create_page が返す Buffer はピン留めされているので、使い終わったら unpin_page するか、
+    with 文で使ってブロックを抜けるときにピンを外す。
+    Buffer 自体はデータを持たず、page_id や is_dirty は BufferPool の配列の index 番目を読み書きする。
+    フレームごとに1つだけ作り、ページを入れ替えても同じ Buffer を使い続ける。
     """
-    def __init__(self, page_id: PageId):
-        self.page_id = page_id               # ディスク上のページID
-        self.page = bytearray(PAGE_SIZE)     # ページサイズ分のバッファ領域確保。ここにデータを読み書きする
-        self.is_dirty = False                # 変更があった場合 True
+    __slots__ = ('pool', 'index', 'page')
+
+    def __init__(self, pool: 'BufferPool', index: int, page: memoryview):
+        self.pool = pool
+        self.index = index
+        self.page = page  # ここにデータを読み書きする
+
+    @property
+    def page_id(self) -> PageId:
+        return PageId(self.pool.page_nos[self.index])
+
+    @page_id.setter
+    def page_id(self, page_id: PageId) -> None:
+        self.pool.page_nos[self.index] = page_id.page_id
+
+    @property
+    def is_dirty(self) -> bool:
+        return self.pool.dirty[self.index] != 0
+
+    @is_dirty.setter
+    def is_dirty(self, is_dirty: bool) -> None:
+        self.pool.dirty[self.index] = is_dirty
+
+    @property
+    def manager(self):
+        """with 文を抜けるときにピンを外すマネージャ"""
+        return self.pool.manager
+
+    def __enter__(self) -> 'Buffer':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.pool.manager.unpin_page(self.page_id)
 
 
 class Frame:
     """
     Buffer をラップし、使用回数(usage_count)などの
     バッファ置換アルゴリズムに必要な情報を保持するクラス。
+    pin_count は今このページを使っている呼び出し元の数で、0 でないフレームは置換されない。
+    usage_count (最近どれだけ使われたか) とは別に管理する。
+    strategy はこのフレームを読み込んだリング(BufferAccessStrategy)で、リングの外から使われたら None に戻す。
+    値は BufferPool の配列に置き、Frame はその index 番目を読み書きするだけ。
     """
-    def __init__(self, buffer: Buffer):
-        self.usage_count = 0   # バッファ置換アルゴリズム用の使用頻度カウンタ
-        self.buffer = buffer   # 実際のページデータを保持する Buffer オブジェクト
+    __slots__ = ('pool', 'index', 'buffer')
+
+    def __init__(self, pool: 'BufferPool', index: int, page: memoryview):
+        self.pool = pool
+        self.index = index
+        self.buffer = Buffer(pool, index, page)  # 実際のページデータを保持する Buffer オブジェクト
+
+    @property
+    def usage_count(self) -> int:
+        """バッファ置換アルゴリズム用の使用頻度カウンタ (MAX_USAGE_COUNT まで)"""
+        return self.pool.usage_counts[self.index]
+
+    @usage_count.setter
+    def usage_count(self, usage_count: int) -> None:
+        self.pool.usage_counts[self.index] = usage_count
+
+    @property
+    def pin_count(self) -> int:
+        """使用中の数。0 でなければ置換しない"""
+        return self.pool.pin_counts[self.index]
+
+    @pin_count.setter
+    def pin_count(self, pin_count: int) -> None:
+        self.pool.pin_counts[self.index] = pin_count
+
+    @property
+    def strategy(self) -> Optional['BufferAccessStrategy']:
+        """このフレームを使い回せるリング"""
+        return self.pool.strategies[self.index]
+
+    @strategy.setter
+    def strategy(self, strategy: Optional['BufferAccessStrategy']) -> None:
+        self.pool.strategies[self.index] = strategy
+
+
+class BufferAccessStrategy:
+    """
+    スキャンや一括ロードのための、リングバッファによるアクセス方法(PostgreSQLの BufferAccessStrategy と同じ考え方)。
+    fetch_page / create_page に渡すと、ミスしたページはバッファプール全体ではなく、
+    ring_size 個のフレームのリングを使い回して読み込む。ヒットしても使用頻度は上げない。
+    大きなスキャンがよく使われるページ(B+ツリーの内部ノードなど)をバッファプールから追い出さなくなる。
+    リングのフレームがピン留めされていたり、リングの外から使われたりしたときは、バッファプールから別のフレームをもらう。
+    """
+    def __init__(self, ring_size: int = BULK_READ_RING_SIZE):
+        self.ring: List[Optional[int]] = [None] * ring_size  # リングに入っているフレームの buffer_id
+        self.current = 0
+
+    def next_frame(self, pool: 'BufferPool') -> Optional[BufferId]:
+        """リングの次の位置のフレームが使い回せればその BufferId を、使えなければ None を返す"""
+        self.current = (self.current + 1) % len(self.ring)
+        buffer_id = self.ring[self.current]
+        if buffer_id is None:
+            return None
+        if buffer_id >= pool.size():
+            # バッファプールが縮小されて無くなったフレーム
+            self.ring[self.current] = None
+            return None
+        frame = pool.buffers[buffer_id]
+        if frame.pin_count > 0 or frame.strategy is not self:
+            return None
+        return BufferId(buffer_id)
+
+    def add_frame(self, buffer_id: BufferId) -> None:
+        """バッファプールからもらったフレームをリングの今の位置に入れる"""
+        self.ring[self.current] = buffer_id.buffer_id
 
 
 # バッファプール (フレーム配列) を管理するクラス=> 複数のフレームを管理する => 複数のバッファを管理する => 複数のページを管理する
 class BufferPool:
     """
     バッファプールの実体。pool_size 個の Frame を用意し、リストで保持する。
-    また、next_victim_id を持ち、バッファ置換の際に次に探すフレームIDを追跡する。
+    置換対象のフレームは policy (replacement.py の置換アルゴリズム, 既定は ClockSweep) が選ぶ。
+    ページのデータは1つの大きな領域(アリーナ, 無名mmap)に並べ、各フレームはその固定の部分を使う。
+    フレームの情報(ページ番号・dirty・ピン数・使用頻度)もフレームごとのオブジェクトではなく配列に持つので、
+    ページを入れ替えてもメモリの確保・解放が起きず、ディスクからフレームへ直接読み込める。
+    grow() でフレームを増やすと、増えた分のアリーナを新しく確保して後ろにつなげる(既存のフレームは動かさない)。
+    truncate() で後ろのフレームを取り除くと、そのアリーナのメモリをOSに返す。
     """
-    def __init__(self, pool_size: int):
-        # INVALID_PAGE_IDを持つ Buffer をフレームに詰めて pool_size 個用意
-        self.buffers = [Frame(Buffer(PageId(PageId.INVALID_PAGE_ID))) for _ in range(pool_size)]
-        # バッファ置換アルゴリズムで最初に探しに行くフレームID
-        self.next_victim_id = BufferId(0)
+    def __init__(self, pool_size: int, policy: Optional[ReplacementPolicy] = None):
+        self.arenas: List[Tuple[int, mmap.mmap, memoryview]] = []  # (最初のフレームの番号, アリーナ, その memoryview)
+        self.page_nos = array('Q')      # フレームに載っているページ番号
+        self.dirty = bytearray()        # 1なら変更済み
+        self.pin_counts = array('l')    # ピン数
+        self.usage_counts = array('B')  # 使用頻度(ClockSweep 用)
+        self.strategies: List[Optional[BufferAccessStrategy]] = []  # フレームを使い回せるリング
+        self.manager = None  # このバッファプールを使っているマネージャ(with 文でピンを外すときに使う)
+        # INVALID_PAGE_IDを持つフレームを pool_size 個用意
+        self.buffers: List[Frame] = []
+        self._add_frames(pool_size)
+        self.policy = policy if policy is not None else ClockSweep()
+        self.policy.attach(self.buffers)
+
+    @classmethod
+    def for_memory_budget(cls, memory_budget: int, policy: Optional[ReplacementPolicy] = None) -> 'BufferPool':
+        """ページデータが memory_budget バイトに収まる大きさのバッファプールを作る"""
+        return cls(frames_for_memory_budget(memory_budget), policy)
+
+    def _add_frames(self, count: int) -> None:
+        """空のフレームを count 個、後ろに追加する"""
+        if count <= 0:
+            return
+        start = len(self.buffers)
+        # mmap はページ境界に揃った領域を返すので、O_DIRECT の読み書きにもそのまま使える
+        arena = mmap.mmap(-1, count * PAGE_SIZE)
+        view = memoryview(arena)
+        self.arenas.append((start, arena, view))
+        self.page_nos.extend([PageId.INVALID_PAGE_ID] * count)
+        self.dirty.extend(bytes(count))
+        self.pin_counts.extend([0] * count)
+        self.usage_counts.extend(bytes(count))
+        self.strategies.extend([None] * count)
+        # ポリシーはこのリストを持っているので、作り直さずに後ろに追加する
+        self.buffers.extend(Frame(self, start + i, view[i * PAGE_SIZE:(i + 1) * PAGE_SIZE]) for i in range(count))
 
     def size(self) -> int:
         """バッファプールのフレーム数を返す。"""
         return len(self.buffers)
 
-    def evict(self) -> Optional[BufferId]: # Clock-sweep(PostgresSQLにも採用されているアルゴリズム)を利用して、捨てるBuffer IDを返す
+    def free_frames(self) -> int:
+        """ページが載っておらず、ピン留めもされていないフレームの数を返す。"""
+        return sum(1 for buffer_id in self.policy.free if self.buffers[buffer_id].pin_count == 0)
+
+    def free_frame(self) -> Optional[BufferId]:
+        """ページが載っておらず、ピン留めもされていないフレームがあればその BufferId を返す。"""
+        for buffer_id in self.policy.free:
+            if self.buffers[buffer_id].pin_count == 0:
+                return BufferId(buffer_id)
+        return None
+
+    def memory_usage(self) -> int:
+        """フレームのページデータに使っているメモリのバイト数を返す。"""
+        return len(self.buffers) * PAGE_SIZE
+
+    def grow(self, pool_size: int) -> None:
+        """フレーム数を pool_size まで増やす。増えたフレームは空きとして置換アルゴリズムに渡す"""
+        if pool_size <= len(self.buffers):
+            return
+        self._add_frames(pool_size - len(self.buffers))
+        self.policy.resize(pool_size)
+
+    def truncate(self, pool_size: int) -> None:
         """
-        バッファプール内のすべてのフレームを調べ、捨てるバッファを見つける。
-        置換対象 (victim) のフレームを探す。
-        usage_count == 0 のフレームがあればそれを返し、
-        なければ is_dirty のフレームの usage_count を減らしながら再試行する。
-        全フレーム連続で見つからなければ None を返す（置換不可を意味する）。
+        pool_size 番目以降のフレームを取り除き、そのメモリを解放する。
+        取り除くフレームは空いている(ページが載っていない)必要がある。空けるのは BufferPoolManager.resize() の役目。
         """
-        pool_size = self.size()
-        consecutive_pinned = 0  # usage_count > 0 のフレームが連続何個出たか
-
-        while True: # バッファプール内のすべてのフレームを調べ、捨てるバッファを見つけるための巡回
-            frame = self.buffers[self.next_victim_id.buffer_id]
-
-            # usage_count == 0 の場合はこのフレームを返して置換に使う
-            if frame.usage_count == 0:
-                return self.next_victim_id
-
-            # usage_countが非0 かつ is_dirty の場合、ディスクへの書き戻しが必要なため
-            # usage_countを少し減らして再度チャンスを与える (簡易的なアルゴリズム)
-            if frame.buffer.is_dirty:
-                frame.usage_count -= 1
-                consecutive_pinned = 0
-            else:
-                # is_dirty でないのに usage_count > 0 のフレームがある
-                consecutive_pinned += 1
-                # もしプール全体を一周しても空きが無い場合は None を返す
-                if consecutive_pinned >= pool_size:
-                    return None
-
-            # 次のフレームIDへローテーション
-            self.next_victim_id = BufferId((self.next_victim_id.buffer_id + 1) % pool_size)
+        if pool_size >= len(self.buffers):
+            return
+        for frame in self.buffers[pool_size:]:
+            if frame.buffer.page_id.page_id != PageId.INVALID_PAGE_ID:
+                raise BufferError(f"frame {frame.index} still holds {frame.buffer.page_id}")
+        # このモジュールの BufferError は組み込みの BufferError と同じ名前なので、
+        # memoryview / mmap が送出する組み込みの方は builtins.BufferError で捕まえる
+        for frame in self.buffers[pool_size:]:
+            # 取り除いた後に古い Buffer を使うと、解放済みのメモリに触る代わりに ValueError になる
+            try:
+                frame.buffer.page.release()
+            except builtins.BufferError:
+                pass
+        kept = []
+        for start, arena, view in self.arenas:
+            if start >= pool_size:
+                try:
+                    view.release()
+                    arena.close()
+                    continue
+                except builtins.BufferError:
+                    # ページの一部を指す memoryview がまだどこかに残っていると閉じられないので、中身だけ手放す
+                    # (アリーナは残っている memoryview が使い終わるまでGCに任せる)
+                    arena.madvise(mmap.MADV_DONTNEED)
+                    continue
+            if start + len(arena) // PAGE_SIZE > pool_size:
+                # 後ろの一部だけ取り除いたアリーナは、取り除いた部分のメモリをOSに返す
+                arena.madvise(mmap.MADV_DONTNEED, (pool_size - start) * PAGE_SIZE)
+            kept.append((start, arena, view))
+
+        # アリーナを手放せたので、フレームとその情報を取り除く
+        self.arenas = kept
+        del self.buffers[pool_size:]
+        del self.page_nos[pool_size:]
+        del self.dirty[pool_size:]
+        del self.pin_counts[pool_size:]
+        del self.usage_counts[pool_size:]
+        del self.strategies[pool_size:]
+        self.policy.resize(pool_size)
+
+    def evict(self, page_id: Optional[PageId] = None) -> Optional[BufferId]:
+        """
+        置換アルゴリズムに置換対象 (victim) のフレームを選んでもらう。
+        page_id はこれから載せるページ(分かっていれば)。
+        ピン留めされていないフレームが無ければ None を返す。
+        """
+        buffer_id = self.policy.victim(page_id)
+        return BufferId(buffer_id) if buffer_id is not None else None
 
 
 # ディスクとバッファプールを連携させるマネージャクラス
@@ -127,97 +331,540 @@ class BufferPoolManager:
     バッファプールを介して管理を行うクラス。
     page_table は、PageId -> BufferId のマッピングテーブルで、
     どのディスクページがバッファプールのどのフレームに入っているかを管理する。
+    バックグラウンドライター(bgwriter.py)と同時に使えるよう、ページテーブルとフレームは lock で、
+    ディスクへの書き込みは io_lock で排他する(lock を持ったまま io_lock を取る順序に揃える)。
     """
     def __init__(self, disk: DiskManager, pool: BufferPool):
         self.disk = disk               # ディスクマネージャ
         self.pool = pool               # バッファプール
+        pool.manager = self
         self.page_table: Dict[PageId, BufferId] = {}  # ページIDとバッファIDのマッピング
-
-    def fetch_page(self, page_id: PageId) -> Buffer:
+        self.io_stats: Optional[IOStats] = None  # enable_stats() を呼ぶまでは計測しない
+        self.lock = threading.RLock()  # ページテーブルとフレームの排他
+        # ディスクへの書き込み(とヘッダを書き換えるページの割り当て・解放・同期)の排他。
+        # 書き込みの順序をデータを写し取った順序に揃え、古い内容が新しい内容を上書きしないようにする
+        self.io_lock = threading.Lock()
+        self.bgwriter = None           # start_background_writer() で起動したバックグラウンドライター
+        self.prewarmer = None          # start_prewarm() で起動したプリウォームのスレッド
+        self.checkpointer = None       # start_checkpointer() で起動したチェックポイントのスレッド
+        # 先読み(enable_read_ahead() を呼ぶまでは行わない)
+        self.read_ahead_window = 0     # 先に読み込むページ数(0なら先読みしない)
+        self.read_ahead_executor: Optional[ThreadPoolExecutor] = None
+        self.prefetching: Dict[PageId, Future] = {}  # 先読み中のページ -> 読み込みの完了を待つ Future
+        self.prefetched: Set[PageId] = set()         # 先読みしてまだ使われていないページ
+        self.last_page_no = -1         # 直前に fetch_page したページ番号
+        self.stride = 0                # 直前のアクセス間隔
+        self.stride_run = 0            # 同じ間隔のアクセスが続いた回数
+        self.prefetch_pages = 0        # 先読みを要求したページ数
+        self.prefetch_hits = 0         # 先読みしたページが使われた回数
+        self.prefetch_waste = 0        # 先読みしたが使われずに捨てたページ数
+        # resize() でバッファプールを縮小している間、ピンが外れたことを知らせる
+        self.unpinned = threading.Condition(self.lock)
+        self.shrinking = False
+
+    def enable_stats(self, trace_hook: Optional[TraceHook] = None, include_disk: bool = True) -> IOStats:
+        """
+        計測を有効にする。バッファのヒット・ミス(とミスの処理時間)・置換・dirtyページの書き戻しを数える。
+        include_disk が True ならディスクマネージャの計測も同じトレースフックで有効にする。
         """
-        指定した page_id のページデータをメモリ上に確保し、Buffer を返す。
+        if self.io_stats is None:
+            self.io_stats = IOStats(trace_hook)
+        if include_disk:
+            self.disk.enable_stats(trace_hook)
+        return self.io_stats
+
+    def stats(self) -> Optional[dict]:
+        """計測値のスナップショットを返す(計測が無効ならNone)。ヒット率とディスクの計測値も含める"""
+        if self.io_stats is None:
+            return None
+        snapshot = self.io_stats.snapshot()
+        counters = snapshot["counters"]
+        accesses = counters.get("hit", 0) + counters.get("miss", 0)
+        snapshot["hit_ratio"] = counters.get("hit", 0) / accesses if accesses else 0.0
+        snapshot["disk"] = self.disk.stats()
+        return snapshot
+
+    def fetch_page(self, page_id: PageId, strategy: Optional[BufferAccessStrategy] = None) -> Buffer:
+        """
+        指定した page_id のページデータをメモリ上に確保し、ピン留めした Buffer を返す。
         もし既に読み込まれている場合は usage_count を上げて再利用。
         まだなら evict() でフレームを確保し、ディスクから読み込む。
+        strategy (BufferAccessStrategy) を渡すと、ミスしたときはそのリングのフレームを使い回し、ヒットしても使用頻度は上げない。
+        使い終わったら unpin_page() を呼ぶか、with bufmgr.fetch_page(page_id) as buffer: の形で使う。
         """
-        # すでに page_table に存在する場合は再利用
-        if page_id in self.page_table:
-            buffer_id = self.page_table[page_id]
+        if self.read_ahead_window:
+            # 先読み中のページなら、自分で読まずに先読みが終わるのを待つ
+            future = self.prefetching.get(page_id)
+            if future is not None:
+                wait([future])
+        with self.lock:
+            if self.read_ahead_window:
+                self._detect_read_ahead(page_id)
+            # すでに page_table に存在する場合は再利用
+            if page_id in self.page_table:
+                buffer_id = self.page_table[page_id]
+                frame = self.pool.buffers[buffer_id.buffer_id]
+                if strategy is None:
+                    self.pool.policy.on_hit(buffer_id.buffer_id, page_id)  # 使われたことを置換アルゴリズムに知らせる
+                    frame.strategy = None  # リングの外からも使われるページになったので、リングでは使い回さない
+                frame.pin_count += 1
+                if page_id in self.prefetched:
+                    self.prefetched.discard(page_id)
+                    self.prefetch_hits += 1
+                if self.io_stats is not None:
+                    self.io_stats.event("hit", page_id)
+                return frame.buffer
+            # 先読みが間に合わなかったページは自分で読み、先読みした内容は使わない
+            self.prefetching.pop(page_id, None)
+
+            # ページがまだロードされていない場合
+            start = time.perf_counter() if self.io_stats is not None else 0.0
+            buffer_id = self._evict(page_id, strategy)
+            if buffer_id is None:
+                # evict() が None を返したら空きフレームなし
+                raise NoFreeBufferError("No free buffer available in buffer pool")
+
             frame = self.pool.buffers[buffer_id.buffer_id]
-            frame.usage_count += 1  # 使用頻度を上げる
+            evict_page_id = frame.buffer.page_id
+            if self.io_stats is not None and evict_page_id.page_id != PageId.INVALID_PAGE_ID:
+                self.io_stats.event("evict", evict_page_id)
+            if evict_page_id in self.prefetched:
+                self.prefetched.discard(evict_page_id)
+                self.prefetch_waste += 1
+
+            # 現在のフレームに古いデータがあり、かつ is_dirty ならディスクへ書き戻す
+            if frame.buffer.is_dirty:
+                self.write_back(frame)
+
+            # 新しいページIDを割り当てて、ディスクから読み込む
+            frame.buffer.page_id = page_id
+            frame.buffer.is_dirty = False
+            self._read_page(page_id, frame.buffer.page)
+            self.pool.policy.on_load(buffer_id.buffer_id, page_id)
+            frame.pin_count = 1
+            frame.strategy = strategy
+
+            # page_table のエントリを更新
+            self.page_table.pop(evict_page_id, None)  # 古いページIDを削除
+            self.page_table[page_id] = buffer_id
+
+            if self.io_stats is not None:
+                self.io_stats.count("miss")
+                self.io_stats.record("miss", page_id, time.perf_counter() - start)
             return frame.buffer
 
-        # ページがまだロードされていない場合
-        buffer_id = self.pool.evict()
-        if buffer_id is None:
-            # evict() が None を返したら空きフレームなし
-            raise NoFreeBufferError("No free buffer available in buffer pool")
+    def create_page(self, strategy: Optional[BufferAccessStrategy] = None) -> Buffer:
+        """
+        新たにページをディスクに確保して、それをバッファプールに載せる。
+        返り値は作成したページの(ピン留めされた) Buffer オブジェクト。
+        strategy を渡すと、そのリングのフレームを使い回す(一括ロード用)。
+        """
+        with self.lock:
+            # 空きフレームを確保
+            buffer_id = self._evict(None, strategy)
+            if buffer_id is None:
+                raise NoFreeBufferError("No free buffer available in buffer pool")
 
-        frame = self.pool.buffers[buffer_id.buffer_id]
-        evict_page_id = frame.buffer.page_id
+            frame = self.pool.buffers[buffer_id.buffer_id]
+            evict_page_id = frame.buffer.page_id
+            if self.io_stats is not None and evict_page_id.page_id != PageId.INVALID_PAGE_ID:
+                self.io_stats.event("evict", evict_page_id)
+            if evict_page_id in self.prefetched:
+                self.prefetched.discard(evict_page_id)
+                self.prefetch_waste += 1
+
+            # 古いフレームが is_dirty なら書き戻し
+            if frame.buffer.is_dirty:
+                self.write_back(frame)
 
-        # 現在のフレームに古いデータがあり、かつ is_dirty ならディスクへ書き戻す
-        if frame.buffer.is_dirty:
-            self.disk.write_page_data(evict_page_id, frame.buffer.page)
+            # ディスク上で新たにページIDを割り当て
+            with self.io_lock:
+                page_id = self.disk.allocate_page()
+            self.prefetching.pop(page_id, None)
 
-        # 新しいページIDを割り当てて、ディスクから読み込む
-        frame.buffer.page_id = page_id
-        frame.buffer.is_dirty = False
-        self.disk.read_page_data(page_id, frame.buffer.page)
-        frame.usage_count = 1
+            # フレームを新しいページ用に空にする(Buffer は作り直さずに使い続ける)
+            frame.buffer.page_id = page_id
+            frame.buffer.page[:] = bytes(PAGE_SIZE)
+            frame.buffer.is_dirty = True   # まだ中身を初期化していないので変更あり扱い
+            self.pool.policy.on_load(buffer_id.buffer_id, page_id)
+            frame.pin_count = 1
+            frame.strategy = strategy
 
-        # page_table のエントリを更新
-        self.page_table.pop(evict_page_id, None)  # 古いページIDを削除
-        self.page_table[page_id] = buffer_id
+            # page_table のエントリを更新
+            self.page_table.pop(evict_page_id, None)
+            self.page_table[page_id] = buffer_id
 
-        return frame.buffer
+            return frame.buffer
+
+    def _evict(self, page_id: Optional[PageId], strategy: Optional[BufferAccessStrategy]) -> Optional[BufferId]:
+        """置換対象のフレームを選ぶ。strategy があればまずリングのフレームを使い回す"""
+        if strategy is None:
+            return self.pool.evict(page_id)
+        buffer_id = strategy.next_frame(self.pool)
+        if buffer_id is None:
+            buffer_id = self.pool.evict(page_id)
+            if buffer_id is not None:
+                strategy.add_frame(buffer_id)
+        return buffer_id
 
-    def create_page(self) -> Buffer:
+    def unpin_page(self, page_id: PageId, is_dirty: bool = False) -> None:
         """
-        新たにページをディスクに確保して、それをバッファプールに載せる。
-        返り値は作成したページの Buffer オブジェクト。
+        fetch_page / create_page で付けたピンを1つ外す。ピンが全て外れたフレームは置換の対象になる。
+        is_dirty が True ならページを変更済みとして印を付ける。
         """
-        # 空きフレームを確保
-        buffer_id = self.pool.evict()
-        if buffer_id is None:
-            raise NoFreeBufferError("No free buffer available in buffer pool")
+        with self.lock:
+            buffer_id = self.page_table.get(page_id)
+            if buffer_id is None:
+                raise BufferError(f"{page_id} is not in the buffer pool")
+            frame = self.pool.buffers[buffer_id.buffer_id]
+            if frame.pin_count == 0:
+                raise BufferError(f"{page_id} is not pinned")
+            frame.pin_count -= 1
+            if is_dirty:
+                frame.buffer.is_dirty = True
+            if self.shrinking and frame.pin_count == 0:
+                self.unpinned.notify_all()
+
+    def resize(self, pool_size: int, timeout: Optional[float] = RESIZE_TIMEOUT) -> None:
+        """
+        バッファプールのフレーム数を pool_size に変える。使用中のスレッドを止めずに行う。
+        増やすときは空のフレームを後ろに追加する。
+        減らすときは後ろのフレームから順に、dirty なら書き戻してページを追い出し、空いたものから取り除く。
+        ピン留めされているフレームはピンが外れるのを待つ(待っている間も lock は手放すので、他の処理は進む)。
+        timeout 秒たっても空かなければ、縮小を取りやめて BufferError を送出する(None なら待ち続ける)。
+        """
+        if pool_size < 1:
+            raise BufferError("buffer pool needs at least one frame")
+        with self.lock:
+            if pool_size >= self.pool.size():
+                self.pool.grow(pool_size)
+                return
+            deadline = None if timeout is None else time.monotonic() + timeout
+            retired: List[Frame] = []
+            self.shrinking = True
+            try:
+                while True:
+                    for frame in self.pool.buffers[pool_size:]:
+                        if frame.pin_count == 0:
+                            self._retire_frame(frame)
+                            retired.append(frame)
+                    if len(retired) == self.pool.size() - pool_size:
+                        break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise BufferError(f"timed out shrinking the buffer pool to {pool_size} frames")
+                    self.unpinned.wait(remaining)
+            except BaseException:
+                # 空けたフレームは空きとして使えるように戻す
+                for frame in retired:
+                    frame.pin_count = 0
+                raise
+            finally:
+                self.shrinking = False
+            for frame in retired:
+                frame.pin_count = 0
+            self.pool.truncate(pool_size)
+
+    def set_memory_budget(self, memory_budget: int, timeout: Optional[float] = RESIZE_TIMEOUT) -> None:
+        """ページデータが memory_budget バイトに収まるようにバッファプールの大きさを変える"""
+        self.resize(frames_for_memory_budget(memory_budget), timeout)
+
+    def _retire_frame(self, frame: Frame) -> None:
+        """
+        取り除くフレームを空ける(dirty なら書き戻し、ページテーブルから外す)。
+        取り除くまでの間に置換対象として選ばれないよう、ピンを1つ付けておく。
+        """
+        page_id = frame.buffer.page_id
+        if page_id.page_id != PageId.INVALID_PAGE_ID:
+            if frame.buffer.is_dirty:
+                self.write_back(frame)
+            del self.page_table[page_id]
+            if page_id in self.prefetched:
+                self.prefetched.discard(page_id)
+                self.prefetch_waste += 1
+            if self.io_stats is not None:
+                self.io_stats.event("evict", page_id)
+            frame.buffer.page_id = PageId(PageId.INVALID_PAGE_ID)
+        frame.strategy = None
+        self.pool.policy.on_free(frame.index)
+        frame.pin_count = 1
+
+    def free_page(self, page_id: PageId) -> None:
+        """
+        ページを解放する。バッファプール上にあればフレームを空きに戻し(書き戻しはしない)、
+        ディスク上のフリーリストにつないで次の create_page で再利用できるようにする。
+        ピン留めされているページは解放できない。
+        """
+        with self.lock:
+            buffer_id = self.page_table.get(page_id)
+            if buffer_id is not None:
+                frame = self.pool.buffers[buffer_id.buffer_id]
+                if frame.pin_count > 0:
+                    raise BufferError(f"{page_id} is pinned")
+                del self.page_table[page_id]
+                frame.buffer.page_id = PageId(PageId.INVALID_PAGE_ID)
+                frame.buffer.is_dirty = False
+                frame.strategy = None
+                self.pool.policy.on_free(buffer_id.buffer_id)
+            if page_id in self.prefetched:
+                self.prefetched.discard(page_id)
+                self.prefetch_waste += 1
+            self.prefetching.pop(page_id, None)
+            with self.io_lock:
+                self.disk.free_page(page_id)
+
+    def _read_page(self, page_id: PageId, data: bytearray) -> None:
+        """
+        ページを読み込む。ディスクマネージャが読み込みを書き込みと同時に行えない場合(concurrent_reads が False)は
+        バックグラウンドライターの書き込みが終わるのを待つ。
+        """
+        if self.disk.concurrent_reads:
+            self.disk.read_page_data(page_id, data)
+        else:
+            with self.io_lock:
+                self.disk.read_page_data(page_id, data)
 
+    def enable_read_ahead(self, window: int = READ_AHEAD_WINDOW) -> None:
+        """
+        先読みを有効にする。同じ間隔(連続や一定の飛び)のページ番号で fetch_page が続いたら、
+        その先の window ページを別スレッドでまとめて読み込み、clean なフレームに載せておく。
+        prefetch() で読み込むページを明示的に伝えることもできる。
+        先読みの効果は prefetch_hits (先読みしたページが使われた回数) と
+        prefetch_waste (使われずに捨てたページ数) で確かめる。
+        """
+        self.read_ahead_window = window
+        if self.read_ahead_executor is None:
+            self.read_ahead_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="relly-readahead")
+
+    def disable_read_ahead(self) -> None:
+        """先読みを止め、読み込み中の先読みが終わるのを待つ"""
+        self.read_ahead_window = 0
+        if self.read_ahead_executor is not None:
+            self.read_ahead_executor.shutdown(wait=True)
+            self.read_ahead_executor = None
+
+    def prefetch(self, page_ids: Sequence[PageId]) -> None:
+        """
+        これから使うページを先読みする(先読みが有効なときだけ)。
+        既にバッファプールにあるページや先読み中のページは読まず、一度に読むのは window ページまで。
+        """
+        if not self.read_ahead_window:
+            return
+        with self.lock:
+            pages = []
+            for page_id in page_ids:
+                if page_id in self.page_table or page_id in self.prefetching or page_id in pages:
+                    continue
+                pages.append(page_id)
+                if len(pages) >= self.read_ahead_window:
+                    break
+            if not pages:
+                return
+            future: Future = Future()
+            for page_id in pages:
+                self.prefetching[page_id] = future
+            self.prefetch_pages += len(pages)
+            self.read_ahead_executor.submit(self._prefetch_pages, pages, future)
+
+    def _detect_read_ahead(self, page_id: PageId) -> None:
+        """fetch_page のページ番号の間隔を見て、同じ間隔が続いていればその先を先読みする"""
+        page_no = page_id.to_u64()
+        stride = page_no - self.last_page_no
+        self.last_page_no = page_no
+        if stride == self.stride:
+            self.stride_run += 1
+        else:
+            self.stride = stride
+            self.stride_run = 1
+        if stride == 0 or abs(stride) > self.read_ahead_window or self.stride_run < READ_AHEAD_TRIGGER:
+            return
+        # ヘッダページと、まだ割り当てていないページは読まない
+        first_page_no = 1 if self.disk.has_header else 0
+        page_ids = []
+        for i in range(1, self.read_ahead_window + 1):
+            next_page_no = page_no + stride * i
+            if not first_page_no <= next_page_no < self.disk.next_page_id:
+                break
+            page_ids.append(PageId(next_page_no))
+        self.prefetch(page_ids)
+
+    def _prefetch_pages(self, page_ids: List[PageId], future: Future) -> None:
+        """(先読みスレッド) ページを読み込み、その間に他で読まれなかったページを clean なフレームに載せる"""
+        try:
+            pages = [(page_id, bytearray(PAGE_SIZE)) for page_id in sorted(page_ids, key=PageId.to_u64)]
+            if self.disk.concurrent_reads:
+                self.disk.read_pages(pages)
+            else:
+                with self.io_lock:
+                    self.disk.read_pages(pages)
+            with self.lock:
+                for page_id, data in pages:
+                    if self.prefetching.get(page_id) is not future or page_id in self.page_table:
+                        self.prefetch_waste += 1
+                        continue
+                    if not self._install_prefetched(page_id, data):
+                        self.prefetch_waste += 1
+        finally:
+            with self.lock:
+                for page_id in page_ids:
+                    if self.prefetching.get(page_id) is future:
+                        del self.prefetching[page_id]
+            future.set_result(None)
+
+    def _install_prefetched(self, page_id: PageId, data: bytearray) -> bool:
+        """先読みしたページを置換対象のフレームに載せる。置換対象が dirty なら書き戻しはせずに諦める"""
+        buffer_id = self.pool.evict(page_id)
+        if buffer_id is None:
+            return False
         frame = self.pool.buffers[buffer_id.buffer_id]
-        evict_page_id = frame.buffer.page_id
-
-        # 古いフレームが is_dirty なら書き戻し
         if frame.buffer.is_dirty:
-            self.disk.write_page_data(evict_page_id, frame.buffer.page)
-
-        # ディスク上で新たにページIDを割り当て
-        page_id = self.disk.allocate_page()
-
-        # フレームに新しいBufferをはめこむ
-        frame.buffer = Buffer(page_id)
-        frame.buffer.is_dirty = True   # まだ中身を初期化していないので変更あり扱い
-        frame.usage_count = 1
-
-        # page_table のエントリを更新
+            return False
+        evict_page_id = frame.buffer.page_id
+        if evict_page_id in self.prefetched:
+            self.prefetched.discard(evict_page_id)
+            self.prefetch_waste += 1
         self.page_table.pop(evict_page_id, None)
+        frame.buffer.page_id = page_id
+        frame.buffer.page[:] = data
+        frame.strategy = None
+        self.pool.policy.on_load(buffer_id.buffer_id, page_id)
         self.page_table[page_id] = buffer_id
+        self.prefetched.add(page_id)
+        return True
 
-        return frame.buffer
+    def install_prewarmed(self, page_id: PageId, data: bytearray) -> bool:
+        """
+        (lock を持って呼ぶ) プリウォームで読んだページを空いているフレームに載せる。
+        空いているフレームが無ければ、載っているページを追い出さずに False を返す。
+        """
+        buffer_id = self.pool.free_frame()
+        if buffer_id is None:
+            return False
+        frame = self.pool.buffers[buffer_id.buffer_id]
+        frame.buffer.page_id = page_id
+        frame.buffer.page[:] = data
+        frame.buffer.is_dirty = False
+        frame.strategy = None
+        self.pool.policy.on_load(buffer_id.buffer_id, page_id)
+        self.page_table[page_id] = buffer_id
+        return True
 
-    def flush(self) -> None:
+    def start_prewarm(self, path: str, background: bool = False, save_interval: Optional[float] = None):
+        """
+        プリウォームを始める(prewarm.py)。path のサイドカーファイルに保存されたページを読み込み、
+        background が False なら読み込み終わるまで待ち、True なら別スレッドで読み込む。
+        save_interval を指定するとその間隔(秒)で、stop_prewarm() のときにも、載っているページIDを path に保存する。
+        """
+        from prewarm import Prewarmer
+        if self.prewarmer is None:
+            self.prewarmer = Prewarmer(self, path, background, save_interval)
+            if not background:
+                self.prewarmer.load()
+            self.prewarmer.start()
+        return self.prewarmer
+
+    def stop_prewarm(self) -> None:
+        """プリウォームのスレッドを止め、載っているページIDをサイドカーファイルに保存する"""
+        if self.prewarmer is not None:
+            self.prewarmer.stop()
+            self.prewarmer = None
+
+    def start_checkpointer(self, log_path: Optional[str] = None, interval: Optional[float] = None,
+                           completion_target: Optional[float] = None, verbose: bool = False):
+        """
+        インクリメンタルチェックポイント(checkpoint.py)のスレッドを起動する。
+        interval 秒ごとに、開始時点の dirty ページを completion_target * interval 秒かけて少しずつ書き戻す。
+        log_path を指定すると、チェックポイントの開始・終了レコードをそのファイルに追記する。
+        """
+        from checkpoint import CHECKPOINT_COMPLETION_TARGET, CHECKPOINT_INTERVAL, Checkpointer
+        if self.checkpointer is None:
+            self.checkpointer = Checkpointer(
+                self, log_path,
+                interval=CHECKPOINT_INTERVAL if interval is None else interval,
+                completion_target=CHECKPOINT_COMPLETION_TARGET if completion_target is None else completion_target,
+                verbose=verbose)
+            self.checkpointer.start()
+        return self.checkpointer
+
+    def stop_checkpointer(self) -> None:
+        """チェックポイントのスレッドを止める(途中のチェックポイントは打ち切る)"""
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+            self.checkpointer = None
+
+    def start_background_writer(self, max_pages: int = BGWRITER_MAX_PAGES, interval: float = BGWRITER_INTERVAL):
+        """
+        バックグラウンドライターを起動する。置換対象になりそうなフレームの dirty ページを先回りして書き戻すので、
+        fetch_page / create_page の置換で書き戻しを待つことがほとんど無くなる。
+        """
+        from bgwriter import BackgroundWriter
+        if self.bgwriter is None:
+            self.bgwriter = BackgroundWriter(self, max_pages, interval)
+            self.bgwriter.start()
+        return self.bgwriter
+
+    def stop_background_writer(self) -> None:
+        """バックグラウンドライターを止める"""
+        if self.bgwriter is not None:
+            self.bgwriter.stop()
+            self.bgwriter = None
+
+    def write_back(self, frame: Frame) -> None:
+        """
+        置換対象のダーティなフレームをディスクに書き戻す。
+        そのページの前後に連続するページIDのダーティページもバッファプール上にあれば、
+        まとめて1回の書き込みで書き戻して is_dirty を下ろす (最大 WRITE_BACK_CLUSTER_SIZE ページ)。
+        """
+        victim_page_no = frame.buffer.page_id.to_u64()
+        cluster = [frame]
+        for step in (-1, 1):
+            page_no = victim_page_no + step
+            while len(cluster) < WRITE_BACK_CLUSTER_SIZE and 0 <= page_no < PageId.INVALID_PAGE_ID:
+                buffer_id = self.page_table.get(PageId(page_no))
+                if buffer_id is None:
+                    break
+                neighbor = self.pool.buffers[buffer_id.buffer_id]
+                # 使用中のページは変更の途中かもしれないので一緒には書き戻さない
+                if not neighbor.buffer.is_dirty or neighbor.pin_count > 0:
+                    break
+                cluster.append(neighbor)
+                page_no += step
+        with self.io_lock:
+            self.disk.write_pages([(f.buffer.page_id, f.buffer.page) for f in cluster])
+        for f in cluster:
+            f.buffer.is_dirty = False
+        if self.io_stats is not None:
+            self.io_stats.count("dirty_write_back", len(cluster))
+
+    def flush(self, verbose: bool = True) -> None:
         """
         バッファプール上の全ての dirty ページをディスクに書き込む。
         最後に disk.sync() を呼んで、物理ディスクへの同期を保証する。
+        verbose が False ならページごとのログを出さない。
+        書き込みの間は他の処理が止まるので、動いている最中は start_checkpointer() の方が良い。
         """
-        print("Flushing buffers to disk...")
-        for page_id, buffer_id in self.page_table.items():
-            frame = self.pool.buffers[buffer_id.buffer_id]
-            # 変更フラグが立っている場合はディスクへ書き戻し
-            if frame.buffer.is_dirty:
-                print(f"Flushing page {page_id.page_id} to disk")
-                self.disk.write_page_data(page_id, frame.buffer.page)
-                frame.buffer.is_dirty = False
-
-        # 書き込みの完了をOSに確定させる
-        self.disk.sync()
+        with self.lock:
+            if verbose:
+                print("Flushing buffers to disk...")
+            # 変更フラグが立っているページを集め、ページID順にまとめて書き戻す
+            dirty_frames = []
+            for page_id, buffer_id in self.page_table.items():
+                frame = self.pool.buffers[buffer_id.buffer_id]
+                if frame.buffer.is_dirty:
+                    dirty_frames.append(frame)
+            dirty_frames.sort(key=lambda f: f.buffer.page_id.to_u64())
+            if verbose:
+                for frame in dirty_frames:
+                    print(f"Flushing page {frame.buffer.page_id.page_id} to disk")
+            with self.io_lock:
+                self.disk.write_pages([(frame.buffer.page_id, frame.buffer.page) for frame in dirty_frames])
+                for frame in dirty_frames:
+                    frame.buffer.is_dirty = False
+                if self.io_stats is not None:
+                    self.io_stats.count("flush_pages", len(dirty_frames))
+
+                # 書き込みの完了をOSに確定させる
+                self.disk.sync()
 
 
 #------------------------------------------------------------------------------
@@ -255,11 +902,11 @@ if __name__ == "__main__":
         bufmgr.flush()
 
         # 再度ページを読み込みして内容確認
-        buffer1_read = bufmgr.fetch_page(page1_id)
-        assert buffer1_read.page[:5] == b"hello"
+        with bufmgr.fetch_page(page1_id) as buffer1_read:
+            assert buffer1_read.page[:5] == b"hello"
 
-        buffer2_read = bufmgr.fetch_page(page2_id)
-        assert buffer2_read.page[:5] == b"world"
+        with bufmgr.fetch_page(page2_id) as buffer2_read:
+            assert buffer2_read.page[:5] == b"world"
 
         print("BufferPoolManager tests passed.")
     finally:
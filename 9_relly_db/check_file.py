@@ -1,11 +1,16 @@
 import struct
-from btree import Pair
+from btree import FORMAT_PICKLE, META_MAGIC, NodeType, Pair, leaf_node_class
 
 def read_page(file, page_id, page_size):
     file.seek(page_id * page_size)
     return file.read(page_size)
 
-def decode_pairs(page):
+def decode_pairs(page, format_version=FORMAT_PICKLE):
+    if format_version != FORMAT_PICKLE:
+        # スロット化ページのフォーマット(メタデータページに META_MAGIC があるファイル)
+        if struct.unpack('>I', page[:4])[0] != NodeType.LEAF:
+            raise ValueError("not a leaf page")
+        return leaf_node_class(format_version)(memoryview(page)).pairs()
     pairs = []
     offset = 8  # ページの先頭にはメタデータがあるため、データはオフセット8から始まる
     num_pairs = struct.unpack('>I', page[4:8])[0]
@@ -23,12 +28,18 @@ def main():
 
     try:
         with open(file_path, "rb") as file:
-            for page_id in range(4):  # 最初の10ページを確認
-                page = read_page(file, page_id, page_size)
+            pages = [read_page(file, page_id, page_size) for page_id in range(4)]  # 最初の4ページを確認
+            # メタデータページからフォーマットのバージョンを読み取る
+            format_version = FORMAT_PICKLE
+            for page in pages:
+                if page[8:12] == META_MAGIC:
+                    format_version = struct.unpack('>I', page[12:16])[0]
+                    break
+            for page_id, page in enumerate(pages):
                 print(f"Page {page_id}:")
                 try:
                     if page.strip(b'\x00'):  # ページが空でない場合のみデコード
-                        pairs = decode_pairs(page)
+                        pairs = decode_pairs(page, format_version)
                         for pair in pairs:
                             key = struct.unpack('>Q', pair.key)[0]
                             value = pair.value.decode('utf-8', errors='replace')
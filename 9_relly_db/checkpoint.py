@@ -0,0 +1,223 @@
+import os
+import struct
+import threading
+import time
+from typing import List, NamedTuple, Optional, Tuple
+from disk import PageId
+
+"""
+インクリメンタル(ファジー)チェックポイント
+なぜ: BufferPoolManager.flush() は lock を持ったまま全ての dirty ページを一度に書くので、
+その間は他の処理が全て止まり、書き込みのI/Oが一度に集中する
+どうやって: チェックポイントを始めた時点で dirty なページの集合を決め(開始レコード)、
+それをページID順に batch_pages ページずつ、lock を手放しながら書き戻す
+書き込みは目標時間(duration)全体に均等に散らし、書いたページの割合が経過時間の割合を超えないように待つ
+全てのページを書いて同期したら終了レコードを書く。終了レコードがあるチェックポイントまでの変更はディスクにある
+チェックポイント中に変更されたページは、書いている間に内容が変わっていれば dirty のまま残す(次のチェックポイントで書く)
+ピン留めされたページは使い終わるまで待つが、目標時間を pin_wait 秒過ぎても使用中なら諦め、
+終了レコードの代わりに未完了レコードを書く(そのチェックポイントは完了したものとして扱わない)
+(BufferPoolManager の lock / io_lock を使うので、AsyncBufferPoolManager と一緒には使わない)
+"""
+
+# チェックポイントで1回に書き戻すページ数
+CHECKPOINT_BATCH_PAGES = 32
+# チェックポイントの間隔(秒)と、そのうち書き込みに使う割合(PostgreSQL の checkpoint_completion_target)
+CHECKPOINT_INTERVAL = 60.0
+CHECKPOINT_COMPLETION_TARGET = 0.9
+# 目標時間を過ぎてから、ピン留めされたページが使い終わるのを待つ最大の秒数
+CHECKPOINT_PIN_WAIT = 1.0
+
+# チェックポイントログのレコード: 種類(開始/終了), チェックポイント番号, 時刻, ページ数
+CHECKPOINT_RECORD = struct.Struct('>4sQdI')
+CHECKPOINT_BEGIN = b"CKPB"
+CHECKPOINT_END = b"CKPE"
+CHECKPOINT_INCOMPLETE = b"CKPI"
+
+
+class CheckpointRecord(NamedTuple):
+    kind: bytes
+    checkpoint_no: int
+    timestamp: float
+    pages: int  # 開始レコードなら書き戻す予定のページ数、終了レコードなら書き戻したページ数、未完了レコードなら書けなかったページ数
+
+
+def checkpoint_log_path(heap_file_path: str) -> str:
+    """ヒープファイルに対応するチェックポイントログのパス"""
+    return heap_file_path + ".checkpoint"
+
+
+def read_checkpoint_log(path: str) -> List[CheckpointRecord]:
+    """チェックポイントログのレコードを全て読み込む(途中で切れたレコードは無視する)"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    size = CHECKPOINT_RECORD.size
+    return [CheckpointRecord(*CHECKPOINT_RECORD.unpack_from(data, offset))
+            for offset in range(0, len(data) - size + 1, size)]
+
+
+def last_completed_checkpoint(path: str) -> Optional[CheckpointRecord]:
+    """終了レコードがある最後のチェックポイントの終了レコードを返す(無ければ None)"""
+    for record in reversed(read_checkpoint_log(path)):
+        if record.kind == CHECKPOINT_END:
+            return record
+    return None
+
+
+def _append_record(path: str, kind: bytes, checkpoint_no: int, pages: int) -> None:
+    with open(path, "ab") as f:
+        f.write(CHECKPOINT_RECORD.pack(kind, checkpoint_no, time.time(), pages))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class Checkpointer(threading.Thread):
+    """
+    BufferPoolManager のチェックポイントを定期的に行うスレッド。
+    interval 秒ごとに、completion_target * interval 秒かけてチェックポイントを行う。
+    run_checkpoint() を直接呼べば、そのスレッドでチェックポイントを1回行う。
+    """
+    def __init__(self, bufmgr, log_path: Optional[str] = None, interval: float = CHECKPOINT_INTERVAL,
+                 completion_target: float = CHECKPOINT_COMPLETION_TARGET,
+                 batch_pages: int = CHECKPOINT_BATCH_PAGES, pin_wait: float = CHECKPOINT_PIN_WAIT,
+                 verbose: bool = False):
+        super().__init__(name="relly-checkpointer", daemon=True)
+        self.bufmgr = bufmgr
+        self.log_path = log_path
+        self.interval = interval
+        self.completion_target = completion_target
+        self.batch_pages = batch_pages
+        self.pin_wait = pin_wait
+        self.verbose = verbose
+        self.stop_event = threading.Event()
+        self.checkpoint_no = 0
+        self.skipped_pages: List[PageId] = []  # 直前のチェックポイントで、使用中のまま書けなかったページ
+        if log_path is not None:
+            records = read_checkpoint_log(log_path)
+            if records:
+                self.checkpoint_no = records[-1].checkpoint_no
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.interval * (1 - self.completion_target)):
+            self.run_checkpoint(self.interval * self.completion_target)
+
+    def stop(self) -> None:
+        """スレッドを止めて終了を待つ(途中のチェックポイントは終了レコードを書かずに打ち切る)"""
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def _log(self, message: str) -> None:
+        if self.verbose:
+            print(message)
+
+    def run_checkpoint(self, duration: float = 0.0) -> Optional[int]:
+        """
+        チェックポイントを1回行い、書き戻したページ数を返す。
+        duration 秒かけて書き込みを散らす(0 なら待たずに書く)。stop() で打ち切られたら None を返す。
+        ピン留めされたページが duration + pin_wait 秒たっても使用中なら、書けたページだけを同期して
+        未完了レコードを書き、None を返す(書けなかったページは skipped_pages に残る)。
+        """
+        bufmgr = self.bufmgr
+        with bufmgr.lock:
+            # 開始時点で dirty なページが、このチェックポイントで書き戻すページ
+            pending = sorted((frame.buffer.page_id for frame in bufmgr.pool.buffers
+                              if frame.buffer.is_dirty and frame.buffer.page_id in bufmgr.page_table),
+                             key=PageId.to_u64)
+        self.checkpoint_no += 1
+        total = len(pending)
+        if self.log_path is not None:
+            _append_record(self.log_path, CHECKPOINT_BEGIN, self.checkpoint_no, total)
+        self._log(f"Checkpoint {self.checkpoint_no} started: {total} dirty pages")
+
+        start = time.monotonic()
+        done = 0
+        written = 0
+        self.skipped_pages = []
+        while pending:
+            if self.stop_event.is_set():
+                self._log(f"Checkpoint {self.checkpoint_no} aborted")
+                return None
+            batch, pending = pending[:self.batch_pages], pending[self.batch_pages:]
+            copied, deferred = self._write_batch(batch)
+            written += copied
+            # ピン留めされていて今は書けないページは後回しにする
+            pending.extend(deferred)
+            done += len(batch) - len(deferred)
+            if deferred and len(deferred) == len(pending):
+                if time.monotonic() >= start + duration + self.pin_wait:
+                    # いつまでも使用中のページのためにチェックポイントを終わらせないことはしない
+                    self.skipped_pages = pending
+                    break
+                # 残っているのが使用中のページだけなら、使い終わるのを少し待つ
+                self.stop_event.wait(0.01)
+            # 書いたページの割合が経過時間の割合を超えないように待つ
+            if duration > 0 and total > 0:
+                delay = start + duration * done / total - time.monotonic()
+                if delay > 0:
+                    self.stop_event.wait(delay)
+
+        with bufmgr.io_lock:
+            bufmgr.disk.sync()
+        if bufmgr.io_stats is not None:
+            bufmgr.io_stats.count("checkpoint_pages", written)
+        if self.skipped_pages:
+            if self.log_path is not None:
+                _append_record(self.log_path, CHECKPOINT_INCOMPLETE, self.checkpoint_no, len(self.skipped_pages))
+            if bufmgr.io_stats is not None:
+                bufmgr.io_stats.count("checkpoints_incomplete")
+            self._log(f"Checkpoint {self.checkpoint_no} incomplete: {written} pages written, "
+                      f"{len(self.skipped_pages)} pinned pages skipped")
+            return None
+        if self.log_path is not None:
+            _append_record(self.log_path, CHECKPOINT_END, self.checkpoint_no, written)
+        if bufmgr.io_stats is not None:
+            bufmgr.io_stats.count("checkpoints")
+        self._log(f"Checkpoint {self.checkpoint_no} complete: {written} pages written "
+                  f"in {time.monotonic() - start:.3f}s")
+        return written
+
+    def _write_batch(self, batch: List[PageId]) -> Tuple[int, List[PageId]]:
+        """
+        batch のページのうち、まだ dirty なものを書き戻す。(書き戻したページ数, ピン留めされていて書けなかったページ) を返す。
+        ページの内容は lock を持って写し取り、書いている間に変更されたページは dirty のまま残す。
+        """
+        bufmgr = self.bufmgr
+        pages: List[Tuple[PageId, bytes]] = []
+        deferred: List[PageId] = []
+        with bufmgr.lock:
+            for page_id in batch:
+                buffer_id = bufmgr.page_table.get(page_id)
+                if buffer_id is None:
+                    # 置換で書き戻されたか、解放された
+                    continue
+                frame = bufmgr.pool.buffers[buffer_id.buffer_id]
+                if not frame.buffer.is_dirty:
+                    continue
+                if frame.pin_count > 0:
+                    # 使用中のページは変更の途中かもしれないので書かない
+                    deferred.append(page_id)
+                    continue
+                pages.append((page_id, bytes(frame.buffer.page)))
+            if not pages:
+                return 0, deferred
+            # 写し取った順に書き込まれるよう、lock を持っている間に io_lock を取る
+            bufmgr.io_lock.acquire()
+        try:
+            bufmgr.disk.write_pages(pages)
+        finally:
+            bufmgr.io_lock.release()
+
+        with bufmgr.lock:
+            for page_id, data in pages:
+                buffer_id = bufmgr.page_table.get(page_id)
+                if buffer_id is None:
+                    continue
+                buffer = bufmgr.pool.buffers[buffer_id.buffer_id].buffer
+                if buffer.is_dirty and buffer.page == data:
+                    buffer.is_dirty = False
+        for page_id, _ in pages:
+            self._log(f"Checkpoint {self.checkpoint_no}: wrote page {page_id.page_id}")
+        return len(pages), deferred
@@ -0,0 +1,306 @@
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence, Tuple
+from buffer import Buffer, BufferError, BufferId, BufferPool, NoFreeBufferError
+from disk import DiskManager, PageId
+from replacement import ClockSweep
+
+"""
+複数のスレッドから共有できるバッファプールマネージャ
+なぜ: BufferPoolManager はマネージャ全体を1つのロックで守るので、ワーカースレッドで共有すると
+バッファヒットもミスの読み込みも1つずつしか進まない
+どうやって: ページテーブルを NUM_PAGE_TABLE_SHARDS 個のシャードに分け、シャードごとにロックを持つ
+置換対象の選択だけはプール全体のロックで行い、ディスクの読み書きはどのロックも持たずに行う
+同じページへの同時のミスは、シャードの loading に登録した Future を待つことで1回の読み込みにまとめる(single-flight)
+ページの中身を読み書きするときは、フレームごとの読み書きラッチ(RWLatch)を shared / exclusive で取る
+"""
+
+# ページテーブルのシャード数
+NUM_PAGE_TABLE_SHARDS = 16
+
+
+class RWLatch:
+    """
+    読み書きラッチ。shared は何スレッドでも同時に取れ、exclusive は1スレッドだけが取れる。
+    exclusive を待っているスレッドがいる間は新しい shared を待たせて、書き込みが飢餓状態にならないようにする。
+    """
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    def acquire_shared(self) -> None:
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_shared(self) -> None:
+        with self.cond:
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquire_exclusive(self) -> None:
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+
+    def release_exclusive(self) -> None:
+        with self.cond:
+            self.writer = False
+            self.cond.notify_all()
+
+
+class PageTableShard:
+    """ページテーブルの1シャード。table はバッファプールに載っているページ、loading は読み込み中・書き戻し中のページ"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.table: Dict[PageId, BufferId] = {}
+        self.loading: Dict[PageId, Future] = {}
+
+
+class ConcurrentBufferPoolManager:
+    """
+    複数のスレッドから同時に使えるバッファプールマネージャ。使い方は BufferPoolManager と同じで、
+    fetch_page / create_page はピン留めした Buffer を返し、unpin_page か with 文でピンを外す。
+    ページの中身は shared(buffer) / exclusive(buffer) のラッチを取ってから読み書きする。
+    置換アルゴリズムが ClockSweep なら、バッファヒットはシャードのロックだけで済む
+    (usage_count の更新は競合しても困らない)。それ以外の置換アルゴリズムはヒットのたびにプール全体のロックを取る。
+    """
+    def __init__(self, disk: DiskManager, pool: BufferPool, num_shards: int = NUM_PAGE_TABLE_SHARDS):
+        self.disk = disk
+        self.pool = pool
+        self.shards = [PageTableShard() for _ in range(num_shards)]
+        self.pool_lock = threading.Lock()  # 置換アルゴリズムとフレームの割り当ての排他
+        self.io_lock = threading.Lock()    # ディスクへの書き込み(とページの割り当て・解放・同期)の排他
+        self.lock_free_hits = isinstance(pool.policy, ClockSweep)
+        # このマネージャはフレームの Buffer を取り替えないので、Buffer からラッチを引ける
+        self.latches: Dict[Buffer, RWLatch] = {}
+        pool.manager = self
+        for frame in pool.buffers:
+            self.latches[frame.buffer] = RWLatch()
+
+    def _shard(self, page_id: PageId) -> PageTableShard:
+        # PageId.__hash__ を呼ばずに済むよう、ページ番号で振り分ける
+        return self.shards[page_id.page_id % len(self.shards)]
+
+    @contextmanager
+    def shared(self, buffer: Buffer):
+        """ページを読むためのラッチ(他のスレッドも同時に読める)"""
+        latch = self.latches[buffer]
+        latch.acquire_shared()
+        try:
+            yield buffer
+        finally:
+            latch.release_shared()
+
+    @contextmanager
+    def exclusive(self, buffer: Buffer):
+        """ページを書き換えるためのラッチ(他のスレッドは読むことも書くこともできない)"""
+        latch = self.latches[buffer]
+        latch.acquire_exclusive()
+        try:
+            yield buffer
+        finally:
+            latch.release_exclusive()
+
+    def fetch_page(self, page_id: PageId, strategy=None) -> Buffer:
+        """
+        指定した page_id のページをピン留めして返す。
+        他のスレッドが同じページを読み込み中(または書き戻し中)なら、その完了を待ってからもう一度探す。
+        """
+        if strategy is not None:
+            raise BufferError("ConcurrentBufferPoolManager does not support access strategies")
+        shard = self._shard(page_id)
+        while True:
+            with shard.lock:
+                buffer_id = shard.table.get(page_id)
+                if buffer_id is not None:
+                    frame = self.pool.buffers[buffer_id.buffer_id]
+                    frame.pin_count += 1
+                    if self.lock_free_hits:
+                        self.pool.policy.on_hit(buffer_id.buffer_id, page_id)
+                        return frame.buffer
+                else:
+                    future = shard.loading.get(page_id)
+                    if future is None:
+                        future = shard.loading[page_id] = Future()
+                        break
+            if buffer_id is not None:
+                # ロックの順序(pool_lock -> シャードのロック)を守るため、シャードのロックを外してから知らせる
+                with self.pool_lock:
+                    self.pool.policy.on_hit(buffer_id.buffer_id, page_id)
+                return frame.buffer
+            # 他のスレッドの読み込みが終わるのを待つ(失敗していても、もう一度自分で読み込みを試みる)
+            future.exception()
+
+        try:
+            buffer_id, frame = self._reserve_frame(page_id)
+        except BaseException as e:
+            self._finish_loading(shard, page_id, future, e)
+            raise
+        try:
+            self._read_page(page_id, frame.buffer.page)
+        except BaseException as e:
+            self._release_frame(buffer_id, frame)
+            self._finish_loading(shard, page_id, future, e)
+            raise
+        return self._install(shard, page_id, buffer_id, frame, future)
+
+    def create_page(self, strategy=None) -> Buffer:
+        """新たにページをディスクに確保して、それをバッファプールに(ピン留めして)載せる"""
+        if strategy is not None:
+            raise BufferError("ConcurrentBufferPoolManager does not support access strategies")
+        # 空きフレームを確保してからページIDを割り当てる(フレームが無いときにページを無駄に確保しない)
+        buffer_id, frame = self._reserve_frame(None)
+        try:
+            with self.io_lock:
+                page_id = self.disk.allocate_page()
+        except BaseException:
+            self._release_frame(buffer_id, frame)
+            raise
+        shard = self._shard(page_id)
+        with shard.lock:
+            future = shard.loading[page_id] = Future()
+        frame.buffer.page[:] = bytes(len(frame.buffer.page))
+        frame.buffer.is_dirty = True  # まだ中身を初期化していないので変更あり扱い
+        return self._install(shard, page_id, buffer_id, frame, future)
+
+    def _reserve_frame(self, page_id: Optional[PageId]):
+        """
+        置換対象のフレームを選び、ピン留めして古いページをページテーブルから外す。page_id はこれから載せるページ。
+        古いページが dirty なら書き戻し、書き戻しが終わるまでそのページの読み込みを待たせる。
+        """
+        with self.pool_lock:
+            while True:
+                buffer_id = self.pool.evict(page_id)
+                if buffer_id is None:
+                    raise NoFreeBufferError("No free buffer available in buffer pool")
+                frame = self.pool.buffers[buffer_id.buffer_id]
+                old_page_id = frame.buffer.page_id
+                if old_page_id.page_id == PageId.INVALID_PAGE_ID:
+                    frame.pin_count = 1
+                    return buffer_id, frame
+                old_shard = self._shard(old_page_id)
+                with old_shard.lock:
+                    # 置換対象に選んだ後でピン留めされていたら、別のフレームを探す
+                    if frame.pin_count > 0:
+                        continue
+                    frame.pin_count = 1
+                    del old_shard.table[old_page_id]
+                    write_future = None
+                    if frame.buffer.is_dirty:
+                        write_future = old_shard.loading[old_page_id] = Future()
+                break
+        frame.buffer.page_id = PageId(PageId.INVALID_PAGE_ID)
+        if write_future is not None:
+            try:
+                with self.io_lock:
+                    self.disk.write_pages([(old_page_id, frame.buffer.page)])
+                frame.buffer.is_dirty = False
+            except BaseException as e:
+                # 書き戻せなかったページはページテーブルに戻す
+                frame.buffer.page_id = old_page_id
+                with old_shard.lock:
+                    old_shard.table[old_page_id] = buffer_id
+                    frame.pin_count = 0
+                self._finish_loading(old_shard, old_page_id, write_future, e)
+                raise
+            self._finish_loading(old_shard, old_page_id, write_future)
+        return buffer_id, frame
+
+    def _release_frame(self, buffer_id: BufferId, frame) -> None:
+        """読み込みやページの確保に失敗したフレームを空きに戻す"""
+        with self.pool_lock:
+            frame.pin_count = 0
+            self.pool.policy.on_free(buffer_id.buffer_id)
+
+    def _install(self, shard: PageTableShard, page_id: PageId, buffer_id: BufferId, frame, future: Future) -> Buffer:
+        """読み込んだページをページテーブルに登録し、待っているスレッドを起こす"""
+        frame.buffer.page_id = page_id
+        with self.pool_lock:
+            self.pool.policy.on_load(buffer_id.buffer_id, page_id)
+        with shard.lock:
+            shard.table[page_id] = buffer_id
+        self._finish_loading(shard, page_id, future)
+        return frame.buffer
+
+    def _finish_loading(self, shard: PageTableShard, page_id: PageId, future: Future,
+                        error: Optional[BaseException] = None) -> None:
+        with shard.lock:
+            if shard.loading.get(page_id) is future:
+                del shard.loading[page_id]
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+
+    def _read_page(self, page_id: PageId, data: bytearray) -> None:
+        # read_pages は位置を指定して読むので、concurrent_reads なら複数のスレッドから同時に呼べる
+        if self.disk.concurrent_reads:
+            self.disk.read_pages([(page_id, data)])
+        else:
+            with self.io_lock:
+                self.disk.read_pages([(page_id, data)])
+
+    def unpin_page(self, page_id: PageId, is_dirty: bool = False) -> None:
+        """fetch_page / create_page で付けたピンを1つ外す"""
+        shard = self._shard(page_id)
+        with shard.lock:
+            buffer_id = shard.table.get(page_id)
+            if buffer_id is None:
+                raise BufferError(f"{page_id} is not in the buffer pool")
+            frame = self.pool.buffers[buffer_id.buffer_id]
+            if frame.pin_count == 0:
+                raise BufferError(f"{page_id} is not pinned")
+            if is_dirty:
+                frame.buffer.is_dirty = True
+            frame.pin_count -= 1
+
+    def prefetch(self, page_ids: Sequence[PageId]) -> None:
+        """先読みはしない(BPlusTree から呼ばれても何もしない)"""
+
+    def flush(self) -> None:
+        """
+        バッファプール上の全ての dirty ページをページID順にまとめて書き戻して同期する。
+        書き込むデータは shared ラッチを取って写し取り、書いている間に変更されたページは dirty のまま残す。
+        写し取ってから io_lock を取るまでの間に、他のスレッドがページを変更して置換で書き戻しているかもしれないので、
+        io_lock を持ってから、ページがまだ同じフレームにあって中身が写しと同じものだけを書く。
+        (ラッチを持ったまま io_lock を待つスレッドがいるので、io_lock を持ってからラッチは取らない)
+        """
+        pages: List[Tuple[PageId, BufferId, Buffer]] = []
+        for shard in self.shards:
+            with shard.lock:
+                for page_id, buffer_id in shard.table.items():
+                    buffer = self.pool.buffers[buffer_id.buffer_id].buffer
+                    if buffer.is_dirty:
+                        pages.append((page_id, buffer_id, buffer))
+        copies = []
+        for page_id, buffer_id, buffer in pages:
+            with self.shared(buffer):
+                if buffer.page_id == page_id:
+                    copies.append((page_id, buffer_id, bytes(buffer.page), buffer))
+        copies.sort(key=lambda page: page[0].to_u64())
+        with self.io_lock:
+            # 置換はページテーブルから外してから io_lock を取って書き戻すので、
+            # ここでページテーブルに同じフレームで残っていれば、写しより新しい内容はまだディスクに書かれていない
+            current = [(page_id, data, buffer) for page_id, buffer_id, data, buffer in copies
+                       if self._is_current(page_id, buffer_id, data, buffer)]
+            self.disk.write_pages([(page_id, data) for page_id, data, _ in current])
+            for page_id, data, buffer in current:
+                if buffer.page_id == page_id and buffer.page == data:
+                    buffer.is_dirty = False
+            self.disk.sync()
+
+    def _is_current(self, page_id: PageId, buffer_id: BufferId, data: bytes, buffer: Buffer) -> bool:
+        """写し取ったページが、まだ同じフレームにあって同じ内容か"""
+        shard = self._shard(page_id)
+        with shard.lock:
+            return (shard.table.get(page_id) == buffer_id
+                    and buffer.page_id == page_id and buffer.page == data)
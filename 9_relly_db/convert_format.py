@@ -0,0 +1,142 @@
+import os
+import sys
+from typing import Iterator, Optional
+from buffer import BufferPool, BufferPoolManager
+from disk import DiskManager, HEADER_PAGE_ID, PageId
+from btree import BPlusTree, BTreeError, CURRENT_FORMAT_VERSION, NodeType, Pair
+import struct
+
+"""
+B+ツリーのファイルを今のノードフォーマット(CURRENT_FORMAT_VERSION)に変換するスクリプト
+古いフォーマット(pickle や、リーフのリンクの無いスロット化ページ)のツリーのペアをキー順に読み出し、
+新しいファイルに BPlusTree.bulk_load() でツリーを組み立ててから、
+元のファイルを path.bak に残して置き換える。ファイルには1つのツリーだけがある前提。
+ツリーが壊れていれば(循環する子ページなど)、元のファイルに手を付けずにエラーで終わる。
+使い方: python convert_format.py ファイル [メタデータページのページID]
+"""
+
+# 変換中のバッファプールの大きさ(ページ数)
+CONVERT_POOL_SIZE = 64
+
+
+class CorruptTreeError(BTreeError):
+    """ツリーの構造が壊れていて、ペアをキー順に読み出せない"""
+    pass
+
+
+def iter_pairs(btree: BPlusTree, bufmgr: BufferPoolManager) -> Iterator[Pair]:
+    """
+    ツリーの全てのペアをキー順に返す。
+    古いファイルは壊れていることがあるので、スタックで深さ優先に辿りながら、
+    ノードタイプ・子ページIDの範囲・キーの順序・同じページを2度訪れないことを確かめ、
+    どれかに反すれば CorruptTreeError を送出する。
+    """
+    disk = bufmgr.disk
+    # ヘッダページとメタデータページはノードにならない
+    reserved = {btree.meta_page_id.page_id}
+    if disk.has_header:
+        reserved.add(HEADER_PAGE_ID)
+
+    def check_page_id(page_id: PageId, parent: str) -> None:
+        if page_id.page_id in reserved or not 0 <= page_id.page_id < disk.next_page_id:
+            raise CorruptTreeError(f"{parent} points to page {page_id.page_id}, "
+                                   f"which is not a node page (file has {disk.next_page_id} pages)")
+
+    with bufmgr.fetch_page(btree.meta_page_id) as meta_buffer:
+        root_page_id = btree.read_meta(meta_buffer)
+    check_page_id(root_page_id, f"meta page {btree.meta_page_id.page_id}")
+
+    visited = set()
+    last_key = None
+    # 子ノードは右から積むので、左の子から順に取り出される
+    stack = [root_page_id]
+    while stack:
+        page_id = stack.pop()
+        if page_id.page_id in visited:
+            raise CorruptTreeError(f"page {page_id.page_id} is reachable twice; "
+                                   f"the tree has a cycle or a shared subtree")
+        visited.add(page_id.page_id)
+        # 子ノードを読む間は親のピンを外しておく
+        with bufmgr.fetch_page(page_id) as buffer:
+            node_type = struct.unpack('>I', buffer.page[:4])[0]
+            try:
+                if node_type == NodeType.LEAF:
+                    pairs = btree.get_pairs(buffer)
+                    children = []
+                elif node_type == NodeType.BRANCH:
+                    pairs = []
+                    _, children = btree.get_branch(buffer)
+                else:
+                    raise CorruptTreeError(f"page {page_id.page_id} has unknown node type {node_type}")
+            except CorruptTreeError:
+                raise
+            except Exception as e:
+                raise CorruptTreeError(f"page {page_id.page_id} cannot be decoded: {e}") from e
+        for child in children:
+            check_page_id(child, f"branch page {page_id.page_id}")
+        stack.extend(reversed(children))
+        for pair in pairs:
+            if last_key is not None and bytes(pair.key) <= last_key:
+                raise CorruptTreeError(f"keys are out of order at leaf page {page_id.page_id}")
+            last_key = bytes(pair.key)
+            yield pair
+
+
+def convert_file(path: str, meta_page_id: Optional[PageId] = None) -> Optional[PageId]:
+    """
+    path のツリーを今のフォーマットに変換し、新しいメタデータページのページIDを返す。
+    既に今のフォーマットなら何もせずに None を返す。
+    """
+    source_disk = DiskManager.open(path)
+    if meta_page_id is None:
+        # ツリーの作成で最初に確保されるのがメタデータページ
+        meta_page_id = PageId(1 if source_disk.has_header else 0)
+    source_bufmgr = BufferPoolManager(source_disk, BufferPool(CONVERT_POOL_SIZE))
+    source = BPlusTree(meta_page_id)
+    with source_bufmgr.fetch_page(meta_page_id) as meta_buffer:
+        source.read_meta(meta_buffer)
+    if source.format_version == CURRENT_FORMAT_VERSION:
+        source_disk.close()
+        return None
+
+    temp_path = path + ".converting"
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    try:
+        disk = DiskManager.open(temp_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(CONVERT_POOL_SIZE))
+        # iter_pairs() はキー順に返すので、挿入を繰り返さずに下から組み立てられる
+        btree = BPlusTree.bulk_load(bufmgr, ((pair.key, pair.value) for pair in iter_pairs(source, source_bufmgr)))
+        bufmgr.flush(verbose=False)
+        disk.close()
+    except BaseException:
+        source_disk.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    source_disk.close()
+    os.replace(path, path + ".bak")
+    os.replace(temp_path, path)
+    return btree.meta_page_id
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: python convert_format.py FILE [META_PAGE_ID]")
+        sys.exit(1)
+    path = sys.argv[1]
+    meta_page_id = PageId(int(sys.argv[2])) if len(sys.argv) > 2 else None
+    try:
+        new_meta_page_id = convert_file(path, meta_page_id)
+    except CorruptTreeError as e:
+        print(f"Cannot convert {path}: {e}", file=sys.stderr)
+        sys.exit(1)
+    if new_meta_page_id is None:
+        print(f"{path} is already in format version {CURRENT_FORMAT_VERSION}")
+        return
+    print(f"Converted {path} to format version {CURRENT_FORMAT_VERSION} "
+          f"(meta page {new_meta_page_id.page_id}, original kept as {path}.bak)")
+
+
+if __name__ == "__main__":
+    main()
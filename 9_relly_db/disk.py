@@ -1,6 +1,13 @@
+import mmap
 import os
 import struct
-from typing import Optional
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+from stats import IOStats, TraceHook
 
 """
 DiskManagerとは: ディスク上のページを管理するクラス
@@ -17,6 +24,16 @@ DiskManagerの目的: データをディスクに永続化する
 """
 
 PAGE_SIZE = 4096
+# mmapモードでファイルとマッピングを拡張する単位(1MiB)。allocate_pageのたびにremapしないよう大きめに取る
+MMAP_GROW_SIZE = 1024 * 1024
+# セグメント分割モードの1セグメントファイルの大きさ(PostgreSQLのリレーションセグメントと同じ1GiB)
+SEGMENT_SIZE = 1024 * 1024 * 1024
+# セグメント分割モードで同時に開いておくセグメントファイル数の上限
+MAX_OPEN_SEGMENTS = 16
+# 圧縮モードで圧縮後のページを置くスロットの大きさの単位
+COMPRESSED_SLOT_ALIGN = 128
+# preadv/pwritev 1回で渡せるバッファ数の上限
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') and 'SC_IOV_MAX' in os.sysconf_names else 1024
 
 class PageId:
     # 64ビットの符号なし整数（uint64_t）の最大値。
@@ -59,22 +76,227 @@ class PageId:
     def __repr__(self):
         return f"PageId({self.page_id})"
 
+# ヘッダページ関連の定数
+HEADER_PAGE_ID = 0          # ヒープファイルの先頭ページをヘッダページとして使う
+HEADER_MAGIC = b'RLYH'      # ヘッダページの識別子
+HEADER_VERSION = 2
+FREE_PAGE_MAGIC = b'RLYF'   # 解放済みページの識別子
+
+
+class DiskError(Exception):
+    """ディスクマネージャ関連で起こるエラー"""
+    pass
+
+
+class SyncCoordinator:
+    """
+    複数のスレッドからの同期(fsync)要求を1回のfsyncにまとめる(グループコミット)。
+    要求には受け付け順に番号を振り、fsyncを実行中のスレッド(リーダー)が居なければ要求したスレッドがリーダーになる。
+    リーダーは commit_delay 秒待って他の要求が集まるのを待ってから1回だけfsyncし、
+    それまでに受け付けたすべての要求を完了にする。リーダーが居る間に来た要求は、次のリーダーのfsyncでまとめて完了する。
+    これで、コミットのスループットがディスクのfsync回数の上限を超えられる。
+    """
+    def __init__(self, fsync_func, commit_delay: float = 0.0):
+        self.fsync_func = fsync_func
+        self.commit_delay = commit_delay
+        self.cond = threading.Condition()
+        self.requested = 0        # 受け付けた最後の要求の番号
+        self.completed = 0        # fsyncで完了した最後の要求の番号
+        self.leading = False      # リーダーがfsync中か
+        self.failed = None        # 失敗したfsyncが対象にしていた要求の範囲と例外 (開始, 終了, 例外)
+
+    def request_sync(self) -> None:
+        """この呼び出しより前の書き込みがディスクに同期されるまで待つ"""
+        with self.cond:
+            self.requested += 1
+            ticket = self.requested
+            while True:
+                if self.completed >= ticket:
+                    return
+                if self.failed is not None and self.failed[0] < ticket <= self.failed[1]:
+                    raise self.failed[2]
+                if not self.leading:
+                    self.leading = True
+                    break
+                self.cond.wait()
+
+        # リーダーとして、集まった要求をまとめてfsyncする
+        if self.commit_delay > 0:
+            time.sleep(self.commit_delay)
+        with self.cond:
+            start, target = self.completed, self.requested
+        try:
+            self.fsync_func()
+        except BaseException as e:
+            with self.cond:
+                self.failed = (start, target, e)
+                self.leading = False
+                self.cond.notify_all()
+            raise
+        with self.cond:
+            self.completed = target
+            self.leading = False
+            self.cond.notify_all()
+
+
 class DiskManager:
+    """
+    ヘッダページ(ページ0)のレイアウト:
+      [0:4]   HEADER_MAGIC
+      [4:8]   バージョン
+      [8:16]  フリーリストの先頭ページID (空なら INVALID_PAGE_ID)
+      [16:24] フリーリストのページ数
+      [24:32] 論理的なデータの終端 (次に割り当てるページID。バージョン2から)
+    解放済みページのレイアウト:
+      [0:4]   FREE_PAGE_MAGIC
+      [4:12]  フリーリストの次のページID
+    解放したページはヘッダページを根とするフリーリスト(単方向リスト)につなぎ、
+    allocate_pageはファイルを伸ばす前にフリーリストのページを再利用する。
+    extent_size (1MiB〜64MiB程度を想定) を指定すると、ファイルを伸ばすときに posix_fallocate で extent_size 単位にまとめて領域を予約する。
+    予約した領域はまだ使われていないので、データの終端(next_page_id)はファイルサイズとは別にヘッダページに記録する。
+    ヘッダページの無い古いヒープファイルはそのまま読み書きできるが、ページの解放とエクステント割り当てはできない。
+    """
+    # read_pagesを複数のスレッドから同時に呼んでよいか(ファイルオフセットや共有バッファを使わない読み込みか)
+    concurrent_reads = True
+
     # ヒープファイル(自由に読み書きできるファイル)を指定してDiskManagerを作成
     # 次に使用するページIDを設定
-    def __init__(self, heap_file: str): 
+    def __init__(self, heap_file: str, extent_size: int = 0): 
+        if extent_size < 0 or extent_size % PAGE_SIZE != 0:
+            raise ValueError("extent_size must be a multiple of PAGE_SIZE")
         self.heap_file = heap_file
-        self.file = open(heap_file, 'r+b')
+        self.extent_size = extent_size
+        self.io_stats: Optional[IOStats] = None
+        self.sync_coordinator: Optional[SyncCoordinator] = None
+        self.fsync = os.fsync
+        self.file = self._open_file(heap_file)
         self.file.seek(0, os.SEEK_END) #　ファイルの0バイト目からファイルの最後まで移動
-        self.next_page_id = self.file.tell() // PAGE_SIZE #　現在の位置(最後)をページサイズで割る。例えば、8192バイトの場合、8192 // 4096 = 2。ファイルが新規作成された場合、ファイルサイズは 0 バイトであり、ページ ID は 0。
+        file_size = self.file.tell()
+        self.next_page_id = file_size // PAGE_SIZE #　現在の位置(最後)をページサイズで割る。例えば、8192バイトの場合、8192 // 4096 = 2。ファイルが新規作成された場合、ファイルサイズは 0 バイトであり、ページ ID は 0。
+        self._init_storage()
+
+        self.has_header = False
+        self.header_dirty = False
+        self.free_list_head = PageId.INVALID_PAGE_ID
+        self.free_page_count = 0
+        if file_size == 0:
+            # 新規ファイルにはヘッダページを作る
+            self.has_header = True
+            self.next_page_id = HEADER_PAGE_ID + 1
+            self._write_header()
+        else:
+            self._load_header()
+
+    # I/Oの計測を有効にする。ページの読み書き・同期(fsync)の回数、ページ数、所要時間を数える
+    # 計測はこのインスタンスの読み書きメソッドを計測付きのものに差し替えて行うので、無効なときのコストは無い
+    def enable_stats(self, trace_hook: Optional[TraceHook] = None) -> IOStats:
+        if self.io_stats is not None:
+            return self.io_stats
+        self.io_stats = IOStats(trace_hook)
+        single_page = lambda page_id, data: ((page_id, data),)
+        all_pages = lambda pages: pages
+        self.read_page_data = self.io_stats.wrap("read", self.read_page_data, single_page)
+        self.write_page_data = self.io_stats.wrap("write", self.write_page_data, single_page)
+        self.read_pages = self.io_stats.wrap("read", self.read_pages, all_pages)
+        self.write_pages = self.io_stats.wrap("write", self.write_pages, all_pages)
+        # グループコミット中は要求の数ではなく実際に同期した回数を数える
+        self._sync_now = self.io_stats.wrap("sync", self._sync_now)
+        return self.io_stats
+
+    # グループコミットを有効にする。複数のスレッドからの sync() をまとめて1回のfsyncで済ませる
+    # commit_delay はリーダーが他の要求を待つ秒数、use_fdatasync はfsyncの代わりにfdatasyncを使うか
+    def enable_group_commit(self, commit_delay: float = 0.0, use_fdatasync: bool = False) -> None:
+        if use_fdatasync and hasattr(os, 'fdatasync'):
+            self.fsync = os.fdatasync
+        self.sync_coordinator = SyncCoordinator(lambda: self._sync_now(), commit_delay)
+
+    # 計測値のスナップショットを返す(計測が無効ならNone)
+    def stats(self) -> Optional[dict]:
+        if self.io_stats is None:
+            return None
+        return self.io_stats.snapshot()
+
+    # ヒープファイルを開く。preadv/pwritevと混ぜて使うため、Python側のバッファは持たない
+    def _open_file(self, heap_file: str):
+        return open(heap_file, 'r+b', buffering=0)
+
+    # サブクラスがヘッダページを読み書きする前に必要な準備をするためのフック
+    def _init_storage(self) -> None:
+        pass
+
+    # ヘッダページを読み込む。識別子が無ければヘッダの無い古いファイルとして扱う
+    def _load_header(self) -> None:
+        header = bytearray(PAGE_SIZE)
+        self.read_page_data(PageId(HEADER_PAGE_ID), header)
+        if header[:4] != HEADER_MAGIC:
+            return
+        self.has_header = True
+        self.free_list_head, self.free_page_count, next_page_id = struct.unpack('<QQQ', header[8:32])
+        # バージョン1のヘッダには終端が無いので、ファイルサイズから求めた値を使う
+        if next_page_id != 0:
+            self.next_page_id = next_page_id
+
+    # ヘッダページを書き込む
+    def _write_header(self) -> None:
+        header = bytearray(PAGE_SIZE)
+        header[:4] = HEADER_MAGIC
+        header[4:8] = struct.pack('<I', HEADER_VERSION)
+        header[8:32] = struct.pack('<QQQ', self.free_list_head, self.free_page_count, self.next_page_id)
+        self.write_page_data(PageId(HEADER_PAGE_ID), header)
+        self.header_dirty = False
+
+    # 終端の変更などでヘッダページが古くなっていれば書き込む
+    def _flush_header(self) -> None:
+        if self.has_header and self.header_dirty:
+            self._write_header()
+
+    # 論理的なデータサイズ(割り当て済みページの終端)を返す
+    def logical_size(self) -> int:
+        return self.next_page_id * PAGE_SIZE
+
+    # 物理的なファイルサイズ(予約済みの領域を含む)を返す
+    def physical_size(self) -> int:
+        return os.fstat(self.file.fileno()).st_size
+
+    # ファイルを end バイト以上になるように extent_size 単位で伸ばして領域を予約する
+    def _reserve_extent(self, end: int) -> None:
+        file_size = self.physical_size()
+        if end <= file_size:
+            return
+        new_size = -(-end // self.extent_size) * self.extent_size
+        try:
+            os.posix_fallocate(self.file.fileno(), file_size, new_size - file_size)
+        except (AttributeError, OSError):
+            # posix_fallocateが使えない環境・ファイルシステムではファイルサイズだけ伸ばす
+            os.ftruncate(self.file.fileno(), new_size)
+        # 予約した領域を終端と取り違えないよう、予約のたびに終端をヘッダに記録する
+        self._write_header()
 
     # ヒープファイルを開き、存在しない場合は新規作成
+    # io_mode="mmap" を指定すると、mmapでページを読み書きするMmapDiskManagerを返す
+    # io_mode="direct" を指定すると、O_DIRECTでOSのページキャッシュを経由しないDirectDiskManagerを返す
+    # io_mode="segmented" を指定すると、segment_size ごとに別ファイルに分けるSegmentedDiskManagerを返す
+    # io_mode="compressed" を指定すると、ページをzlibで圧縮して保存するCompressedDiskManagerを返す
+    # extent_size を指定すると、その単位でファイルの領域をまとめて予約する(mmapモードではマッピングの拡張単位になる)
     @staticmethod
-    def open(heap_file_path: str) -> 'DiskManager':
+    def open(heap_file_path: str, io_mode: str = "file", extent_size: int = 0,
+             segment_size: int = SEGMENT_SIZE) -> 'DiskManager':
         if not os.path.exists(heap_file_path):
             with open(heap_file_path, 'w+b') as f:
                 pass
-        return DiskManager(heap_file_path)
+        if io_mode == "mmap":
+            return MmapDiskManager(heap_file_path, grow_size=extent_size or MMAP_GROW_SIZE)
+        if io_mode == "direct":
+            return DirectDiskManager(heap_file_path, extent_size=extent_size)
+        if io_mode == "segmented":
+            return SegmentedDiskManager(heap_file_path, extent_size=extent_size, segment_size=segment_size)
+        if io_mode == "compressed":
+            if extent_size:
+                raise ValueError("extent_size is not supported in compressed mode")
+            return CompressedDiskManager(heap_file_path)
+        if io_mode != "file":
+            raise ValueError(f"unknown io_mode: {io_mode}")
+        return DiskManager(heap_file_path, extent_size=extent_size)
     
     # 指定したページIDのデータを読み込む
     def read_page_data(self, page_id: PageId, data: bytearray) -> None:
@@ -88,20 +310,657 @@ class DiskManager:
         self.file.seek(offset)
         self.file.write(data)
 
+    # 複数ページをまとめて読み込む
+    # ページIDでソートして連続するページを1つのpreadvにまとめる。ファイルオフセットは動かさない
+    def read_pages(self, pages: Sequence[Tuple[PageId, bytearray]]) -> None:
+        if not hasattr(os, 'preadv'):
+            for page_id, data in pages:
+                self.read_page_data(page_id, data)
+            return
+        fd = self.file.fileno()
+        for start, buffers in self._page_runs(pages):
+            os.preadv(fd, buffers, PAGE_SIZE * start)
+
+    # 複数ページをまとめて書き込む
+    # ページIDでソートして連続するページを1つのpwritevにまとめる。ファイルオフセットは動かさない
+    def write_pages(self, pages: Sequence[Tuple[PageId, bytes]]) -> None:
+        if not hasattr(os, 'pwritev'):
+            for page_id, data in pages:
+                self.write_page_data(page_id, data)
+            return
+        fd = self.file.fileno()
+        for start, buffers in self._page_runs(pages):
+            written = os.pwritev(fd, buffers, PAGE_SIZE * start)
+            # 書き込みが途中で終わった場合は、残りのページを1ページずつ書き込む
+            for i in range(written // PAGE_SIZE, len(buffers)):
+                self.write_page_data(PageId(start + i), buffers[i])
+
+    # (ページID, バッファ)の列をページIDでソートし、連続するページごとに(先頭ページ番号, バッファのリスト)にまとめる
+    @staticmethod
+    def _page_runs(pages: Sequence[Tuple[PageId, bytes]]) -> List[Tuple[int, list]]:
+        runs: List[Tuple[int, list]] = []
+        for page_id, data in sorted(pages, key=lambda p: p[0].to_u64()):
+            page_no = page_id.to_u64()
+            if runs and runs[-1][0] + len(runs[-1][1]) == page_no and len(runs[-1][1]) < IOV_MAX:
+                runs[-1][1].append(data)
+            else:
+                runs.append((page_no, [data]))
+        return runs
+
     # ページを割り当て、ページIDを返す
+    # フリーリストに解放済みページがあればそれを再利用し、無ければファイルの末尾に追加する
     def allocate_page(self) -> PageId:
+        if self.free_list_head != PageId.INVALID_PAGE_ID:
+            page_id = PageId(self.free_list_head)
+            page = bytearray(PAGE_SIZE)
+            self.read_page_data(page_id, page)
+            if page[:4] != FREE_PAGE_MAGIC:
+                raise DiskError(f"free list is corrupted at {page_id}")
+            self.free_list_head, = struct.unpack('<Q', page[4:12])
+            self.free_page_count -= 1
+            self._write_header()
+            return page_id
         page_id = self.next_page_id
         self.next_page_id += 1
+        self.header_dirty = True
+        if self.extent_size and self.has_header:
+            self._reserve_extent(self.next_page_id * PAGE_SIZE)
         return PageId(page_id)
+
+    # ページを解放し、フリーリストの先頭につなぐ。解放したページは次のallocate_pageで再利用される
+    def free_page(self, page_id: PageId) -> None:
+        if not self.has_header:
+            raise DiskError("heap file has no header page; pages cannot be freed")
+        page_no = page_id.to_u64()
+        if page_no == HEADER_PAGE_ID or page_no >= self.next_page_id:
+            raise DiskError(f"cannot free {page_id}")
+        page = bytearray(PAGE_SIZE)
+        self.read_page_data(page_id, page)
+        if page[:4] == FREE_PAGE_MAGIC:
+            raise DiskError(f"{page_id} is already free")
+        page[:] = bytes(PAGE_SIZE)
+        page[:4] = FREE_PAGE_MAGIC
+        page[4:12] = struct.pack('<Q', self.free_list_head)
+        self.write_page_data(page_id, page)
+        self.free_list_head = page_no
+        self.free_page_count += 1
+        self._write_header()
     
     # データをディスクに書き込む(永続化)
+    # グループコミットが有効なら、他のスレッドの要求とまとめて同期されるのを待つ
     def sync(self) -> None:
+        if self.sync_coordinator is not None:
+            self.sync_coordinator.request_sync()
+        else:
+            self._sync_now()
+
+    # 実際にディスクと同期する
+    def _sync_now(self) -> None:
+        self._flush_header()
         self.file.flush()
-        os.fsync(self.file.fileno())
+        self.fsync(self.file.fileno())
 
     # ディスクマネージャを閉じる
+    def close(self) -> None:
+        if not self.file.closed:
+            self._flush_header()
+            self.file.close()
+
     def __del__(self):
-        self.file.close()
+        if hasattr(self, 'file'):
+            self.close()
+
+
+class MmapDiskManager(DiskManager):
+    """
+    ヒープファイルをmmapでメモリにマッピングして読み書きするDiskManager。
+    seek + readinto/write のシステムコールとioバッファ経由のコピーが無くなり、
+    ページはマッピング上のmemoryviewとして直接扱える。
+    マッピングはallocate_pageでファイルが伸びるたびに grow_size 単位でまとめて拡張する。
+    (ファイルはマッピングに合わせて伸ばし、close時に使用中のページ数まで切り詰める)
+    マッピングの作り直しは古いマッピングを閉じるので、マッピングへの読み書きと map_lock で排他する。
+    割り当てていないページ(next_page_id 以降)の読み込みはファイルを伸ばさずに DiskError を送出する。
+    """
+    def __init__(self, heap_file: str, grow_size: int = MMAP_GROW_SIZE):
+        if grow_size <= 0 or grow_size % PAGE_SIZE != 0:
+            raise ValueError("grow_size must be a positive multiple of PAGE_SIZE")
+        self.grow_size = grow_size
+        self.map_lock = threading.Lock()
+        self.mmap: Optional[mmap.mmap] = None
+        self.view: Optional[memoryview] = None
+        self.map_size = 0
+        super().__init__(heap_file)
+
+    # ヘッダページを読み書きする前にファイルをマッピングする
+    def _init_storage(self) -> None:
+        with self.map_lock:
+            self._remap(self.next_page_id * PAGE_SIZE)
+
+    # 必要なサイズ以上になるようにファイルを grow_size 単位で伸ばし、マッピングを作り直す(map_lock を持って呼ぶ)
+    def _remap(self, required_size: int) -> None:
+        new_size = max(self.grow_size, -(-required_size // self.grow_size) * self.grow_size)
+        if new_size <= self.map_size:
+            return
+        os.ftruncate(self.file.fileno(), new_size)
+        old_mmap, old_view = self.mmap, self.view
+        self.mmap = mmap.mmap(self.file.fileno(), new_size)
+        self.view = memoryview(self.mmap)
+        self.map_size = new_size
+        if old_view is not None:
+            old_view.release()
+        if old_mmap is not None:
+            try:
+                old_mmap.close()
+            except BufferError:
+                # page_viewで渡したmemoryviewが残っている場合、古いマッピングはそれが解放されるまで生かしておく
+                pass
+
+    # 読み込むページのオフセットを返す。割り当てていないページなら DiskError を送出する
+    def _read_offset(self, page_id: PageId) -> int:
+        page_no = page_id.to_u64()
+        if page_no >= self.next_page_id:
+            raise DiskError(f"{page_id} is out of range (next_page_id={self.next_page_id})")
+        return PAGE_SIZE * page_no
+
+    # 指定したページIDのページをマッピング上のmemoryviewとして返す(コピーしない)
+    # 返したmemoryviewが残っている間は、マッピングを作り直しても古いマッピングは閉じられない
+    def page_view(self, page_id: PageId) -> memoryview:
+        offset = self._read_offset(page_id)
+        with self.map_lock:
+            return self.view[offset:offset + PAGE_SIZE]
+
+    # 指定したページIDのデータを読み込む(マッピングからコピーするだけ)
+    def read_page_data(self, page_id: PageId, data: bytearray) -> None:
+        offset = self._read_offset(page_id)
+        with self.map_lock:
+            data[:PAGE_SIZE] = self.view[offset:offset + PAGE_SIZE]
+
+    # 指定したページIDにデータを書き込む(マッピングへコピーするだけ)
+    def write_page_data(self, page_id: PageId, data: bytes) -> None:
+        offset = PAGE_SIZE * page_id.to_u64()
+        with self.map_lock:
+            if offset + PAGE_SIZE > self.map_size:
+                self._remap(offset + PAGE_SIZE)
+            self.view[offset:offset + len(data)] = data
+
+    # 複数ページをまとめて読み込む(マッピングからのコピーなのでページごとに処理する)
+    def read_pages(self, pages: Sequence[Tuple[PageId, bytearray]]) -> None:
+        for page_id, data in pages:
+            self.read_page_data(page_id, data)
+
+    # 複数ページをまとめて書き込む(マッピングへのコピーなのでページごとに処理する)
+    def write_pages(self, pages: Sequence[Tuple[PageId, bytes]]) -> None:
+        for page_id, data in pages:
+            self.write_page_data(page_id, data)
+
+    # ページを割り当て、必要ならマッピングを拡張する
+    def allocate_page(self) -> PageId:
+        page_id = super().allocate_page()
+        end = PAGE_SIZE * self.next_page_id
+        with self.map_lock:
+            if end > self.map_size:
+                self._remap(end)
+        return page_id
+
+    # マッピングの変更をディスクに書き込む(永続化)
+    def _sync_now(self) -> None:
+        self._flush_header()
+        with self.map_lock:
+            self.mmap.flush()
+        self.fsync(self.file.fileno())
+
+    # マッピングを解放し、ファイルを使用中のページ数まで切り詰めて閉じる
+    def close(self) -> None:
+        if self.file.closed:
+            return
+        self._flush_header()
+        unmapped = True
+        with self.map_lock:
+            if self.mmap is not None:
+                self.mmap.flush()
+                self.view.release()
+                try:
+                    self.mmap.close()
+                except BufferError:
+                    # memoryviewがまだ使われている間はファイルを切り詰めるとアクセス時にSIGBUSになるので切り詰めない
+                    unmapped = False
+                self.mmap = None
+                self.view = None
+        if unmapped:
+            os.ftruncate(self.file.fileno(), self.next_page_id * PAGE_SIZE)
+        super().close()
+
+
+class DirectDiskManager(DiskManager):
+    """
+    ヒープファイルを O_DIRECT で開き、OSのページキャッシュを経由せずに読み書きするDiskManager。
+    バッファプールとOSのページキャッシュで同じページを二重にキャッシュしなくなるので、
+    メモリの大半をバッファプールに割り当てられ、メモリが逼迫したときのレイテンシも安定する。
+    O_DIRECTではバッファのアドレス・長さ・オフセットがブロック境界に揃っている必要があるため、
+    匿名mmapで確保したページ境界に揃った領域(アリーナ)を経由して読み書きする。
+    アリーナは読み込みと書き込みで共有するので、アリーナを使う間は arena_lock を持つ。
+    """
+    # アリーナを共有するので、読み込みを同時に呼んでも1つずつ行われる
+    concurrent_reads = False
+
+    def __init__(self, heap_file: str, extent_size: int = 0, arena_pages: int = 64):
+        if not hasattr(os, 'O_DIRECT'):
+            raise DiskError("O_DIRECT is not supported on this platform")
+        if arena_pages <= 0:
+            raise ValueError("arena_pages must be positive")
+        # 匿名mmapはページ境界に揃っている
+        self.arena = mmap.mmap(-1, arena_pages * PAGE_SIZE)
+        self.arena_view = memoryview(self.arena)
+        self.arena_pages = arena_pages
+        self.arena_lock = threading.Lock()
+        super().__init__(heap_file, extent_size=extent_size)
+
+    # ヒープファイルを O_DIRECT 付きで開く
+    def _open_file(self, heap_file: str):
+        try:
+            return open(heap_file, 'r+b', buffering=0,
+                        opener=lambda path, flags: os.open(path, flags | os.O_DIRECT))
+        except OSError as e:
+            raise DiskError(f"cannot open {heap_file} with O_DIRECT: {e}") from e
+
+    # 指定したページIDのデータをアリーナ経由で読み込む
+    def read_page_data(self, page_id: PageId, data: bytearray) -> None:
+        with self.arena_lock:
+            aligned = self.arena_view[:PAGE_SIZE]
+            read = os.preadv(self.file.fileno(), [aligned], PAGE_SIZE * page_id.to_u64())
+            data[:read] = aligned[:read]
+
+    # 指定したページIDにデータをアリーナ経由で書き込む(ページに満たない部分は0で埋める)
+    def write_page_data(self, page_id: PageId, data: bytes) -> None:
+        with self.arena_lock:
+            aligned = self.arena_view[:PAGE_SIZE]
+            aligned[:len(data)] = data
+            aligned[len(data):] = bytes(PAGE_SIZE - len(data))
+            os.pwrite(self.file.fileno(), aligned, PAGE_SIZE * page_id.to_u64())
+
+    # 複数ページをまとめて読み込む。連続するページをアリーナに一度に読み込んでから各バッファに配る
+    def read_pages(self, pages: Sequence[Tuple[PageId, bytearray]]) -> None:
+        fd = self.file.fileno()
+        for start, buffers in self._page_runs(pages):
+            for i in range(0, len(buffers), self.arena_pages):
+                chunk = buffers[i:i + self.arena_pages]
+                with self.arena_lock:
+                    aligned = self.arena_view[:len(chunk) * PAGE_SIZE]
+                    read = os.preadv(fd, [aligned], PAGE_SIZE * (start + i))
+                    for j, data in enumerate(chunk):
+                        n = max(0, min(PAGE_SIZE, read - j * PAGE_SIZE))
+                        data[:n] = aligned[j * PAGE_SIZE:j * PAGE_SIZE + n]
+
+    # 複数ページをまとめて書き込む。連続するページをアリーナに並べてから一度に書き込む
+    def write_pages(self, pages: Sequence[Tuple[PageId, bytes]]) -> None:
+        fd = self.file.fileno()
+        for start, buffers in self._page_runs(pages):
+            for i in range(0, len(buffers), self.arena_pages):
+                chunk = buffers[i:i + self.arena_pages]
+                with self.arena_lock:
+                    aligned = self.arena_view[:len(chunk) * PAGE_SIZE]
+                    for j, data in enumerate(chunk):
+                        aligned[j * PAGE_SIZE:(j + 1) * PAGE_SIZE] = data
+                    os.pwrite(fd, aligned, PAGE_SIZE * (start + i))
+
+    # ファイルを閉じてからアリーナを解放する
+    def close(self) -> None:
+        super().close()
+        with self.arena_lock:
+            if not self.arena.closed:
+                self.arena_view.release()
+                self.arena.close()
+
+
+class SegmentedDiskManager(DiskManager):
+    """
+    ページを segment_size ごとの別ファイル(セグメント)に分けて保存するDiskManager。
+    PostgreSQLのリレーションセグメントと同じく、セグメント0はヒープファイルそのもので、
+    セグメントnは "<ヒープファイル>.n" になる。ページIDからセグメント番号とセグメント内のオフセットを求める。
+    バックアップや切り詰めがセグメント単位ででき、ファイルサイズの上限にも引っかからない。
+    セグメントファイルは初めて使うときに開き、開いておく数は max_open_segments 個までのLRUで管理する。
+    読み書きはファイルオフセットを共有しない pread/pwrite 系で行うので、
+    別のスレッドから別のセグメントへのI/Oを並行して発行できる。
+    """
+    class Segment:
+        """開いているセグメントファイルのファイルディスクリプタと、それを使用中のスレッド数"""
+        def __init__(self, fd: int):
+            self.fd = fd
+            self.users = 0
+
+    def __init__(self, heap_file: str, extent_size: int = 0, segment_size: int = SEGMENT_SIZE,
+                 max_open_segments: int = MAX_OPEN_SEGMENTS):
+        if segment_size <= 0 or segment_size % PAGE_SIZE != 0:
+            raise ValueError("segment_size must be a positive multiple of PAGE_SIZE")
+        if extent_size and segment_size % extent_size != 0:
+            raise ValueError("segment_size must be a multiple of extent_size")
+        if max_open_segments <= 0:
+            raise ValueError("max_open_segments must be positive")
+        self.segment_size = segment_size
+        self.pages_per_segment = segment_size // PAGE_SIZE
+        self.max_open_segments = max_open_segments
+        self.segments: 'OrderedDict[int, SegmentedDiskManager.Segment]' = OrderedDict()
+        self.dirty_segments = set()
+        self.segments_lock = threading.Lock()
+        super().__init__(heap_file, extent_size=extent_size)
+
+    # セグメント番号からファイルパスを返す(セグメント0はヒープファイルそのもの)
+    def segment_path(self, segment_no: int) -> str:
+        return self.heap_file if segment_no == 0 else f"{self.heap_file}.{segment_no}"
+
+    # ヘッダページの無いファイルでは、存在するセグメントファイルの大きさから終端を求める
+    def _init_storage(self) -> None:
+        segment_no = 0
+        while os.path.exists(self.segment_path(segment_no + 1)):
+            segment_no += 1
+        if segment_no > 0:
+            last_size = os.path.getsize(self.segment_path(segment_no))
+            self.next_page_id = segment_no * self.pages_per_segment + last_size // PAGE_SIZE
+
+    # セグメントを使用中にしてファイルディスクリプタを返す。開いていなければ開き、上限を超えたら使われていないものから閉じる
+    def _acquire_segment(self, segment_no: int) -> int:
+        with self.segments_lock:
+            segment = self.segments.get(segment_no)
+            if segment is None:
+                if segment_no == 0:
+                    fd = self.file.fileno()
+                else:
+                    fd = os.open(self.segment_path(segment_no), os.O_RDWR | os.O_CREAT, 0o644)
+                segment = SegmentedDiskManager.Segment(fd)
+                self.segments[segment_no] = segment
+                self._close_idle_segments()
+            else:
+                self.segments.move_to_end(segment_no)
+            segment.users += 1
+            return segment.fd
+
+    # セグメントの使用を終える
+    def _release_segment(self, segment_no: int) -> None:
+        with self.segments_lock:
+            self.segments[segment_no].users -= 1
+
+    # 開いているセグメントが上限を超えていれば、使われていないものを古い順に閉じる(segments_lockを持って呼ぶ)
+    def _close_idle_segments(self) -> None:
+        for segment_no in list(self.segments):
+            if len(self.segments) <= self.max_open_segments:
+                break
+            segment = self.segments[segment_no]
+            if segment.users == 0:
+                del self.segments[segment_no]
+                if segment_no != 0:
+                    os.close(segment.fd)
+
+    # ページ番号の連続をセグメントの境界で分割する
+    def _segment_runs(self, pages: Sequence[Tuple[PageId, bytes]]) -> List[Tuple[int, list]]:
+        runs = []
+        for start, buffers in self._page_runs(pages):
+            while buffers:
+                count = min(len(buffers), self.pages_per_segment - start % self.pages_per_segment)
+                runs.append((start, buffers[:count]))
+                start += count
+                buffers = buffers[count:]
+        return runs
+
+    # 指定したページIDのデータを読み込む
+    def read_page_data(self, page_id: PageId, data: bytearray) -> None:
+        self.read_pages([(page_id, data)])
+
+    # 指定したページIDにデータを書き込む
+    def write_page_data(self, page_id: PageId, data: bytes) -> None:
+        self.write_pages([(page_id, data)])
+
+    # 複数ページをまとめて読み込む。連続するページはセグメントごとに1つのpreadvにまとめる
+    def read_pages(self, pages: Sequence[Tuple[PageId, bytearray]]) -> None:
+        for start, buffers in self._segment_runs(pages):
+            segment_no, page_in_segment = divmod(start, self.pages_per_segment)
+            fd = self._acquire_segment(segment_no)
+            try:
+                os.preadv(fd, buffers, PAGE_SIZE * page_in_segment)
+            finally:
+                self._release_segment(segment_no)
+
+    # 複数ページをまとめて書き込む。連続するページはセグメントごとに1つのpwritevにまとめる
+    def write_pages(self, pages: Sequence[Tuple[PageId, bytes]]) -> None:
+        for start, buffers in self._segment_runs(pages):
+            segment_no, page_in_segment = divmod(start, self.pages_per_segment)
+            fd = self._acquire_segment(segment_no)
+            try:
+                offset = PAGE_SIZE * page_in_segment
+                written = os.pwritev(fd, buffers, offset)
+                # 書き込みが途中で終わった場合は、残りのページを1ページずつ書き込む
+                for i in range(written // PAGE_SIZE, len(buffers)):
+                    os.pwrite(fd, buffers[i], offset + PAGE_SIZE * i)
+            finally:
+                self._release_segment(segment_no)
+            with self.segments_lock:
+                self.dirty_segments.add(segment_no)
+
+    # 物理的なファイルサイズ(全セグメントの合計)を返す
+    def physical_size(self) -> int:
+        size = 0
+        for segment_no in range(self.next_page_id // self.pages_per_segment + 1):
+            path = self.segment_path(segment_no)
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+        return size
+
+    # 終端のページを含むセグメントを extent_size 単位で伸ばして領域を予約する
+    def _reserve_extent(self, end: int) -> None:
+        segment_no, end_in_segment = divmod(end - PAGE_SIZE, self.segment_size)
+        end_in_segment += PAGE_SIZE
+        fd = self._acquire_segment(segment_no)
+        try:
+            file_size = os.fstat(fd).st_size
+            if end_in_segment <= file_size:
+                return
+            new_size = min(self.segment_size, -(-end_in_segment // self.extent_size) * self.extent_size)
+            try:
+                os.posix_fallocate(fd, file_size, new_size - file_size)
+            except (AttributeError, OSError):
+                os.ftruncate(fd, new_size)
+        finally:
+            self._release_segment(segment_no)
+        self._write_header()
+
+    # 書き込みのあったセグメントをすべてディスクに同期する
+    def _sync_now(self) -> None:
+        self._flush_header()
+        with self.segments_lock:
+            dirty_segments, self.dirty_segments = self.dirty_segments, set()
+        pending = sorted(dirty_segments)
+        try:
+            while pending:
+                segment_no = pending[0]
+                fd = self._acquire_segment(segment_no)
+                try:
+                    self.fsync(fd)
+                finally:
+                    self._release_segment(segment_no)
+                pending.pop(0)
+        except BaseException:
+            # 同期できなかったセグメントは dirty に戻し、次の sync() でもう一度同期する
+            with self.segments_lock:
+                self.dirty_segments.update(pending)
+            raise
+
+    # 開いているセグメントファイルをすべて閉じる
+    def close(self) -> None:
+        if self.file.closed:
+            return
+        self._flush_header()
+        with self.segments_lock:
+            for segment_no, segment in self.segments.items():
+                if segment_no != 0:
+                    os.close(segment.fd)
+            self.segments.clear()
+        super().close()
+
+
+class CompressedDiskManager(DiskManager):
+    """
+    ページをzlibで圧縮して保存するDiskManager。
+    B+ツリーのページはほとんどが0埋めなので、圧縮するとディスクへの書き込み量が大きく減る。
+    圧縮後のページは可変長なので、ヒープファイルには COMPRESSED_SLOT_ALIGN 単位の大きさのスロットに置き、
+    ページIDからスロットの位置を引くページ変換表(PTT)を "<ヒープファイル>.ptt" に保存する。
+    PTTのエントリは (スロットのオフセット, 圧縮後の長さ, スロットの大きさ) で、長さ0は未書き込みのページを表す。
+    永続化済みのPTTが指すスロットは上書きせず、書き直したページは常に新しいスロットに書く(シャドウページング)。
+    古いスロットはPTTを書き直してfsyncするまで空きスロットに戻さないので、
+    途中でクラッシュしても、ディスク上のPTTが指すページの内容は最後の同期の時点のまま残る。
+    前回の同期より後に確保したスロットはディスク上のPTTから参照されないので、そのまま上書き・再利用してよい。
+    圧縮しても小さくならないページは PAGE_SIZE の長さでそのまま保存する。
+    ヘッダページやフリーリストもページ0以降の圧縮ページとして保存される。
+    """
+    PTT_ENTRY = struct.Struct('<QII')
+
+    def __init__(self, heap_file: str, level: int = 6):
+        self.level = level
+        self.ptt_file = heap_file + '.ptt'
+        self.slot_offsets = array('Q')
+        self.slot_lengths = array('I')
+        self.slot_capacities = array('I')
+        self.free_slots: Dict[int, List[int]] = {}  # スロットの大きさ -> 空きスロットのオフセット
+        self.pending_free_slots: List[Tuple[int, int]] = []  # PTTの永続化を待つ古いスロットの (オフセット, 大きさ)
+        self.unsynced_slots: Set[int] = set()  # 前回PTTを永続化した後に確保したスロットのオフセット
+        self.data_end = 0
+        self.ptt_dirty = False
+        self.bytes_read = 0      # ディスクから読んだ(圧縮後の)バイト数
+        self.bytes_written = 0   # ディスクに書いた(圧縮後の)バイト数
+        super().__init__(heap_file)
+
+    # PTTを読み込み、空きスロットを求める
+    def _init_storage(self) -> None:
+        file_size = os.fstat(self.file.fileno()).st_size
+        if not os.path.exists(self.ptt_file):
+            if file_size != 0:
+                raise DiskError(f"{self.heap_file} is not a compressed heap file")
+            return
+        with open(self.ptt_file, 'rb') as f:
+            ptt = f.read()
+        for offset, length, capacity in self.PTT_ENTRY.iter_unpack(ptt):
+            self.slot_offsets.append(offset)
+            self.slot_lengths.append(length)
+            self.slot_capacities.append(capacity)
+        # 使用中のスロットの隙間を空きスロットとして登録する
+        used = sorted((self.slot_offsets[i], self.slot_capacities[i])
+                      for i in range(len(self.slot_offsets)) if self.slot_capacities[i])
+        position = 0
+        for offset, capacity in used:
+            self._add_free_slot(position, offset - position)
+            position = offset + capacity
+        self.data_end = position
+
+    # PTTをファイルに書き出す(一時ファイルに書いてから置き換える)
+    def _write_ptt(self) -> None:
+        if not self.ptt_dirty:
+            return
+        entries = bytearray()
+        for i in range(len(self.slot_offsets)):
+            entries += self.PTT_ENTRY.pack(self.slot_offsets[i], self.slot_lengths[i], self.slot_capacities[i])
+        tmp_file = self.ptt_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(entries)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.ptt_file)
+        # 置き換えたことも永続化してから、古いスロットを空きスロットに戻す
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.ptt_file)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        self.ptt_dirty = False
+        for offset, capacity in self.pending_free_slots:
+            self._add_free_slot(offset, capacity)
+        self.pending_free_slots = []
+        self.unsynced_slots.clear()
+
+    # 空き領域を COMPRESSED_SLOT_ALIGN 単位のスロットとして登録する
+    def _add_free_slot(self, offset: int, size: int) -> None:
+        capacity = size // COMPRESSED_SLOT_ALIGN * COMPRESSED_SLOT_ALIGN
+        if capacity > 0:
+            self.free_slots.setdefault(capacity, []).append(offset)
+
+    # length バイトが入るスロットを空きスロットから探し、無ければファイルの末尾に確保する
+    def _allocate_slot(self, length: int) -> Tuple[int, int]:
+        capacity = -(-length // COMPRESSED_SLOT_ALIGN) * COMPRESSED_SLOT_ALIGN
+        for size in sorted(self.free_slots):
+            if size >= capacity:
+                offsets = self.free_slots[size]
+                offset = offsets.pop()
+                if not offsets:
+                    del self.free_slots[size]
+                self._add_free_slot(offset + capacity, size - capacity)
+                return offset, capacity
+        offset = self.data_end
+        self.data_end += capacity
+        return offset, capacity
+
+    # 指定したページIDのデータを読み込み、展開する。未書き込みのページは0で埋める
+    def read_page_data(self, page_id: PageId, data: bytearray) -> None:
+        page_no = page_id.to_u64()
+        if page_no >= len(self.slot_lengths) or self.slot_lengths[page_no] == 0:
+            data[:PAGE_SIZE] = bytes(PAGE_SIZE)
+            return
+        length = self.slot_lengths[page_no]
+        stored = os.pread(self.file.fileno(), length, self.slot_offsets[page_no])
+        self.bytes_read += length
+        data[:PAGE_SIZE] = stored if length == PAGE_SIZE else zlib.decompress(stored)
+
+    # 指定したページIDのデータを圧縮して書き込む
+    # 永続化済みのPTTが指すスロットは上書きせず、新しいスロットに書いて古いスロットは次のPTTの永続化まで取っておく
+    def write_page_data(self, page_id: PageId, data: bytes) -> None:
+        page_no = page_id.to_u64()
+        compressed = zlib.compress(data, self.level)
+        if len(compressed) >= PAGE_SIZE:
+            compressed = bytes(data)
+        if page_no >= len(self.slot_offsets):
+            grow = page_no + 1 - len(self.slot_offsets)
+            self.slot_offsets.extend([0] * grow)
+            self.slot_lengths.extend([0] * grow)
+            self.slot_capacities.extend([0] * grow)
+        old_offset, old_capacity = self.slot_offsets[page_no], self.slot_capacities[page_no]
+        unsynced = old_capacity > 0 and old_offset in self.unsynced_slots
+        if not unsynced or len(compressed) > old_capacity:
+            if unsynced:
+                # ディスク上のPTTから参照されていないスロットはすぐに再利用できる
+                self.unsynced_slots.discard(old_offset)
+                self._add_free_slot(old_offset, old_capacity)
+            elif old_capacity:
+                self.pending_free_slots.append((old_offset, old_capacity))
+            offset, capacity = self._allocate_slot(len(compressed))
+            self.slot_offsets[page_no], self.slot_capacities[page_no] = offset, capacity
+            self.unsynced_slots.add(offset)
+        self.slot_lengths[page_no] = len(compressed)
+        self.ptt_dirty = True
+        os.pwrite(self.file.fileno(), compressed, self.slot_offsets[page_no])
+        self.bytes_written += len(compressed)
+
+    # 圧縮ページは可変長なので、複数ページの読み込みはページごとに行う
+    def read_pages(self, pages: Sequence[Tuple[PageId, bytearray]]) -> None:
+        for page_id, data in pages:
+            self.read_page_data(page_id, data)
+
+    # 圧縮ページは可変長なので、複数ページの書き込みはページごとに行う
+    def write_pages(self, pages: Sequence[Tuple[PageId, bytes]]) -> None:
+        for page_id, data in pages:
+            self.write_page_data(page_id, data)
+
+    # データとPTTをディスクに書き込む(永続化)
+    def _sync_now(self) -> None:
+        super()._sync_now()
+        self._write_ptt()
+
+    # データを同期し、PTTを書き出してから閉じる
+    def close(self) -> None:
+        if self.file.closed:
+            return
+        self._flush_header()
+        if self.ptt_dirty:
+            # PTTが指すスロットの内容を先に永続化する
+            self.fsync(self.file.fileno())
+        self._write_ptt()
+        super().close()
 
 # テスト用コード
 if __name__ == "__main__":
@@ -32,19 +32,14 @@ def main():
         
         # データを検索
         print("Searching data...")
-        result = btree.search(bufmgr, SearchMode.Key(struct.pack('>Q', 3)))
-        if result:  # 検索結果がある場合のみ処理
-            key, value = result  # タプルをアンパック
-            print(f"Key: {struct.unpack('>Q', key)[0]}, Value: {value.decode()}")
-        else:
-            print("Key not found.")
-
-        result = btree.search(bufmgr, SearchMode.Key(struct.pack('>Q', 8)))
-        if result:  # 検索結果がある場合のみ処理
-            key, value = result  # タプルをアンパック
-            print(f"Key: {struct.unpack('>Q', key)[0]}, Value: {value.decode()}")
-        else:
-            print("Key not found.")
+        # search() はキー以上の最初のペアを指すカーソルを返すので、キーが一致するかを確かめる
+        for search_key in (3, 8):
+            result = btree.search(bufmgr, SearchMode.Key(struct.pack('>Q', search_key))).get()
+            if result and result[0] == struct.pack('>Q', search_key):  # 検索結果がある場合のみ処理
+                key, value = result  # タプルをアンパック
+                print(f"Key: {struct.unpack('>Q', key)[0]}, Value: {value.decode()}")
+            else:
+                print("Key not found.")
         
     except Exception as e:
         print(f"An error occurred: {e}", file=sys.stderr)
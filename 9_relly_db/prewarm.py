@@ -0,0 +1,160 @@
+import os
+import struct
+import threading
+from concurrent.futures import Future
+from typing import List, Optional
+from disk import FREE_PAGE_MAGIC, PageId, PAGE_SIZE
+
+"""
+バッファプールのプリウォーム
+なぜ: 再起動した直後はバッファプールが空なので、B+ツリーの検索が全てミスになり、
+キャッシュが温まるまでの間ずっと応答時間が悪くなる
+どうやって: バッファプールに載っているページIDを、よく使われている順に小さなファイル(サイドカー)に保存しておき、
+起動したらそのページをページID順に並べて、連続するページをまとめて読み込む(disk.read_pages)
+読み込みはブロックして終わらせるか、別スレッドで行うかを選べる。別スレッドで読んでいる間に
+フォアグラウンドが読み込んだページは、先読みと同じ仕組み(prefetching)でプリウォームの内容を捨てる
+プリウォームは空いているフレームだけを使い、既に載っているページは追い出さない
+"""
+
+# サイドカーファイルの先頭の識別子
+PREWARM_MAGIC = b"RLYWARM1"
+# 1回の read_pages で読み込むページ数
+PREWARM_BATCH_PAGES = 64
+
+
+def prewarm_file_path(heap_file_path: str) -> str:
+    """ヒープファイルに対応するサイドカーファイルのパス"""
+    return heap_file_path + ".prewarm"
+
+
+def save_prewarm_file(bufmgr, path: str) -> int:
+    """
+    バッファプールに載っているページIDを、よく使われている(置換されにくい)順に path に保存し、保存したページ数を返す。
+    書きかけのファイルが残らないよう、一時ファイルに書いてから置き換える。
+    """
+    with bufmgr.lock:
+        # candidates() は置換されそうな順なので、逆にすると残しておきたい順になる
+        page_ids = [bufmgr.pool.buffers[buffer_id].buffer.page_id for buffer_id in reversed(bufmgr.pool.policy.candidates())]
+    data = PREWARM_MAGIC + struct.pack('>I', len(page_ids)) + b"".join(page_id.to_bytes() for page_id in page_ids)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return len(page_ids)
+
+
+def load_prewarm_file(path: str) -> List[PageId]:
+    """サイドカーファイルからページIDを読み込む(ファイルが無い・壊れている場合は空のリスト)"""
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    header_size = len(PREWARM_MAGIC) + 4
+    if len(data) < header_size or data[:len(PREWARM_MAGIC)] != PREWARM_MAGIC:
+        return []
+    count = struct.unpack('>I', data[len(PREWARM_MAGIC):header_size])[0]
+    if len(data) != header_size + count * 8:
+        return []
+    return [PageId.from_bytes(data[offset:offset + 8]) for offset in range(header_size, len(data), 8)]
+
+
+def prewarm(bufmgr, page_ids: List[PageId], batch_pages: int = PREWARM_BATCH_PAGES) -> int:
+    """
+    page_ids (よく使われている順) をバッファプールの空いているフレームに読み込み、読み込んだページ数を返す。
+    空いているフレームの数だけ先頭から選び、ページID順に batch_pages ページずつまとめて読む。
+    空いているフレームが無くなったら止める。
+    """
+    first_page_no = 1 if bufmgr.disk.has_header else 0
+    with bufmgr.lock:
+        budget = bufmgr.pool.free_frames()
+        selected = []
+        seen = set()
+        for page_id in page_ids:
+            if len(selected) >= budget:
+                break
+            # 解放されて無くなったページや、既に載っているページは読まない
+            if page_id in seen or page_id in bufmgr.page_table or page_id in bufmgr.prefetching:
+                continue
+            if not first_page_no <= page_id.to_u64() < bufmgr.disk.next_page_id:
+                continue
+            seen.add(page_id)
+            selected.append(page_id)
+    selected.sort(key=PageId.to_u64)
+
+    loaded = 0
+    for start in range(0, len(selected), batch_pages):
+        batch = selected[start:start + batch_pages]
+        future: Future = Future()
+        with bufmgr.lock:
+            batch = [page_id for page_id in batch
+                     if page_id not in bufmgr.page_table and page_id not in bufmgr.prefetching]
+            for page_id in batch:
+                bufmgr.prefetching[page_id] = future
+        try:
+            pages = [(page_id, bytearray(PAGE_SIZE)) for page_id in batch]
+            if bufmgr.disk.concurrent_reads:
+                bufmgr.disk.read_pages(pages)
+            else:
+                with bufmgr.io_lock:
+                    bufmgr.disk.read_pages(pages)
+            with bufmgr.lock:
+                for page_id, data in pages:
+                    # 読んでいる間にフォアグラウンドで読み込まれた(または解放された)ページは捨てる
+                    if bufmgr.prefetching.get(page_id) is not future:
+                        continue
+                    # 保存した後に解放されたページは、次の create_page で使われるので載せない
+                    if data[:4] == FREE_PAGE_MAGIC:
+                        continue
+                    if not bufmgr.install_prewarmed(page_id, data):
+                        return loaded
+                    loaded += 1
+        finally:
+            with bufmgr.lock:
+                for page_id in batch:
+                    if bufmgr.prefetching.get(page_id) is future:
+                        del bufmgr.prefetching[page_id]
+            future.set_result(None)
+    return loaded
+
+
+class Prewarmer(threading.Thread):
+    """
+    BufferPoolManager のプリウォームを行うスレッド。
+    background なら起動時の読み込みもこのスレッドで行い、save_interval 秒ごとにサイドカーファイルを保存し直す。
+    stop() で止めるときにもう一度保存する。
+    """
+    def __init__(self, bufmgr, path: str, background: bool, save_interval: Optional[float]):
+        super().__init__(name="relly-prewarm", daemon=True)
+        self.bufmgr = bufmgr
+        self.path = path
+        self.background = background
+        self.save_interval = save_interval
+        self.stop_event = threading.Event()
+        self.loaded = threading.Event()  # 起動時の読み込みが終わったら立つ
+        self.loaded_pages = 0
+
+    def load(self) -> int:
+        """サイドカーファイルのページを読み込む"""
+        try:
+            self.loaded_pages = prewarm(self.bufmgr, load_prewarm_file(self.path))
+            if self.bufmgr.io_stats is not None:
+                self.bufmgr.io_stats.count("prewarm_pages", self.loaded_pages)
+        finally:
+            self.loaded.set()
+        return self.loaded_pages
+
+    def run(self) -> None:
+        if self.background:
+            self.load()
+        while self.save_interval is not None and not self.stop_event.wait(self.save_interval):
+            save_prewarm_file(self.bufmgr, self.path)
+
+    def stop(self) -> None:
+        """スレッドを止めて終了を待ち、今載っているページを保存する"""
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+        save_prewarm_file(self.bufmgr, self.path)
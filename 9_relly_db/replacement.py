@@ -0,0 +1,401 @@
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional
+
+"""
+バッファプールのページ置換アルゴリズム
+なぜ: どのページを追い出すのが良いかはアクセスパターン(点検索・範囲スキャン・挿入)によって変わるので、
+置換アルゴリズムを入れ替えて、実際のアクセスパターンで比べられるようにしたい
+どうやって: BufferPool は置換アルゴリズム(ReplacementPolicy)にアクセスを知らせ、置換対象のフレームを選んでもらう
+ClockSweep(既定)のほかに LRU, LRU-K, 2Q, ARC を用意する
+どのアルゴリズムもピン留めされたフレームは選ばず、空いているフレームがあればそれを先に使う
+"""
+
+# usage_count の上限。上限が無いと、よく使われたページが使われなくなっても長い間追い出されなくなる
+MAX_USAGE_COUNT = 5
+
+
+class ReplacementPolicy:
+    """
+    置換アルゴリズムのインターフェース。
+    BufferPool はページがフレームに載ったとき on_load、バッファヒットのとき on_hit、
+    フレームが空きに戻ったとき on_free を呼び、置換対象が必要になったら victim を呼ぶ。
+    victim は置換対象を選ぶだけで、選んだフレームの古いページは次の on_load で追い出されたものとして扱う。
+    フレームは buffer_id (フレーム配列の添字) で表す。
+    バッファプールの大きさが変わったら resize が呼ばれる。
+    """
+    name = "base"
+
+    def attach(self, frames: List) -> None:
+        """BufferPool のフレーム配列を受け取り、全フレームを空きとして初期化する"""
+        self.frames = frames
+        self.pages: List[Optional[object]] = [None] * len(frames)  # フレームに載っているページID
+        self.free: Dict[int, None] = dict.fromkeys(range(len(frames)))  # 空いているフレーム
+
+    def resize(self, pool_size: int) -> None:
+        """
+        フレーム配列の大きさが pool_size に変わった。増えたフレームは空きとして扱う。
+        減ったときに取り除かれたフレームは、先に on_free で空きに戻されている。
+        """
+        old_size = len(self.pages)
+        if pool_size >= old_size:
+            self.pages.extend([None] * (pool_size - old_size))
+            self.free.update(dict.fromkeys(range(old_size, pool_size)))
+        else:
+            for buffer_id in range(pool_size, old_size):
+                del self.free[buffer_id]
+            del self.pages[pool_size:]
+
+    def on_load(self, buffer_id: int, page_id) -> None:
+        """フレーム buffer_id に page_id が載った(古いページは追い出された)"""
+        old_page_id = self.pages[buffer_id]
+        if old_page_id is None:
+            self.free.pop(buffer_id, None)
+        else:
+            self._remove(buffer_id, old_page_id, evicted=True)
+        self.pages[buffer_id] = page_id
+        self._insert(buffer_id, page_id)
+
+    def on_hit(self, buffer_id: int, page_id) -> None:
+        """フレーム buffer_id のページ page_id が再び使われた"""
+        raise NotImplementedError
+
+    def on_free(self, buffer_id: int) -> None:
+        """フレーム buffer_id のページが解放され、フレームが空きに戻った"""
+        old_page_id = self.pages[buffer_id]
+        if old_page_id is not None:
+            self._remove(buffer_id, old_page_id, evicted=False)
+            self.pages[buffer_id] = None
+        self.free[buffer_id] = None
+
+    def victim(self, page_id=None) -> Optional[int]:
+        """
+        置換対象のフレームを返す(全フレームがピン留めされていれば None)。
+        page_id はこれから載せるページで、分かっていれば置換対象の選択に使う(ARC)。
+        """
+        for buffer_id in self.free:
+            if self.frames[buffer_id].pin_count == 0:
+                return buffer_id
+        return self._victim(page_id)
+
+    def candidates(self) -> List[int]:
+        """
+        載っているフレームを置換対象になりそうな順に返す(状態は変えない)。
+        バックグラウンドライターが、置換される前に dirty ページを書き戻しておくのに使う。
+        """
+        return [buffer_id for buffer_id in range(len(self.frames)) if self.pages[buffer_id] is not None]
+
+    def _unpinned(self, buffer_ids) -> Optional[int]:
+        """buffer_ids のうち、最初のピン留めされていないフレームを返す"""
+        for buffer_id in buffer_ids:
+            if self.frames[buffer_id].pin_count == 0:
+                return buffer_id
+        return None
+
+    def _insert(self, buffer_id: int, page_id) -> None:
+        raise NotImplementedError
+
+    def _remove(self, buffer_id: int, page_id, evicted: bool) -> None:
+        raise NotImplementedError
+
+    def _victim(self, page_id) -> Optional[int]:
+        raise NotImplementedError
+
+
+class ClockSweep(ReplacementPolicy):
+    """
+    Clock-sweep(PostgreSQLにも採用されているアルゴリズム)。
+    フレームを時計の針のように巡回し、usage_count == 0 のものを置換対象にする。
+    usage_count > 0 のものは usage_count を1減らして(ページを老化させて)次へ進む。
+    usage_count は MAX_USAGE_COUNT 以下なので、MAX_USAGE_COUNT + 1 周すれば
+    ピン留めされていないフレームは必ず見つかる。
+    """
+    name = "clock"
+
+    def attach(self, frames: List) -> None:
+        super().attach(frames)
+        self.hand = 0  # 次に調べるフレーム
+
+    def resize(self, pool_size: int) -> None:
+        super().resize(pool_size)
+        if self.hand >= pool_size:
+            self.hand = 0
+
+    def on_hit(self, buffer_id: int, page_id) -> None:
+        frame = self.frames[buffer_id]
+        frame.usage_count = min(frame.usage_count + 1, MAX_USAGE_COUNT)
+
+    def _insert(self, buffer_id: int, page_id) -> None:
+        self.frames[buffer_id].usage_count = 1
+
+    def _remove(self, buffer_id: int, page_id, evicted: bool) -> None:
+        self.frames[buffer_id].usage_count = 0
+
+    def _victim(self, page_id) -> Optional[int]:
+        pool_size = len(self.frames)
+        for _ in range((MAX_USAGE_COUNT + 1) * pool_size + 1):
+            buffer_id = self.hand
+            frame = self.frames[buffer_id]
+            # 次のフレームへ針を進める
+            self.hand = (buffer_id + 1) % pool_size
+            if frame.pin_count > 0:
+                continue
+            if frame.usage_count == 0:
+                return buffer_id
+            # 最近使われていたフレームは usage_count を減らして再度チャンスを与える
+            frame.usage_count -= 1
+        return None
+
+    def candidates(self) -> List[int]:
+        # 針の位置から1周する順で、usage_count が小さい(すぐに置換される)ものを先にする
+        pool_size = len(self.frames)
+        ring = [(self.hand + i) % pool_size for i in range(pool_size)]
+        ring = [buffer_id for buffer_id in ring if self.pages[buffer_id] is not None]
+        return sorted(ring, key=lambda buffer_id: self.frames[buffer_id].usage_count)
+
+
+class LRU(ReplacementPolicy):
+    """最後に使われてから最も時間が経ったページを追い出す"""
+    name = "lru"
+
+    def attach(self, frames: List) -> None:
+        super().attach(frames)
+        self.order: 'OrderedDict[int, None]' = OrderedDict()  # 先頭ほど古い
+
+    def on_hit(self, buffer_id: int, page_id) -> None:
+        self.order.move_to_end(buffer_id)
+
+    def _insert(self, buffer_id: int, page_id) -> None:
+        self.order[buffer_id] = None
+
+    def _remove(self, buffer_id: int, page_id, evicted: bool) -> None:
+        del self.order[buffer_id]
+
+    def _victim(self, page_id) -> Optional[int]:
+        return self._unpinned(self.order)
+
+    def candidates(self) -> List[int]:
+        return list(self.order)
+
+
+class LRUK(ReplacementPolicy):
+    """
+    LRU-K。最近 K 回のアクセスのうち最も古いもの(後ろ向き K 距離)が最も古いページを追い出す。
+    アクセスが K 回に満たないページは距離が無限大とみなして先に追い出し、その中では最後のアクセスが古いものを選ぶ。
+    1回だけ読まれるスキャンのページが、何度も使われるページを追い出さないようにできる。
+    追い出したページのアクセス履歴も history_size 個まで覚えておき、すぐ読み直されたときに使う。
+    置換対象を選ぶときに全フレームを調べるので、1回あたりのコストはフレーム数に比例する。
+    """
+    name = "lru-k"
+
+    def __init__(self, k: int = 2, history_size: Optional[int] = None):
+        self.k = k
+        self.history_size = history_size
+
+    def attach(self, frames: List) -> None:
+        super().attach(frames)
+        self.clock = 0  # アクセスごとに1増える論理時刻
+        self.history: Dict[object, Deque[int]] = {}  # 載っているページ -> 最近 K 回のアクセス時刻
+        self.retained: 'OrderedDict[object, Deque[int]]' = OrderedDict()  # 追い出したページの履歴
+        self.max_retained = self.history_size if self.history_size is not None else len(frames)
+
+    def resize(self, pool_size: int) -> None:
+        super().resize(pool_size)
+        if self.history_size is None:
+            self.max_retained = pool_size
+            while len(self.retained) > self.max_retained:
+                self.retained.popitem(last=False)
+
+    def _access(self, page_id) -> None:
+        self.clock += 1
+        self.history[page_id].append(self.clock)
+
+    def on_hit(self, buffer_id: int, page_id) -> None:
+        self._access(page_id)
+
+    def _insert(self, buffer_id: int, page_id) -> None:
+        history = self.retained.pop(page_id, None)
+        self.history[page_id] = history if history is not None else deque(maxlen=self.k)
+        self._access(page_id)
+
+    def _remove(self, buffer_id: int, page_id, evicted: bool) -> None:
+        history = self.history.pop(page_id)
+        if evicted and self.max_retained > 0:
+            self.retained[page_id] = history
+            if len(self.retained) > self.max_retained:
+                self.retained.popitem(last=False)
+
+    def _victim(self, page_id) -> Optional[int]:
+        best_id = None
+        best = None
+        for buffer_id, frame in enumerate(self.frames):
+            if frame.pin_count > 0 or self.pages[buffer_id] is None:
+                continue
+            history = self.history[self.pages[buffer_id]]
+            key = self._key(history)
+            if best is None or key < best:
+                best_id, best = buffer_id, key
+        return best_id
+
+    def _key(self, history: Deque[int]):
+        # (K回アクセスされているか, K回前のアクセス時刻, 最後のアクセス時刻) が最小のものを追い出す
+        return (len(history) == self.k, history[0], history[-1])
+
+    def candidates(self) -> List[int]:
+        resident = [buffer_id for buffer_id in range(len(self.frames)) if self.pages[buffer_id] is not None]
+        return sorted(resident, key=lambda buffer_id: self._key(self.history[self.pages[buffer_id]]))
+
+
+class TwoQ(ReplacementPolicy):
+    """
+    2Q (Johnson & Shasha)。初めて読まれたページは FIFO の A1in に入れ、
+    A1in から追い出したページのIDを A1out に覚えておく。A1out に居る間にもう一度読まれたページだけを
+    LRU の Am に入れるので、1回しか読まれないスキャンのページは Am を汚さない。
+    kin, kout はフレーム数に対する A1in, A1out の大きさの割合。
+    """
+    name = "2q"
+
+    def __init__(self, kin: float = 0.25, kout: float = 0.5):
+        self.kin = kin
+        self.kout = kout
+
+    def attach(self, frames: List) -> None:
+        super().attach(frames)
+        self.a1in: 'OrderedDict[int, None]' = OrderedDict()     # 先頭ほど古い(FIFO)
+        self.am: 'OrderedDict[int, None]' = OrderedDict()       # 先頭ほど古い(LRU)
+        self.a1out: 'OrderedDict[object, None]' = OrderedDict()  # 追い出したページID(FIFO)
+        self._set_sizes(len(frames))
+
+    def resize(self, pool_size: int) -> None:
+        super().resize(pool_size)
+        self._set_sizes(pool_size)
+        while len(self.a1out) > self.max_a1out:
+            self.a1out.popitem(last=False)
+
+    def _set_sizes(self, pool_size: int) -> None:
+        self.max_a1in = max(1, int(pool_size * self.kin))
+        self.max_a1out = max(1, int(pool_size * self.kout))
+
+    def on_hit(self, buffer_id: int, page_id) -> None:
+        # A1in のページは、短い間に繰り返し使われても相関のあるアクセスとみなして動かさない
+        if buffer_id in self.am:
+            self.am.move_to_end(buffer_id)
+
+    def _insert(self, buffer_id: int, page_id) -> None:
+        if page_id in self.a1out:
+            del self.a1out[page_id]
+            self.am[buffer_id] = None
+        else:
+            self.a1in[buffer_id] = None
+
+    def _remove(self, buffer_id: int, page_id, evicted: bool) -> None:
+        if buffer_id in self.a1in:
+            del self.a1in[buffer_id]
+            if evicted:
+                self.a1out[page_id] = None
+                if len(self.a1out) > self.max_a1out:
+                    self.a1out.popitem(last=False)
+        else:
+            del self.am[buffer_id]
+
+    def _queues(self):
+        # A1in が大きすぎれば A1in から、そうでなければ Am から追い出す
+        if len(self.a1in) > self.max_a1in:
+            return self.a1in, self.am
+        return self.am, self.a1in
+
+    def _victim(self, page_id) -> Optional[int]:
+        first, second = self._queues()
+        buffer_id = self._unpinned(first)
+        return buffer_id if buffer_id is not None else self._unpinned(second)
+
+    def candidates(self) -> List[int]:
+        first, second = self._queues()
+        return list(first) + list(second)
+
+
+class ARC(ReplacementPolicy):
+    """
+    ARC (Megiddo & Modha)。1回だけ使われたページの T1 と2回以上使われたページの T2 を LRU で持ち、
+    それぞれから追い出したページIDを B1, B2 に覚えておく。
+    B1 のページが読み直されたら T1 の目標の大きさ p を増やし、B2 なら減らして、
+    最近性と頻度のどちらを重視するかをアクセスパターンに合わせて自動で調整する。
+    """
+    name = "arc"
+
+    def attach(self, frames: List) -> None:
+        super().attach(frames)
+        self.capacity = len(frames)
+        self.p = 0.0  # T1 の目標の大きさ
+        self.t1: 'OrderedDict[int, None]' = OrderedDict()  # 先頭ほど古い
+        self.t2: 'OrderedDict[int, None]' = OrderedDict()
+        self.b1: 'OrderedDict[object, None]' = OrderedDict()
+        self.b2: 'OrderedDict[object, None]' = OrderedDict()
+
+    def resize(self, pool_size: int) -> None:
+        super().resize(pool_size)
+        self.capacity = pool_size
+        self.p = min(self.p, float(pool_size))
+        # 覚えておくページIDを新しい大きさに合わせて減らす
+        while self.b1 and len(self.t1) + len(self.b1) > self.capacity:
+            self.b1.popitem(last=False)
+        while self.b2 and len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2) > 2 * self.capacity:
+            self.b2.popitem(last=False)
+
+    def on_hit(self, buffer_id: int, page_id) -> None:
+        self.t1.pop(buffer_id, None)
+        self.t2.pop(buffer_id, None)
+        self.t2[buffer_id] = None
+
+    def _insert(self, buffer_id: int, page_id) -> None:
+        if page_id in self.b1:
+            # 最近追い出したばかりのページが読み直されたので、T1 を大きくする
+            self.p = min(self.capacity, self.p + max(len(self.b2) / len(self.b1), 1))
+            del self.b1[page_id]
+            self.t2[buffer_id] = None
+        elif page_id in self.b2:
+            # 頻繁に使われていたページが読み直されたので、T2 を大きくする
+            self.p = max(0.0, self.p - max(len(self.b1) / len(self.b2), 1))
+            del self.b2[page_id]
+            self.t2[buffer_id] = None
+        else:
+            self.t1[buffer_id] = None
+        # 覚えておくページIDは、T1 + B1 がフレーム数、全体でフレーム数の2倍まで
+        while self.b1 and len(self.t1) + len(self.b1) > self.capacity:
+            self.b1.popitem(last=False)
+        while self.b2 and len(self.t1) + len(self.t2) + len(self.b1) + len(self.b2) > 2 * self.capacity:
+            self.b2.popitem(last=False)
+
+    def _remove(self, buffer_id: int, page_id, evicted: bool) -> None:
+        if buffer_id in self.t1:
+            del self.t1[buffer_id]
+            ghost = self.b1
+        else:
+            del self.t2[buffer_id]
+            ghost = self.b2
+        if evicted:
+            ghost[page_id] = None
+
+    def _lists(self, page_id):
+        # T1 が目標の大きさ p を超えていれば T1 から、そうでなければ T2 から追い出す
+        if self.t1 and (len(self.t1) > self.p or (page_id in self.b2 and len(self.t1) == int(self.p))):
+            return self.t1, self.t2
+        return self.t2, self.t1
+
+    def _victim(self, page_id) -> Optional[int]:
+        first, second = self._lists(page_id)
+        buffer_id = self._unpinned(first)
+        return buffer_id if buffer_id is not None else self._unpinned(second)
+
+    def candidates(self) -> List[int]:
+        first, second = self._lists(None)
+        return list(first) + list(second)
+
+
+# 名前から置換アルゴリズムを作るための表
+POLICIES = {
+    ClockSweep.name: ClockSweep,
+    LRU.name: LRU,
+    LRUK.name: LRUK,
+    TwoQ.name: TwoQ,
+    ARC.name: ARC,
+}
@@ -0,0 +1,125 @@
+import time
+import threading
+from typing import Callable, Dict, Optional
+
+"""
+I/Oの計測(カウンタとレイテンシのヒストグラム)
+なぜ: バッファのヒット率やディスクI/Oの回数・時間が分からないと、バッファプールの大きさや置換アルゴリズムを評価できない
+どうやって: 操作ごとの回数をカウンタで、所要時間を2のべき乗ごとのバケットのヒストグラムで数える
+計測は enable_stats() を呼んだときだけ有効になり、無効なときはほとんどコストがかからない
+トレースフックを渡すと、操作ごとに hook(操作名, ページID, 所要秒数) が呼ばれる
+"""
+
+# ヒストグラムのバケット数。バケットiは 2**(i-1) 以上 2**i 未満マイクロ秒(最後のバケットはそれ以上すべて)
+NUM_LATENCY_BUCKETS = 26
+
+TraceHook = Callable[[str, object, float], None]
+
+
+class LatencyHistogram:
+    """所要時間を 2のべき乗マイクロ秒ごとのバケットで数えるヒストグラム"""
+    def __init__(self):
+        self.buckets = [0] * NUM_LATENCY_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        """所要時間(秒)を1つ記録する"""
+        bucket = min(int(seconds * 1_000_000).bit_length(), NUM_LATENCY_BUCKETS - 1)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p: float) -> float:
+        """p(0〜100)パーセンタイルの近似値(そのバケットの上限, 秒)を返す"""
+        if self.count == 0:
+            return 0.0
+        threshold = self.count * p / 100
+        seen = 0
+        for bucket, n in enumerate(self.buckets):
+            seen += n
+            if seen >= threshold:
+                return min((2 ** bucket) / 1_000_000, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        """現在の値を辞書で返す"""
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "max": self.max,
+            # バケットの上限(マイクロ秒) -> 回数
+            "buckets": {2 ** i: n for i, n in enumerate(self.buckets) if n},
+        }
+
+
+class IOStats:
+    """
+    カウンタとレイテンシのヒストグラムをまとめて持つクラス。
+    マルチスレッドから使う場合も排他はしないので、カウンタは近似値になりうる。
+    """
+    def __init__(self, trace_hook: Optional[TraceHook] = None):
+        self.counters: Dict[str, int] = {}
+        self.latencies: Dict[str, LatencyHistogram] = {}
+        self.trace_hook = trace_hook
+        self._local = threading.local()
+
+    def count(self, name: str, n: int = 1) -> None:
+        """カウンタ name を n 増やす"""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def event(self, name: str, page_id) -> None:
+        """時間を測らない出来事(ヒットなど)を数え、トレースフックがあれば呼ぶ"""
+        self.counters[name] = self.counters.get(name, 0) + 1
+        if self.trace_hook is not None:
+            self.trace_hook(name, page_id, 0.0)
+
+    def record(self, op: str, page_id, seconds: float) -> None:
+        """操作 op の所要時間を記録し、トレースフックがあれば呼ぶ"""
+        histogram = self.latencies.get(op)
+        if histogram is None:
+            histogram = self.latencies[op] = LatencyHistogram()
+        histogram.record(seconds)
+        if self.trace_hook is not None:
+            self.trace_hook(op, page_id, seconds)
+
+    def wrap(self, op: str, func: Callable, pages_of: Optional[Callable] = None) -> Callable:
+        """
+        func を呼び出すたびに op の回数と所要時間を記録する関数を返す。
+        pages_of を渡すと、引数から求めたページ数を "<op>_pages" に数える。
+        ラップした関数の中から別のラップした関数が呼ばれた場合は、一番外側の呼び出しだけを数える。
+        """
+        local = self._local
+
+        def wrapper(*args):
+            if getattr(local, 'depth', 0):
+                return func(*args)
+            local.depth = 1
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                elapsed = time.perf_counter() - start
+                local.depth = 0
+                self.count(op)
+                if pages_of is not None:
+                    pages = pages_of(*args)
+                    self.count(op + "_pages", len(pages))
+                    page_id = pages[0][0] if len(pages) == 1 else None
+                else:
+                    page_id = args[0] if args else None
+                self.record(op, page_id, elapsed)
+        return wrapper
+
+    def snapshot(self) -> dict:
+        """カウンタとヒストグラムの現在の値を辞書で返す"""
+        return {
+            "counters": dict(self.counters),
+            "latency": {op: histogram.snapshot() for op, histogram in self.latencies.items()},
+        }
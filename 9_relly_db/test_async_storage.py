@@ -0,0 +1,140 @@
+import asyncio
+import os
+import struct
+import tempfile
+from buffer import BufferPool, BufferPoolManager
+from disk import DiskManager, PAGE_SIZE
+from btree import BPlusTree, SearchMode
+from async_storage import AsyncBPlusTree, AsyncBufferPoolManager
+
+def test_async_fetch_page_single_flight():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        page_id = disk.allocate_page()
+        disk.write_page_data(page_id, bytearray(b"hello") + bytearray(PAGE_SIZE - 5))
+
+        reads = []
+        read_pages = disk.read_pages
+        def counting_read_pages(pages):
+            reads.append([page_id for page_id, _ in pages])
+            read_pages(pages)
+        disk.read_pages = counting_read_pages
+
+        async def run():
+            bufmgr = AsyncBufferPoolManager(BufferPoolManager(disk, BufferPool(4)))
+            try:
+                # 同じページへの同時のミスは1回の読み込みにまとめられる
+                buffers = await asyncio.gather(*[bufmgr.fetch_page(page_id) for _ in range(10)])
+                assert all(buffer is buffers[0] for buffer in buffers)
+                assert buffers[0].page[:5] == b"hello"
+                # ヒットはディスクを読まない
+                await bufmgr.fetch_page(page_id)
+            finally:
+                bufmgr.close()
+
+        asyncio.run(run())
+        assert reads == [[page_id]]
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_async_btree():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        sync_bufmgr = BufferPoolManager(disk, BufferPool(64))
+        btree = BPlusTree.create(sync_bufmgr)
+
+        async def run():
+            bufmgr = AsyncBufferPoolManager(sync_bufmgr)
+            tree = AsyncBPlusTree(btree, bufmgr)
+            try:
+                for i in (6, 3, 8, 4, 1, 7, 2, 5):
+                    await tree.insert(struct.pack('>Q', i), b"value%d" % i)
+                await bufmgr.flush()
+                results = await asyncio.gather(*[tree.search(SearchMode.Key(struct.pack('>Q', i))) for i in range(1, 9)])
+                for i, (key, value) in enumerate(results, start=1):
+                    assert struct.unpack('>Q', key)[0] == i
+                    assert value == b"value%d" % i
+                assert await tree.search(SearchMode.Key(struct.pack('>Q', 9))) is None
+            finally:
+                bufmgr.close()
+
+        asyncio.run(run())
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_async_split_waits_for_sibling_write_back():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    def key_of(i):
+        return struct.pack('>Q', i)
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        sync_bufmgr = BufferPoolManager(disk, BufferPool(8))
+        # リーフは [0, 10, 20](満杯), [30, 40], [50, 60] になる
+        big = bytes(1340)
+        btree = BPlusTree.bulk_load(sync_bufmgr, [(key_of(i), big) for i in range(0, 70, 10)], fill_factor=1.0)
+        extra_page_ids = [sync_bufmgr.disk.allocate_page() for _ in range(16)]
+        sync_bufmgr.flush(verbose=False)
+        next_leaf = btree.find_leaf(sync_bufmgr, key_of(30))
+
+        async def fetch_and_unpin(bufmgr, page_id):
+            buffer = await bufmgr.fetch_page(page_id)
+            bufmgr.unpin_page(buffer.page_id)
+
+        async def run():
+            bufmgr = AsyncBufferPoolManager(sync_bufmgr)
+            tree = AsyncBPlusTree(btree, bufmgr)
+            # 書き戻しを(ディスクの io_lock を取る前に)止めておけるようにする
+            gate = asyncio.Event()
+            gate.set()
+            write_pages = bufmgr.disk.write_pages
+            async def gated_write_pages(pages):
+                await gate.wait()
+                await write_pages(pages)
+            bufmgr.disk.write_pages = gated_write_pages
+            try:
+                # 次のリーフだけを dirty にして、その書き戻しが終わらないうちに追い出させる
+                await tree.insert(key_of(35), b"new")
+                await bufmgr.flush()
+                await tree.insert(key_of(45), b"newer")
+                gate.clear()
+                evicting = None
+                for page_id in extra_page_ids:
+                    evicting = asyncio.ensure_future(fetch_and_unpin(bufmgr, page_id))
+                    await asyncio.wait([evicting], timeout=0.2)
+                    if next_leaf in bufmgr.writing:
+                        break
+                assert next_leaf in bufmgr.writing and next_leaf not in sync_bufmgr.page_table
+
+                # 書き戻し中に、そのページを次のリーフに持つ満杯のリーフを分割する
+                asyncio.get_running_loop().call_later(0.2, gate.set)
+                await tree.insert(key_of(5), bytes(100))
+                await evicting
+                await bufmgr.flush()
+            finally:
+                gate.set()
+                bufmgr.close()
+
+        asyncio.run(run())
+
+        # 書き戻した内容が、分割で古い内容に上書きされていない
+        disk.close()
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(16))
+        tree = BPlusTree(btree.meta_page_id)
+        assert tree.get(bufmgr, key_of(45)) == (key_of(45), b"newer")
+        assert [key for key, _ in tree.search(bufmgr, SearchMode.Start())] == \
+            [key_of(i) for i in (0, 5, 10, 20, 30, 35, 40, 45, 50, 60)]
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
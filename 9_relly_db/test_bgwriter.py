@@ -0,0 +1,82 @@
+import os
+import tempfile
+import time
+from bgwriter import BackgroundWriter
+from buffer import BufferPool, BufferPoolManager
+from disk import DiskManager, PAGE_SIZE
+
+def test_background_writer_round():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(8))
+        bufmgr.enable_stats()
+        page_ids = []
+        for i in range(6):
+            with bufmgr.create_page() as buffer:
+                buffer.page[:1] = bytes([i + 1])
+                page_ids.append(buffer.page_id)
+        pinned = bufmgr.fetch_page(page_ids[0])
+
+        writer = BackgroundWriter(bufmgr, max_pages=3, interval=60)
+
+        # 書き込み中に変更されたページは dirty のまま残す
+        write_pages = disk.write_pages
+        def write_pages_and_modify(pages):
+            write_pages(pages)
+            with bufmgr.fetch_page(pages[0][0]) as buffer:
+                buffer.page[1:2] = b"x"
+        disk.write_pages = write_pages_and_modify
+        assert writer.run_round() == 3
+        disk.write_pages = write_pages
+        # 残りの2ページと変更されたページを書く。ピン留めされたページは書かない
+        assert writer.run_round() == 3
+        assert writer.run_round() == 0
+
+        assert pinned.is_dirty
+        for i, page_id in enumerate(page_ids[1:], start=1):
+            with bufmgr.fetch_page(page_id) as buffer:
+                assert not buffer.is_dirty
+            read_page = bytearray(PAGE_SIZE)
+            disk.read_page_data(page_id, read_page)
+            assert read_page[:1] == bytes([i + 1])
+        assert bufmgr.stats()["counters"]["bgwriter_pages"] == 6
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_background_writer_thread_keeps_victims_clean():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(4))
+        bufmgr.enable_stats()
+        bufmgr.start_background_writer(max_pages=4, interval=0.01)
+        try:
+            page_ids = []
+            for i in range(4):
+                with bufmgr.create_page() as buffer:
+                    buffer.page[:1] = bytes([i + 1])
+                    page_ids.append(buffer.page_id)
+            deadline = time.monotonic() + 5
+            while any(bufmgr.pool.buffers[bufmgr.page_table[page_id].buffer_id].buffer.is_dirty for page_id in page_ids):
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            # 置換対象は clean なので、置換で書き戻しは起きない
+            with bufmgr.create_page():
+                pass
+            assert bufmgr.stats()["counters"].get("dirty_write_back", 0) == 0
+        finally:
+            bufmgr.stop_background_writer()
+
+        for i, page_id in enumerate(page_ids):
+            read_page = bytearray(PAGE_SIZE)
+            disk.read_page_data(page_id, read_page)
+            assert read_page[:1] == bytes([i + 1])
+
+    finally:
+        os.remove(temp_file_path)
@@ -1,6 +1,9 @@
 import os
+import struct
 import tempfile
-from buffer import BufferPool, BufferPoolManager, NoFreeBufferError
+import threading
+import pytest
+from buffer import BufferAccessStrategy, BufferError, BufferPool, BufferPoolManager, NoFreeBufferError
 from disk import DiskManager, PAGE_SIZE
 
 def test_buffer_pool_manager():
@@ -36,5 +39,338 @@ def test_buffer_pool_manager():
     finally:
         os.remove(temp_file_path)
 
+def test_evict_writes_back_adjacent_dirty_pages():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        pool = BufferPool(3)
+        bufmgr = BufferPoolManager(disk, pool)
+
+        page_ids = []
+        for i in range(3):
+            buffer = bufmgr.create_page()
+            buffer.page[:1] = bytes([i + 1])
+            bufmgr.unpin_page(buffer.page_id)
+            page_ids.append(buffer.page_id)
+
+        # 4ページ目の作成で置換が起き、連続するダーティページがまとめて書き戻される
+        # (置換されたページのフレームは4ページ目に使い回されるので、残っている2ページを調べる)
+        with bufmgr.create_page() as new_buffer:
+            evicted = [page_id for page_id in page_ids if page_id not in bufmgr.page_table]
+            assert len(evicted) == 1
+        assert all(not pool.buffers[bufmgr.page_table[page_id].buffer_id].buffer.is_dirty
+                   for page_id in page_ids if page_id in bufmgr.page_table)
+        assert new_buffer.is_dirty
+
+        for i, page_id in enumerate(page_ids):
+            read_page = bytearray(PAGE_SIZE)
+            disk.read_page_data(page_id, read_page)
+            assert read_page[:1] == bytes([i + 1])
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_free_page_is_reused():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        pool = BufferPool(2)
+        bufmgr = BufferPoolManager(disk, pool)
+
+        buffer1 = bufmgr.create_page()
+        buffer2 = bufmgr.create_page()
+        page1_id = buffer1.page_id
+        bufmgr.flush()
+
+        # ピン留めされているページは解放できない
+        with pytest.raises(BufferError):
+            bufmgr.free_page(page1_id)
+        bufmgr.unpin_page(page1_id)
+        bufmgr.free_page(page1_id)
+        assert page1_id not in bufmgr.page_table
+
+        # 解放したページIDが再利用され、解放したフレームが置換対象になる
+        buffer3 = bufmgr.create_page()
+        assert buffer3.page_id == page1_id
+        assert buffer2.page_id in bufmgr.page_table
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_buffer_pool_stats():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        pool = BufferPool(2)
+        bufmgr = BufferPoolManager(disk, pool)
+        assert bufmgr.stats() is None  # 有効にするまでは計測しない
+
+        events = []
+        bufmgr.enable_stats(trace_hook=lambda op, page_id, seconds: events.append(op))
+        page_ids = []
+        for _ in range(3):
+            with bufmgr.create_page() as buffer:
+                page_ids.append(buffer.page_id)
+        with bufmgr.fetch_page(page_ids[2]):   # ヒット
+            pass
+        with bufmgr.fetch_page(page_ids[0]):   # ミス(置換と書き戻しが起きる)
+            pass
+        bufmgr.flush()
+
+        stats = bufmgr.stats()
+        counters = stats["counters"]
+        assert counters["hit"] == 1
+        assert counters["miss"] == 1
+        assert counters["evict"] == 2
+        assert counters["dirty_write_back"] >= 1
+        assert stats["hit_ratio"] == 0.5
+        assert stats["latency"]["miss"]["count"] == 1
+        disk_counters = stats["disk"]["counters"]
+        assert disk_counters["sync"] == 1
+        assert disk_counters["read_pages"] == 1
+        assert "hit" in events and "miss" in events and "sync" in events
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_clock_sweep_ages_clean_frames_and_skips_pinned():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        page_ids = []
+        for i in range(8):
+            page_id = disk.allocate_page()
+            disk.write_page_data(page_id, bytes([i + 1]) + bytes(PAGE_SIZE - 1))
+            page_ids.append(page_id)
+
+        pool = BufferPool(3)
+        bufmgr = BufferPoolManager(disk, pool)
+        pinned = bufmgr.fetch_page(page_ids[0])
+        # cleanなページを何度も使っても、小さいバッファプールでスキャンを続けられる
+        for _ in range(3):
+            for i, page_id in enumerate(page_ids[1:], start=1):
+                with bufmgr.fetch_page(page_id) as buffer:
+                    assert buffer.page[:1] == bytes([i + 1])
+                with bufmgr.fetch_page(page_id):
+                    pass
+        # ピン留めされたページは追い出されない
+        assert page_ids[0] in bufmgr.page_table
+        assert pinned.page[:1] == b"\x01"
+
+        # 全フレームがピン留めされていれば置換できない
+        others = [bufmgr.fetch_page(page_id) for page_id in page_ids[1:3]]
+        with pytest.raises(NoFreeBufferError):
+            bufmgr.fetch_page(page_ids[3])
+        for buffer in others + [pinned]:
+            bufmgr.unpin_page(buffer.page_id)
+        with pytest.raises(BufferError):
+            bufmgr.unpin_page(page_ids[0])
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_sequential_read_ahead():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        page_ids = []
+        for i in range(32):
+            page_id = disk.allocate_page()
+            disk.write_page_data(page_id, bytes([i + 1]) + bytes(PAGE_SIZE - 1))
+            page_ids.append(page_id)
+
+        bufmgr = BufferPoolManager(disk, BufferPool(16))
+        bufmgr.enable_read_ahead(window=4)
+        try:
+            # 連続したページを順に読むと、先の方のページは先読み済みになっている
+            for i, page_id in enumerate(page_ids):
+                with bufmgr.fetch_page(page_id) as buffer:
+                    assert buffer.page[:1] == bytes([i + 1])
+            assert bufmgr.prefetch_hits >= 24
+            # 明示的な先読み
+            bufmgr.prefetch(page_ids[:4])
+            for i, page_id in enumerate(page_ids[:4]):
+                with bufmgr.fetch_page(page_id) as buffer:
+                    assert buffer.page[:1] == bytes([i + 1])
+        finally:
+            bufmgr.disable_read_ahead()
+        assert bufmgr.prefetch_hits + bufmgr.prefetch_waste <= bufmgr.prefetch_pages
+        assert not bufmgr.prefetching
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_ring_strategy_keeps_hot_pages():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        page_ids = []
+        for i in range(40):
+            page_id = disk.allocate_page()
+            disk.write_page_data(page_id, bytes([i + 1]) + bytes(PAGE_SIZE - 1))
+            page_ids.append(page_id)
+
+        bufmgr = BufferPoolManager(disk, BufferPool(8))
+        hot = page_ids[:4]
+        for page_id in hot * 2:
+            with bufmgr.fetch_page(page_id):
+                pass
+
+        # リングを使ったスキャンは、リングの2フレームだけを使い回す
+        strategy = BufferAccessStrategy(ring_size=2)
+        for i, page_id in enumerate(page_ids[4:], start=4):
+            with bufmgr.fetch_page(page_id, strategy) as buffer:
+                assert buffer.page[:1] == bytes([i + 1])
+        assert all(page_id in bufmgr.page_table for page_id in hot)
+        assert len(set(strategy.ring)) == 2
+
+        # リングを使わないスキャンは、よく使われるページも追い出す
+        for page_id in page_ids[4:]:
+            with bufmgr.fetch_page(page_id):
+                pass
+        assert not any(page_id in bufmgr.page_table for page_id in hot)
+
+    finally:
+        os.remove(temp_file_path)
+
+
+def test_frames_share_one_arena():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        pool = BufferPool(4)
+        bufmgr = BufferPoolManager(disk, pool)
+
+        # 各フレームのページはアリーナの固定の部分で、ページを入れ替えても同じ Buffer が使われる
+        assert len(pool.arenas) == 1
+        _, arena, _ = pool.arenas[0]
+        assert len(arena) == 4 * PAGE_SIZE
+        buffers = [frame.buffer for frame in pool.buffers]
+        for index, buffer in enumerate(buffers):
+            buffer.page[:1] = bytes([index + 1])
+            assert arena[index * PAGE_SIZE] == index + 1
+
+        page_ids = []
+        for i in range(8):
+            buffer = bufmgr.create_page()
+            buffer.page[:4] = struct.pack('>I', i)
+            bufmgr.unpin_page(buffer.page_id, is_dirty=True)
+            page_ids.append(buffer.page_id)
+        assert [frame.buffer for frame in pool.buffers] == buffers
+
+        # ディスクから読んだページはフレームのアリーナの部分にそのまま入る
+        for i, page_id in enumerate(page_ids):
+            with bufmgr.fetch_page(page_id) as buffer:
+                assert buffer in buffers
+                assert struct.unpack('>I', buffer.page[:4])[0] == i
+                offset = buffers.index(buffer) * PAGE_SIZE
+                assert arena[offset:offset + 4] == struct.pack('>I', i)
+        # 新しく作ったページは前のページの中身を引き継がない
+        with bufmgr.create_page() as buffer:
+            assert bytes(buffer.page) == bytes(PAGE_SIZE)
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+
+
+def test_resize_keeps_pages_and_waits_for_pinned_frames():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        pool = BufferPool(2)
+        bufmgr = BufferPoolManager(disk, pool)
+
+        # 増やしたフレームも使われ、既存のフレームはそのまま残る
+        first = pool.buffers[0].buffer
+        bufmgr.set_memory_budget(8 * PAGE_SIZE)
+        assert pool.size() == 8 and pool.memory_usage() == 8 * PAGE_SIZE
+        assert pool.buffers[0].buffer is first
+        page_ids = []
+        for i in range(8):
+            buffer = bufmgr.create_page()
+            buffer.page[:1] = bytes([i + 1])
+            bufmgr.unpin_page(buffer.page_id, is_dirty=True)
+            page_ids.append(buffer.page_id)
+        assert len(bufmgr.page_table) == 8
+
+        # 取り除くフレームのページがピン留めされている間は、ピンが外れるまで縮小を待つ
+        pinned_id = bufmgr.page_table[page_ids[7]]
+        assert pinned_id.buffer_id >= 3
+        pinned = bufmgr.fetch_page(page_ids[7])
+        with pytest.raises(BufferError):
+            bufmgr.resize(3, timeout=0.05)
+        assert pool.size() == 8
+
+        resizer = threading.Thread(target=bufmgr.resize, args=(3,))
+        resizer.start()
+        while not bufmgr.shrinking:
+            resizer.join(0.01)
+        # 縮小を待っている間も他のページは読める
+        with bufmgr.fetch_page(page_ids[0]) as buffer:
+            assert buffer.page[:1] == b"\x01"
+        bufmgr.unpin_page(pinned.page_id)
+        resizer.join()
+        assert pool.size() == 3 and len(pool.pin_counts) == 3
+        assert all(buffer_id.buffer_id < 3 for buffer_id in bufmgr.page_table.values())
+        with pytest.raises(ValueError):
+            pinned.page[:1]
+
+        # 追い出したページは書き戻されている
+        for i, page_id in enumerate(page_ids):
+            with bufmgr.fetch_page(page_id) as buffer:
+                assert buffer.page[:1] == bytes([i + 1])
+        with pytest.raises(BufferError):
+            bufmgr.resize(0)
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+
+def test_shrink_while_a_page_view_is_still_held():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        pool = BufferPool(2)
+        bufmgr = BufferPoolManager(disk, pool)
+        bufmgr.resize(6)
+        assert len(pool.arenas) == 2
+        # 取り除くフレームのページの一部を指す memoryview が残っていても、アリーナを閉じられないだけで縮小できる
+        held = pool.buffers[4].buffer.page[10:20]
+        bufmgr.resize(2)
+        assert pool.size() == 2 and len(pool.pin_counts) == 2 and len(pool.arenas) == 1
+        assert held[:] == bytes(10)
+
+        # 縮小した後も、残ったフレームでページを読み書きできる
+        page_ids = []
+        for i in range(4):
+            with bufmgr.create_page() as buffer:
+                buffer.page[:1] = bytes([i + 1])
+                buffer.is_dirty = True
+                page_ids.append(buffer.page_id)
+        for i, page_id in enumerate(page_ids):
+            with bufmgr.fetch_page(page_id) as buffer:
+                assert buffer.page[:1] == bytes([i + 1])
+        del held
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+
 if __name__ == "__main__":
     test_buffer_pool_manager()
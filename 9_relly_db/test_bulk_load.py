@@ -0,0 +1,166 @@
+import os
+import struct
+import tempfile
+import pytest
+from buffer import BufferPool, BufferPoolManager
+from disk import DiskManager, PageId, PAGE_SIZE
+from btree import BPlusTree, BTreeError, DuplicateKeyError, FORMAT_LINKED, FORMAT_PICKLE, Pair, SearchMode
+
+def key_of(i):
+    return struct.pack('>Q', i)
+
+@pytest.mark.parametrize("format_version", [FORMAT_PICKLE, FORMAT_LINKED])
+def test_bulk_load_builds_packed_contiguous_tree(format_version):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        # バッファプールより大きな入力を、ジェネレータから読みながら組み立てる
+        bufmgr = BufferPoolManager(disk, BufferPool(32))
+        num_keys = 8000
+        btree = BPlusTree.bulk_load(bufmgr, ((key_of(i), b"value-%d" % i) for i in range(0, num_keys * 2, 2)),
+                                    format_version=format_version)
+        bufmgr.flush(verbose=False)
+        disk.close()
+
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(64))
+        btree = BPlusTree(btree.meta_page_id)
+        for i in (0, 2, 1234, num_keys * 2 - 2):
+            assert btree.get(bufmgr, key_of(i)) == (key_of(i), b"value-%d" % i)
+        assert btree.format_version == format_version
+        assert btree.get(bufmgr, key_of(7)) is None
+        assert [key for key, _ in btree.search(bufmgr, SearchMode.Start())] == [key_of(i) for i in range(0, num_keys * 2, 2)]
+        cursor = btree.search(bufmgr, SearchMode.Key(key_of(num_keys * 2)))
+        assert cursor.prev()[0] == key_of(num_keys * 2 - 2)
+
+        # 子ページは親より前に、リーフはほぼ連続して確保される
+        leaf_page_ids = []
+        def walk(page_id):
+            with bufmgr.fetch_page(page_id) as buffer:
+                is_leaf = struct.unpack('>I', buffer.page[:4])[0] == 0
+                children = [] if is_leaf else btree.get_branch(buffer)[1]
+            if is_leaf:
+                leaf_page_ids.append(page_id.page_id)
+            for child in children:
+                assert child.page_id < page_id.page_id
+                walk(child)
+        with bufmgr.fetch_page(btree.meta_page_id) as meta_buffer:
+            walk(btree.read_meta(meta_buffer))
+        assert leaf_page_ids == sorted(leaf_page_ids)
+        assert leaf_page_ids[-1] - leaf_page_ids[0] < len(leaf_page_ids) * 1.05
+
+        # fill_factor まで詰めるので、昇順に挿入したツリーとほぼ同じページ数で済み、後から挿入もできる
+        pages = disk.next_page_id
+        inserted_disk = DiskManager.open(temp_file_path + ".insert")
+        inserted_bufmgr = BufferPoolManager(inserted_disk, BufferPool(256))
+        inserted = BPlusTree.create(inserted_bufmgr, format_version)
+        for i in range(0, num_keys * 2, 2):
+            inserted.insert(inserted_bufmgr, key_of(i), b"value-%d" % i)
+        assert pages <= inserted_disk.next_page_id * 1.05
+        inserted_disk.close()
+        btree.insert(bufmgr, key_of(1235), b"new")
+        assert btree.search_range(bufmgr, key_of(1234), key_of(1236)) == \
+            [(key_of(1234), b"value-1234"), (key_of(1235), b"new"), (key_of(1236), b"value-1236")]
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+        if os.path.exists(temp_file_path + ".insert"):
+            os.remove(temp_file_path + ".insert")
+
+def test_bulk_load_small_and_invalid_input():
+    class SmallTree(BPlusTree):
+        LEAF_NODE_MAX_PAIRS = 2
+        BRANCH_NODE_MAX_KEYS = 2
+
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(64))
+        # 空の入力は空のツリーになる
+        empty = BPlusTree.bulk_load(bufmgr, [])
+        assert empty.search_range(bufmgr, b"", b"\xff") == []
+
+        # ノードの大きさの上限が小さければ、何段ものブランチノードができる
+        deep = SmallTree.bulk_load(bufmgr, [(key_of(i), b"%d" % i) for i in range(50)], fill_factor=1.0)
+        assert [key for key, _ in deep.search(bufmgr, SearchMode.Start())] == [key_of(i) for i in range(50)]
+        for i in range(50):
+            assert deep.get(bufmgr, key_of(i)) == (key_of(i), b"%d" % i)
+
+        with pytest.raises(DuplicateKeyError):
+            BPlusTree.bulk_load(bufmgr, [(key_of(1), b""), (key_of(1), b"")])
+        with pytest.raises(BTreeError):
+            BPlusTree.bulk_load(bufmgr, [(key_of(2), b""), (key_of(1), b"")])
+        # 途中で失敗してもページのピンは残らない
+        assert all(frame.pin_count == 0 for frame in bufmgr.pool.buffers)
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+
+def node_shapes(bufmgr, btree):
+    """ツリーのノードを (深さ, リーフか, エントリ数, エントリのバイト数) のリストにして返す"""
+    shapes = []
+    def walk(page_id, depth):
+        with bufmgr.fetch_page(page_id) as buffer:
+            if struct.unpack('>I', buffer.page[:4])[0] == 0:
+                pairs = btree.get_pairs(buffer)
+                shapes.append((depth, True, len(pairs), sum(btree.pair_size(pair) for pair in pairs)))
+                return
+            keys, children = btree.get_branch(buffer)
+        assert len(children) == len(keys) + 1
+        shapes.append((depth, False, len(keys), sum(btree.key_size(bytes(key)) for key in keys)))
+        for child in children:
+            walk(child, depth + 1)
+    with bufmgr.fetch_page(btree.meta_page_id) as meta_buffer:
+        walk(btree.read_meta(meta_buffer), 0)
+    return shapes
+
+def test_bulk_load_keeps_tail_nodes_at_minimum_fill():
+    class SmallTree(BPlusTree):
+        LEAF_NODE_MAX_PAIRS = 8
+        BRANCH_NODE_MAX_KEYS = 8
+
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(64))
+        # どの数でも、最後のリーフやブランチノードが1つ前のノードと釣り合うように分けられる
+        for num_keys in list(range(1, 120)) + [729, 730, 6562]:
+            btree = SmallTree.bulk_load(bufmgr, [(key_of(i), b"v") for i in range(num_keys)], fill_factor=1.0)
+            shapes = node_shapes(bufmgr, btree)
+            leaf_depths = {depth for depth, is_leaf, _, _ in shapes if is_leaf}
+            assert len(leaf_depths) == 1
+            for depth, is_leaf, count, _ in shapes:
+                if depth == 0:
+                    # ルートは子が2つ以上のブランチか、唯一のリーフ
+                    assert is_leaf or count >= 1
+                elif is_leaf:
+                    assert 4 <= count <= 8
+                else:
+                    assert 4 <= count <= 8
+            assert sum(count for _, is_leaf, count, _ in shapes if is_leaf) == num_keys
+            assert btree.get(bufmgr, key_of(num_keys - 1)) == (key_of(num_keys - 1), b"v")
+
+        # バイト数で詰める場合も、ルート以外のノードは予算の半分近く(エントリ1つ分の誤差まで)埋まる
+        sizer = BPlusTree(PageId(0), FORMAT_LINKED)
+        pair_size, key_size = sizer.pair_size(Pair(key_of(0), bytes(100))), sizer.key_size(key_of(0))
+        leaf_budget = (PAGE_SIZE - sizer.leaf_header_size()) * 0.9
+        branch_budget = (PAGE_SIZE - sizer.branch_header_size()) * 0.9
+        for num_keys in (30, 31, 32, 33, 3000, 3001, 3030):
+            btree = BPlusTree.bulk_load(bufmgr, ((key_of(i), bytes(100)) for i in range(num_keys)), fill_factor=0.9)
+            shapes = node_shapes(bufmgr, btree)
+            for depth, is_leaf, count, size in shapes:
+                assert size <= (leaf_budget if is_leaf else branch_budget)
+                if depth > 0:
+                    assert size >= (leaf_budget / 2 - pair_size if is_leaf else branch_budget / 2 - key_size)
+                if not is_leaf:
+                    assert count >= 1
+            assert [key for key, _ in btree.search(bufmgr, SearchMode.Start())] == [key_of(i) for i in range(num_keys)]
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
@@ -0,0 +1,133 @@
+import os
+import tempfile
+import threading
+import time
+from buffer import BufferPool, BufferPoolManager
+from checkpoint import CHECKPOINT_BEGIN, CHECKPOINT_END, CHECKPOINT_INCOMPLETE, Checkpointer, checkpoint_log_path, \
+    last_completed_checkpoint, read_checkpoint_log
+from disk import DiskManager, PAGE_SIZE
+
+def test_checkpoint_paces_writes_and_records_begin_end():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+    log_path = checkpoint_log_path(temp_file_path)
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(16))
+        page_ids = []
+        for i in range(10):
+            with bufmgr.create_page() as buffer:
+                buffer.page[:1] = bytes([i + 1])
+                page_ids.append(buffer.page_id)
+        pinned = bufmgr.fetch_page(page_ids[0])
+
+        writes = []
+        write_pages = disk.write_pages
+        def record_write_pages(pages):
+            writes.append((time.monotonic(), len(pages)))
+            write_pages(pages)
+        disk.write_pages = record_write_pages
+
+        # 使用中のページは使い終わるまで書かずに待つ
+        threading.Timer(0.1, bufmgr.unpin_page, args=(pinned.page_id,)).start()
+        checkpointer = Checkpointer(bufmgr, log_path, batch_pages=3)
+        start = time.monotonic()
+        assert checkpointer.run_checkpoint(duration=0.2) == 10
+        # 書き込みは目標時間に散らばり、1回に書くのは batch_pages ページまで
+        assert time.monotonic() - start >= 0.18
+        assert len(writes) >= 4 and all(count <= 3 for _, count in writes)
+        assert writes[-1][0] - writes[0][0] >= 0.1
+        assert not any(frame.buffer.is_dirty for frame in bufmgr.pool.buffers)
+        for i, page_id in enumerate(page_ids):
+            data = bytearray(PAGE_SIZE)
+            disk.read_page_data(page_id, data)
+            assert data[:1] == bytes([i + 1])
+
+        records = read_checkpoint_log(log_path)
+        assert [(record.kind, record.checkpoint_no, record.pages) for record in records] == \
+            [(CHECKPOINT_BEGIN, 1, 10), (CHECKPOINT_END, 1, 10)]
+
+        # 番号はログの続きから振られる
+        assert Checkpointer(bufmgr, log_path).run_checkpoint() == 0
+        assert last_completed_checkpoint(log_path).checkpoint_no == 2
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+        if os.path.exists(log_path):
+            os.remove(log_path)
+
+def test_checkpoint_gives_up_on_a_page_pinned_throughout():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+    log_path = checkpoint_log_path(temp_file_path)
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(8))
+        bufmgr.enable_stats()
+        page_ids = []
+        for i in range(5):
+            with bufmgr.create_page() as buffer:
+                buffer.page[:1] = bytes([i + 1])
+                page_ids.append(buffer.page_id)
+        # チェックポイントの間ずっとピン留めしたままのページ
+        pinned = bufmgr.fetch_page(page_ids[2])
+
+        checkpointer = Checkpointer(bufmgr, log_path, batch_pages=2, pin_wait=0.1)
+        start = time.monotonic()
+        assert checkpointer.run_checkpoint(duration=0.05) is None
+        # 目標時間 + pin_wait で諦め、いつまでも待ち続けない
+        assert time.monotonic() - start < 1.0
+        assert checkpointer.skipped_pages == [page_ids[2]]
+        # 他のページは書き戻されて同期され、使用中のページだけ dirty のまま残る
+        assert [bufmgr.pool.buffers[bufmgr.page_table[page_id].buffer_id].buffer.is_dirty
+                for page_id in page_ids] == [False, False, True, False, False]
+        data = bytearray(PAGE_SIZE)
+        disk.read_page_data(page_ids[4], data)
+        assert data[:1] == bytes([5])
+
+        # 未完了レコードを書き、完了したチェックポイントとしては扱わない
+        records = read_checkpoint_log(log_path)
+        assert [(record.kind, record.pages) for record in records] == [(CHECKPOINT_BEGIN, 5), (CHECKPOINT_INCOMPLETE, 1)]
+        assert last_completed_checkpoint(log_path) is None
+        assert bufmgr.stats()["counters"]["checkpoints_incomplete"] == 1
+
+        # ピンが外れれば次のチェックポイントで書かれて完了する
+        bufmgr.unpin_page(pinned.page_id)
+        assert checkpointer.run_checkpoint() == 1
+        assert checkpointer.skipped_pages == []
+        assert last_completed_checkpoint(log_path).checkpoint_no == 2
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+        if os.path.exists(log_path):
+            os.remove(log_path)
+
+def test_checkpointer_thread_and_quiet_flush(capsys):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(8))
+        bufmgr.enable_stats()
+        bufmgr.start_checkpointer(interval=0.05, completion_target=0.5)
+        for i in range(6):
+            with bufmgr.create_page() as buffer:
+                buffer.page[:1] = bytes([i + 1])
+        deadline = time.monotonic() + 5
+        while any(frame.buffer.is_dirty for frame in bufmgr.pool.buffers) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        bufmgr.stop_checkpointer()
+        assert not any(frame.buffer.is_dirty for frame in bufmgr.pool.buffers)
+        assert bufmgr.stats()["counters"]["checkpoint_pages"] == 6
+
+        buffer = bufmgr.fetch_page(buffer.page_id)
+        buffer.page[:1] = b"x"
+        bufmgr.unpin_page(buffer.page_id, is_dirty=True)
+        bufmgr.flush(verbose=False)
+        assert capsys.readouterr().out == ""
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
@@ -0,0 +1,191 @@
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+import pytest
+from buffer import BufferPool, NoFreeBufferError
+from concurrent_buffer import ConcurrentBufferPoolManager
+from disk import DiskManager, PAGE_SIZE
+from replacement import POLICIES
+
+def test_concurrent_fetch_single_flight():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        page_id = disk.allocate_page()
+        disk.write_page_data(page_id, b"hello" + bytes(PAGE_SIZE - 5))
+
+        reads = []
+        read_pages = disk.read_pages
+        def slow_read_pages(pages):
+            reads.append([page_id for page_id, _ in pages])
+            time.sleep(0.05)
+            read_pages(pages)
+        disk.read_pages = slow_read_pages
+
+        bufmgr = ConcurrentBufferPoolManager(disk, BufferPool(4))
+        barrier = threading.Barrier(8)
+        results = []
+        def reader():
+            barrier.wait()
+            with bufmgr.fetch_page(page_id) as buffer:
+                with bufmgr.shared(buffer):
+                    results.append(bytes(buffer.page[:5]))
+        threads = [threading.Thread(target=reader) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 同じページへの同時のミスは1回の読み込みにまとめられる
+        assert reads == [[page_id]]
+        assert results == [b"hello"] * 8
+
+    finally:
+        os.remove(temp_file_path)
+
+@pytest.mark.parametrize("policy_name", ["clock", "lru"])
+def test_concurrent_stress(policy_name):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        num_pages = 64
+        page_ids = []
+        for i in range(num_pages):
+            page_id = disk.allocate_page()
+            # 先頭8バイトはページ番号、次の8バイトは加算した回数
+            disk.write_page_data(page_id, struct.pack('>QQ', page_id.page_id, 0) + bytes(PAGE_SIZE - 16))
+            page_ids.append(page_id)
+
+        # ページ数より小さいバッファプールで、置換と書き戻しを繰り返し起こす
+        policy = POLICIES[policy_name]()
+        bufmgr = ConcurrentBufferPoolManager(disk, BufferPool(16, policy), num_shards=4)
+        num_threads = 8
+        iterations = 400
+        increments = [0] * num_threads
+        errors = []
+
+        def worker(n):
+            rng = random.Random(n)
+            try:
+                for _ in range(iterations):
+                    page_id = rng.choice(page_ids)
+                    with bufmgr.fetch_page(page_id) as buffer:
+                        if rng.random() < 0.3:
+                            with bufmgr.exclusive(buffer):
+                                page_no, count = struct.unpack('>QQ', buffer.page[:16])
+                                buffer.page[:16] = struct.pack('>QQ', page_no, count + 1)
+                                buffer.is_dirty = True
+                            increments[n] += 1
+                        else:
+                            with bufmgr.shared(buffer):
+                                page_no, _ = struct.unpack('>QQ', buffer.page[:16])
+                        assert page_no == page_id.page_id
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+        bufmgr.flush()
+
+        # 加算が1回も失われていない
+        total = 0
+        data = bytearray(PAGE_SIZE)
+        for page_id in page_ids:
+            disk.read_page_data(page_id, data)
+            page_no, count = struct.unpack('>QQ', data[:16])
+            assert page_no == page_id.page_id
+            total += count
+        assert total == sum(increments)
+        assert all(frame.pin_count == 0 for frame in bufmgr.pool.buffers)
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_flush_does_not_overwrite_newer_evicted_page():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = ConcurrentBufferPoolManager(disk, BufferPool(2))
+        with bufmgr.create_page() as buffer:
+            with bufmgr.exclusive(buffer):
+                buffer.page[:2] = b"v1"
+            page_id = buffer.page_id
+
+        # flush のスレッドだけ、ページを写し取った後の io_lock の前で止める
+        class GatedLock:
+            def __init__(self, lock):
+                self.lock = lock
+                self.reached = threading.Event()
+                self.go = threading.Event()
+                self.gated_thread = None
+            def __enter__(self):
+                if threading.current_thread() is self.gated_thread and not self.go.is_set():
+                    self.reached.set()
+                    self.go.wait()
+                return self.lock.__enter__()
+            def __exit__(self, *args):
+                return self.lock.__exit__(*args)
+        gated = bufmgr.io_lock = GatedLock(bufmgr.io_lock)
+        flusher = threading.Thread(target=bufmgr.flush)
+        gated.gated_thread = flusher
+        flusher.start()
+        assert gated.reached.wait(5)
+
+        # その間に他のスレッドがページを変更し、置換で書き戻す
+        buffer = bufmgr.fetch_page(page_id)
+        with bufmgr.exclusive(buffer):
+            buffer.page[:2] = b"v2"
+        bufmgr.unpin_page(page_id, is_dirty=True)
+        for _ in range(10):
+            with bufmgr.create_page():
+                pass
+            if all(page_id not in shard.table for shard in bufmgr.shards):
+                break
+        assert all(page_id not in shard.table for shard in bufmgr.shards)
+
+        gated.go.set()
+        flusher.join()
+        # 古い写し(v1)で上書きしない
+        data = bytearray(PAGE_SIZE)
+        disk.read_page_data(page_id, data)
+        assert data[:2] == b"v2"
+        with bufmgr.fetch_page(page_id) as buffer:
+            assert buffer.page[:2] == b"v2"
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+
+def test_create_page_without_free_buffer_allocates_nothing():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = ConcurrentBufferPoolManager(disk, BufferPool(2))
+        pinned = [bufmgr.create_page(), bufmgr.create_page()]
+        next_page_id = disk.next_page_id
+        # 空きフレームが無ければ、ディスクのページを確保せずに失敗する
+        with pytest.raises(NoFreeBufferError):
+            bufmgr.create_page()
+        assert disk.next_page_id == next_page_id
+
+        # ピンを外せば、次のページIDで作れる
+        bufmgr.unpin_page(pinned[0].page_id)
+        with bufmgr.create_page() as buffer:
+            assert buffer.page_id.page_id == next_page_id
+        bufmgr.unpin_page(pinned[1].page_id)
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
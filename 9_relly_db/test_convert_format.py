@@ -0,0 +1,71 @@
+import os
+import shutil
+import struct
+import tempfile
+import pytest
+from buffer import BufferPool, BufferPoolManager
+from disk import DiskManager, PAGE_SIZE
+from btree import BPlusTree, FORMAT_LINKED, SearchMode
+from convert_format import CorruptTreeError, convert_file
+
+# 変更前の main.py が作ったファイル(pickle フォーマット、キー 1～7)
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "testdata", "baseline_pickle.rly")
+BASELINE_PAIRS = [(1, b"one"), (2, b"six"), (3, b"four"), (4, b"two"), (5, b"seven"), (6, b"three"), (7, b"five")]
+
+def copy_to_temp(source_path):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+    shutil.copyfile(source_path, temp_file_path)
+    return temp_file_path
+
+def remove_all(temp_file_path):
+    for path in (temp_file_path, temp_file_path + ".bak", temp_file_path + ".converting"):
+        if os.path.exists(path):
+            os.remove(path)
+
+def test_convert_baseline_pickle_file():
+    temp_file_path = copy_to_temp(BASELINE_FILE)
+    try:
+        meta_page_id = convert_file(temp_file_path)
+        assert meta_page_id is not None
+        with open(temp_file_path + ".bak", "rb") as bak, open(BASELINE_FILE, "rb") as original:
+            assert bak.read() == original.read()
+
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(16))
+        btree = BPlusTree(meta_page_id)
+        assert list(btree.search(bufmgr, SearchMode.Start())) == \
+            [(struct.pack('>Q', key), value) for key, value in BASELINE_PAIRS]
+        assert btree.get(bufmgr, struct.pack('>Q', 3)) == (struct.pack('>Q', 3), b"four")
+        assert btree.format_version == FORMAT_LINKED
+        disk.close()
+        # 変換後のファイルを再び変換しても何もしない
+        assert convert_file(temp_file_path, meta_page_id) is None
+    finally:
+        remove_all(temp_file_path)
+
+def test_convert_rejects_cyclic_tree():
+    temp_file_path = copy_to_temp(BASELINE_FILE)
+    try:
+        # ルート(ページ7)の左の子(ページ3)の最初の子ページIDを、ルートに書き換えて循環させる
+        with open(temp_file_path, "r+b") as f:
+            f.seek(3 * PAGE_SIZE + 20)
+            f.write(struct.pack('Q', 7))
+        with open(temp_file_path, "rb") as f:
+            corrupted = f.read()
+        with pytest.raises(CorruptTreeError, match="page 7 is reachable twice"):
+            convert_file(temp_file_path)
+        # 元のファイルはそのまま残り、作りかけのファイルは消える
+        with open(temp_file_path, "rb") as f:
+            assert f.read() == corrupted
+        assert not os.path.exists(temp_file_path + ".converting")
+        assert not os.path.exists(temp_file_path + ".bak")
+
+        # 子ページIDがファイルの外を指していても、再帰で落ちずにエラーになる
+        with open(temp_file_path, "r+b") as f:
+            f.seek(3 * PAGE_SIZE + 20)
+            f.write(struct.pack('Q', 1000))
+        with pytest.raises(CorruptTreeError, match="points to page 1000"):
+            convert_file(temp_file_path)
+    finally:
+        remove_all(temp_file_path)
@@ -0,0 +1,109 @@
+import os
+import random
+import struct
+import tempfile
+import pytest
+from buffer import BufferPool, BufferPoolManager
+from disk import DiskManager
+from btree import BPlusTree, FORMAT_LINKED, FORMAT_PICKLE, FORMAT_SLOTTED, SearchMode
+from convert_format import convert_file
+
+def key_of(i):
+    return struct.pack('>Q', i)
+
+@pytest.mark.parametrize("format_version", [FORMAT_PICKLE, FORMAT_SLOTTED, FORMAT_LINKED])
+def test_cursor_streams_across_leaves(format_version):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(512))
+        btree = BPlusTree.create(bufmgr, format_version)
+        keys = list(range(0, 6000, 2))
+        random.Random(1).shuffle(keys)
+        for i in keys:
+            btree.insert(bufmgr, key_of(i), b"value-%d" % i + bytes(60))
+
+        # 全てのペアをキー順に読む
+        assert [key for key, _ in btree.search(bufmgr, SearchMode.Start())] == [key_of(i) for i in range(0, 6000, 2)]
+
+        # 無いキーに seek すると、その次のキーを指す。end_key で止まる
+        cursor = btree.search(bufmgr, SearchMode.Key(key_of(1001)), end_key=key_of(1401))
+        assert cursor.get()[0] == key_of(1002)
+        assert [key for key, _ in cursor] == [key_of(i) for i in range(1002, 1401, 2)]
+        assert cursor.next() is None and cursor.get() is None
+
+        # prev() はリーフの境界を越えて戻り、next() と同じペアを返す
+        for i in range(1400, 0, -2):
+            assert cursor.prev()[0] == key_of(i)
+        assert cursor.prev()[0] == key_of(0)
+        assert cursor.prev() is None
+        assert cursor.next()[0] == key_of(0) and cursor.next()[0] == key_of(2)
+        assert cursor.prev()[0] == key_of(2)
+
+        # 全てのキーより大きい位置
+        cursor.seek(key_of(99999))
+        assert cursor.get() is None and cursor.prev()[0] == key_of(5998)
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+
+def test_linked_leaves_scan_reads_only_the_range():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(512))
+        btree = BPlusTree.create(bufmgr, FORMAT_SLOTTED)
+        for i in range(5000):
+            btree.insert(bufmgr, key_of(i), bytes(100))
+        bufmgr.flush(verbose=False)
+        disk.close()
+
+        # 古いフォーマットのファイルは作り直して、リーフをリンクでつなぐ
+        meta_page_id = convert_file(temp_file_path)
+        assert meta_page_id is not None
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(512))
+        btree = BPlusTree(meta_page_id)
+        assert btree.get(bufmgr, key_of(4321)) == (key_of(4321), bytes(100))
+        assert btree.format_version == FORMAT_LINKED
+
+        # 範囲スキャンが読むのは、ルートからの経路と範囲を含むリーフだけ
+        stats = bufmgr.enable_stats()
+        results = btree.search_range(bufmgr, key_of(2000), key_of(2100))
+        assert [key for key, _ in results] == [key_of(i) for i in range(2000, 2101)]
+        assert stats.counters.get("hit", 0) + stats.counters.get("miss", 0) <= 12
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+        if os.path.exists(temp_file_path + ".bak"):
+            os.remove(temp_file_path + ".bak")
+
+def test_seek_copies_only_pairs_after_the_key(monkeypatch):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(64))
+        btree = BPlusTree.create(bufmgr)
+        for i in range(40):
+            btree.insert(bufmgr, key_of(i), b"value-%d" % i)
+
+        # seek() はリーフをデコードせずにスロットの配列から位置を求め、key 以降のペアだけを持つ
+        monkeypatch.setattr(BPlusTree, "get_pairs", lambda self, buffer: pytest.fail("leaf was decoded"))
+        cursor = btree.search(bufmgr, SearchMode.Key(key_of(30)))
+        monkeypatch.undo()
+        assert cursor.index == 0 and cursor.pairs[0].key == key_of(30) and len(cursor.pairs) == 10
+        assert cursor.next() == (key_of(30), b"value-30")
+
+        # 飛ばした先頭のペアにも prev() で戻れる
+        for i in range(30, -1, -1):
+            assert cursor.prev() == (key_of(i), b"value-%d" % i)
+        assert cursor.prev() is None
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
@@ -1,6 +1,9 @@
 import os
+import shutil
 import tempfile
-from disk import DiskManager, PageId, PAGE_SIZE
+import threading
+import pytest
+from disk import CompressedDiskManager, DirectDiskManager, DiskError, DiskManager, MmapDiskManager, PageId, SegmentedDiskManager, PAGE_SIZE
 
 def test_disk_manager():
     with tempfile.NamedTemporaryFile(delete=False) as temp_file:
@@ -27,3 +30,432 @@ def test_disk_manager():
 
     finally:
         os.remove(temp_file_path)
+
+def test_mmap_disk_manager():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        assert isinstance(DiskManager.open(temp_file_path, io_mode="mmap"), MmapDiskManager)
+        # マッピングの拡張が起きるように拡張単位を小さくする
+        disk = MmapDiskManager(temp_file_path, grow_size=PAGE_SIZE * 2)
+
+        page_ids = []
+        for i in range(5):
+            page_id = disk.allocate_page()
+            disk.write_page_data(page_id, bytearray([i + 1]) * PAGE_SIZE)
+            page_ids.append(page_id)
+
+        view = disk.page_view(page_ids[2])
+        assert view[0] == 3
+        del view
+
+        disk.sync()
+        disk.close()
+        assert os.path.getsize(temp_file_path) == 6 * PAGE_SIZE  # ヘッダページ + 5ページ
+
+        disk = DiskManager.open(temp_file_path)
+        assert disk.next_page_id == 6
+        read_page = bytearray(PAGE_SIZE)
+        disk.read_page_data(page_ids[4], read_page)
+        assert read_page == bytearray([5]) * PAGE_SIZE
+        disk.close()
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_mmap_reads_during_remap_and_out_of_range():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        # ページを割り当てるたびにマッピングが作り直される
+        disk = MmapDiskManager(temp_file_path, grow_size=PAGE_SIZE)
+        assert disk.concurrent_reads
+        page_ids = []
+        for i in range(4):
+            page_ids.append(disk.allocate_page())
+            disk.write_page_data(page_ids[-1], bytearray([i + 1]) * PAGE_SIZE)
+
+        errors = []
+        stop = threading.Event()
+        def read():
+            data = bytearray(PAGE_SIZE)
+            try:
+                while not stop.is_set():
+                    for i, page_id in enumerate(page_ids[:4]):
+                        disk.read_page_data(page_id, data)
+                        assert data == bytearray([i + 1]) * PAGE_SIZE
+            except Exception as e:
+                errors.append(e)
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        # 読み込みと並行して、マッピングの作り直しを繰り返す
+        for i in range(300):
+            page_id = disk.allocate_page()
+            disk.write_page_data(page_id, bytearray([i % 200 + 10]) * PAGE_SIZE)
+        stop.set()
+        for reader in readers:
+            reader.join()
+        assert errors == []
+
+        # 割り当てていないページの読み込みはファイルを伸ばさずにエラーになる
+        size = os.path.getsize(temp_file_path)
+        with pytest.raises(DiskError):
+            disk.read_page_data(PageId(disk.next_page_id + 100), bytearray(PAGE_SIZE))
+        with pytest.raises(DiskError):
+            disk.page_view(PageId(disk.next_page_id))
+        assert os.path.getsize(temp_file_path) == size
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+
+def test_read_write_pages():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        page_ids = [disk.allocate_page() for _ in range(6)]
+
+        # 連続しないページIDを順不同で渡してもページごとに正しい位置に書き込まれる
+        writes = [(page_ids[i], bytearray([i + 1]) * PAGE_SIZE) for i in (3, 0, 1, 5, 2)]
+        offset = disk.file.tell()
+        disk.write_pages(writes)
+        assert disk.file.tell() == offset  # ファイルオフセットは動かない
+
+        reads = [(page_ids[i], bytearray(PAGE_SIZE)) for i in (5, 0, 2, 1, 3)]
+        disk.read_pages(reads)
+        for page_id, data in reads:
+            assert data == bytearray([page_ids.index(page_id) + 1]) * PAGE_SIZE
+
+        read_page = bytearray(PAGE_SIZE)
+        disk.read_page_data(page_ids[3], read_page)
+        assert read_page == bytearray([4]) * PAGE_SIZE
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_free_page_recycling():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        page_ids = [disk.allocate_page() for _ in range(4)]
+        assert PageId(0) not in page_ids  # ページ0はヘッダページ
+        for page_id in page_ids:
+            disk.write_page_data(page_id, bytearray(b"data") * (PAGE_SIZE // 4))
+
+        disk.free_page(page_ids[1])
+        disk.free_page(page_ids[2])
+        try:
+            disk.free_page(page_ids[2])
+            assert False, "double free must fail"
+        except DiskError:
+            pass
+        disk.close()
+
+        # フリーリストはヘッダページに永続化され、解放したページから再利用される
+        disk = DiskManager.open(temp_file_path)
+        assert disk.free_page_count == 2
+        assert disk.allocate_page() == page_ids[2]
+        assert disk.allocate_page() == page_ids[1]
+        assert disk.allocate_page() == PageId(page_ids[3].to_u64() + 1)
+        assert os.path.getsize(temp_file_path) == 5 * PAGE_SIZE
+        disk.close()
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_extent_preallocation():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        extent_size = 16 * PAGE_SIZE
+        disk = DiskManager.open(temp_file_path, extent_size=extent_size)
+        for _ in range(3):
+            disk.write_page_data(disk.allocate_page(), bytearray(b"x") * PAGE_SIZE)
+        # ファイルはエクステント単位で予約され、データの終端とは別に管理される
+        assert disk.physical_size() == extent_size
+        assert disk.logical_size() == 4 * PAGE_SIZE
+        disk.close()
+
+        # 終端はヘッダページから復元される
+        disk = DiskManager.open(temp_file_path, extent_size=extent_size)
+        assert disk.logical_size() == 4 * PAGE_SIZE
+        for _ in range(16):
+            disk.allocate_page()
+        assert disk.logical_size() == 20 * PAGE_SIZE
+        assert disk.physical_size() == 2 * extent_size
+        disk.close()
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_direct_disk_manager():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        try:
+            disk = DiskManager.open(temp_file_path, io_mode="direct")
+        except DiskError as e:
+            pytest.skip(str(e))  # O_DIRECTに対応していないファイルシステム
+        assert isinstance(disk, DirectDiskManager)
+
+        page_ids = [disk.allocate_page() for _ in range(3)]
+        disk.write_page_data(page_ids[0], bytearray(b"a") * PAGE_SIZE)
+        disk.write_pages([(page_ids[2], bytearray(b"c") * PAGE_SIZE),
+                          (page_ids[1], bytearray(b"b") * PAGE_SIZE)])
+
+        reads = [(page_id, bytearray(PAGE_SIZE)) for page_id in page_ids]
+        disk.read_pages(reads)
+        assert [bytes(data[:1]) for _, data in reads] == [b"a", b"b", b"c"]
+
+        read_page = bytearray(PAGE_SIZE)
+        disk.read_page_data(page_ids[1], read_page)
+        assert read_page == bytearray(b"b") * PAGE_SIZE
+        disk.close()
+
+    finally:
+        os.remove(temp_file_path)
+
+def test_direct_disk_manager_reads_and_writes_from_threads():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        try:
+            disk = DiskManager.open(temp_file_path, io_mode="direct")
+        except DiskError as e:
+            pytest.skip(str(e))  # O_DIRECTに対応していないファイルシステム
+        page_ids = [disk.allocate_page() for _ in range(8)]
+        disk.write_pages([(page_id, bytearray([page_id.to_u64()]) * PAGE_SIZE) for page_id in page_ids])
+
+        # アリーナを共有していても、書き込み中のページの内容が他のページの読み書きに混ざらない
+        errors = []
+        def write(page_id):
+            try:
+                for round_no in range(200):
+                    disk.write_page_data(page_id, bytearray([page_id.to_u64()]) * PAGE_SIZE)
+                    if round_no % 10 == 0:
+                        disk.write_pages([(page_id, bytearray([page_id.to_u64()]) * PAGE_SIZE)])
+            except Exception as e:
+                errors.append(e)
+        def read():
+            try:
+                for _ in range(100):
+                    reads = [(page_id, bytearray(PAGE_SIZE)) for page_id in page_ids]
+                    disk.read_pages(reads)
+                    for page_id, data in reads:
+                        assert data == bytearray([page_id.to_u64()]) * PAGE_SIZE
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=write, args=(page_id,)) for page_id in page_ids[:4]]
+        threads += [threading.Thread(target=read) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+
+def test_segmented_disk_manager():
+    temp_dir = tempfile.mkdtemp()
+    heap_file_path = os.path.join(temp_dir, "test.rly")
+
+    try:
+        open(heap_file_path, 'wb').close()
+        # 1セグメント4ページ、同時に開くセグメントは2つまで
+        disk = SegmentedDiskManager(heap_file_path, segment_size=4 * PAGE_SIZE, max_open_segments=2)
+        page_ids = [disk.allocate_page() for _ in range(11)]
+        disk.write_pages([(page_id, bytearray([page_id.to_u64()]) * PAGE_SIZE) for page_id in page_ids])
+        assert os.path.exists(heap_file_path + ".1")
+        assert os.path.exists(heap_file_path + ".2")
+        assert len(disk.segments) <= 2
+
+        # 別々のセグメントへのI/Oをスレッドから並行して行う
+        def rewrite(page_id):
+            disk.write_page_data(page_id, bytearray([100 + page_id.to_u64()]) * PAGE_SIZE)
+        threads = [threading.Thread(target=rewrite, args=(page_id,)) for page_id in page_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        disk.sync()
+        disk.close()
+
+        disk = DiskManager.open(heap_file_path, io_mode="segmented", segment_size=4 * PAGE_SIZE)
+        assert disk.next_page_id == 12
+        reads = [(page_id, bytearray(PAGE_SIZE)) for page_id in page_ids]
+        disk.read_pages(reads)
+        for page_id, data in reads:
+            assert data == bytearray([100 + page_id.to_u64()]) * PAGE_SIZE
+        disk.close()
+
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_segmented_sync_retries_segments_after_fsync_failure():
+    temp_dir = tempfile.mkdtemp()
+    heap_file_path = os.path.join(temp_dir, "test.rly")
+
+    try:
+        open(heap_file_path, 'wb').close()
+        disk = SegmentedDiskManager(heap_file_path, segment_size=4 * PAGE_SIZE)
+        page_ids = [disk.allocate_page() for _ in range(11)]
+        disk.sync()
+        disk.write_pages([(page_id, bytearray([page_id.to_u64()]) * PAGE_SIZE) for page_id in page_ids])
+        assert disk.dirty_segments == {0, 1, 2}
+
+        # 2つ目のセグメントの fsync が失敗する
+        synced = []
+        fsync = disk.fsync
+        def failing_fsync(fd):
+            if len(synced) == 1:
+                synced.append(None)
+                raise OSError(5, "Input/output error")
+            synced.append(fd)
+            fsync(fd)
+        disk.fsync = failing_fsync
+        with pytest.raises(OSError):
+            disk.sync()
+        # 同期できなかったセグメントは dirty のまま残り、次の sync() で同期される
+        assert disk.dirty_segments == {1, 2}
+        synced.clear()
+        disk.fsync = lambda fd: (synced.append(fd), fsync(fd))
+        disk.sync()
+        assert len(synced) == 2 and disk.dirty_segments == set()
+        disk.close()
+    finally:
+        shutil.rmtree(temp_dir)
+
+def test_compressed_disk_manager():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path, io_mode="compressed")
+        assert isinstance(disk, CompressedDiskManager)
+        page_ids = [disk.allocate_page() for _ in range(8)]
+        for page_id in page_ids:
+            page = bytearray(PAGE_SIZE)
+            page[:5] = b"hello"
+            page[100] = page_id.to_u64()
+            disk.write_page_data(page_id, page)
+        # ほとんど0のページは小さく圧縮される
+        assert disk.physical_size() < 2 * PAGE_SIZE
+
+        # 圧縮できないページは元のスロットに収まらないので別のスロットに移る
+        random_page = bytearray(os.urandom(PAGE_SIZE))
+        disk.write_page_data(page_ids[3], random_page)
+        disk.close()
+
+        disk = DiskManager.open(temp_file_path, io_mode="compressed")
+        assert disk.next_page_id == 9
+        read_page = bytearray(PAGE_SIZE)
+        disk.read_page_data(page_ids[3], read_page)
+        assert read_page == random_page
+        for page_id in page_ids[:3] + page_ids[4:]:
+            disk.read_page_data(page_id, read_page)
+            assert read_page[:5] == b"hello" and read_page[100] == page_id.to_u64()
+        disk.close()
+
+    finally:
+        os.remove(temp_file_path)
+        if os.path.exists(temp_file_path + ".ptt"):
+            os.remove(temp_file_path + ".ptt")
+
+def test_compressed_disk_manager_keeps_synced_slots_until_ptt_is_written():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+    crash_path = temp_file_path + ".crash"
+
+    def page_of(text):
+        page = bytearray(PAGE_SIZE)
+        page[:len(text)] = text
+        return page
+
+    try:
+        disk = DiskManager.open(temp_file_path, io_mode="compressed")
+        page_ids = [disk.allocate_page() for _ in range(4)]
+        for page_id in page_ids:
+            disk.write_page_data(page_id, page_of(b"v1-%d" % page_id.to_u64()))
+        disk.sync()
+        data_end = disk.data_end
+
+        # 同期の後の書き直し: 元のスロットに収まるページ、収まらずに移るページ、新しいページ
+        disk.write_page_data(page_ids[0], page_of(b"v2-0"))
+        disk.write_page_data(page_ids[1], bytearray(os.urandom(PAGE_SIZE)))
+        disk.write_page_data(disk.allocate_page(), page_of(b"new"))
+        disk.write_page_data(page_ids[2], page_of(b"v2-2"))
+        disk.write_page_data(page_ids[2], page_of(b"v3-2"))
+
+        # PTTを書く前にクラッシュしたときのファイル: 同期した時点の内容がすべて読める
+        shutil.copyfile(temp_file_path, crash_path)
+        shutil.copyfile(temp_file_path + ".ptt", crash_path + ".ptt")
+        crashed = DiskManager.open(crash_path, io_mode="compressed")
+        read_page = bytearray(PAGE_SIZE)
+        for page_id in page_ids:
+            crashed.read_page_data(page_id, read_page)
+            assert read_page == page_of(b"v1-%d" % page_id.to_u64())
+        crashed.close()
+
+        # PTTを永続化した後は、古いスロットが再利用されてファイルが伸び続けない
+        disk.sync()
+        assert disk.pending_free_slots == [] and not disk.unsynced_slots
+        grown = disk.data_end
+        for _ in range(3):
+            for page_id in page_ids[2:]:
+                disk.write_page_data(page_id, page_of(b"v4-%d" % page_id.to_u64()))
+            disk.sync()
+        assert disk.data_end == grown and grown < data_end + 3 * PAGE_SIZE
+        disk.close()
+
+        disk = DiskManager.open(temp_file_path, io_mode="compressed")
+        disk.read_page_data(page_ids[0], read_page)
+        assert read_page == page_of(b"v2-0")
+        disk.read_page_data(page_ids[3], read_page)
+        assert read_page == page_of(b"v4-%d" % page_ids[3].to_u64())
+        disk.close()
+    finally:
+        for path in (temp_file_path, crash_path):
+            for suffix in ("", ".ptt"):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+def test_group_commit():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        disk.enable_stats()
+        disk.enable_group_commit(commit_delay=0.02, use_fdatasync=True)
+        page_ids = [disk.allocate_page() for _ in range(8)]
+        disk.sync()
+
+        barrier = threading.Barrier(len(page_ids))
+        def commit(page_id):
+            disk.write_page_data(page_id, bytearray([page_id.to_u64()]) * PAGE_SIZE)
+            barrier.wait()
+            disk.sync()
+        threads = [threading.Thread(target=commit, args=(page_id,)) for page_id in page_ids]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # 同時に来た同期要求はまとめられ、要求の数よりfsyncの回数が少なくなる
+        syncs = disk.stats()["counters"]["sync"] - 1
+        assert 1 <= syncs < len(page_ids)
+        assert disk.sync_coordinator.completed == disk.sync_coordinator.requested
+        disk.close()
+
+    finally:
+        os.remove(temp_file_path)
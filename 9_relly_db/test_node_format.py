@@ -0,0 +1,191 @@
+import os
+import random
+import struct
+import tempfile
+import pytest
+from buffer import BufferPool, BufferPoolManager
+from disk import DiskManager, PAGE_SIZE
+from btree import BPlusTree, CURRENT_FORMAT_VERSION, FORMAT_PICKLE, LeafNode, NodeOverflowError, Pair
+from convert_format import convert_file
+
+def test_slotted_leaf_reads_keys_in_place():
+    page = memoryview(bytearray(PAGE_SIZE))
+    pairs = [Pair(b"a", b"1"), Pair(b"bb", b""), Pair(b"ccc", b"333")]
+    LeafNode.write(page, pairs)
+    leaf = LeafNode(page)
+    assert leaf.count == 3
+    # キーと値はページの中を指す memoryview で、ペアにするときだけコピーする
+    assert isinstance(leaf.key(2), memoryview) and leaf.key(2).obj is page.obj
+    assert leaf.key(1) == b"bb" and leaf.value(2) == b"333"
+    assert [(pair.key, pair.value) for pair in leaf.pairs()] == [(b"a", b"1"), (b"bb", b""), (b"ccc", b"333")]
+    assert leaf.find(b"ccc") == 2 and leaf.find(b"c") is None
+
+    # 収まらないペアリストはページを変更せずに例外にする
+    before = bytes(page)
+    with pytest.raises(NodeOverflowError):
+        LeafNode.write(page, [Pair(b"k%d" % i, bytes(1500)) for i in range(3)])
+    assert bytes(page) == before
+
+def test_slotted_leaf_inserts_in_place():
+    page = memoryview(bytearray(PAGE_SIZE))
+    LeafNode.write(page, [Pair(b"b", b"2"), Pair(b"d", b"4")])
+    leaf = LeafNode(page)
+    # 先頭・途中・末尾に挿入しても、書き直したページと同じ順序で読める
+    assert leaf.insert(0, b"a", b"1") and leaf.insert(2, b"c", b"33") and leaf.insert(4, b"e", b"")
+    expected = [Pair(b"a", b"1"), Pair(b"b", b"2"), Pair(b"c", b"33"), Pair(b"d", b"4"), Pair(b"e", b"")]
+    assert leaf.count == 5 and LeafNode(page).count == 5
+    assert [(pair.key, pair.value) for pair in LeafNode(page).pairs()] == [(pair.key, pair.value) for pair in expected]
+
+    # 空き領域に収まらないペアはページを変更せずに False を返す
+    free = PAGE_SIZE - LeafNode.SLOTS_START - 6 * 6 - sum(len(pair.key) + len(pair.value) for pair in expected)
+    before = bytes(page)
+    assert not leaf.insert(5, b"f", bytes(free))
+    assert bytes(page) == before
+    assert leaf.insert(5, b"f", bytes(free - 1))
+    assert LeafNode(page).key(5) == b"f" and len(LeafNode(page).value(5)) == free - 1
+
+def test_insert_into_slotted_leaf_does_not_rewrite_it(monkeypatch):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_path = temp_file.name
+    try:
+        disk = DiskManager.open(temp_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(10))
+        btree = BPlusTree.create(bufmgr)
+        for i in range(0, 20, 2):
+            btree.insert(bufmgr, b"%02d" % i, b"v%d" % i)
+        # 分割しない挿入ではペアリストを作らない
+        monkeypatch.setattr(LeafNode, "pairs", lambda self: pytest.fail("leaf was decoded"))
+        btree.insert(bufmgr, b"07", b"seven")
+        monkeypatch.undo()
+        assert [key for key, _ in btree.search_range(bufmgr, b"00", b"99")][3:6] == [b"06", b"07", b"08"]
+        assert btree.get(bufmgr, b"07") == (b"07", b"seven")
+        disk.close()
+    finally:
+        os.remove(temp_path)
+
+def test_convert_pickle_file_to_current_format():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(16))
+        btree = BPlusTree.create(bufmgr, FORMAT_PICKLE)
+        keys = [(i * 37) % 50 for i in range(50)]
+        for key in keys:
+            btree.insert(bufmgr, struct.pack('>Q', key), b"value-%d" % key)
+        bufmgr.flush(verbose=False)
+        disk.close()
+
+        # 古いフォーマットのファイルも、メタデータページからフォーマットを読み取って使える
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(16))
+        old = BPlusTree(btree.meta_page_id)
+        assert old.get(bufmgr, struct.pack('>Q', 7)) == (struct.pack('>Q', 7), b"value-7")
+        assert old.format_version == FORMAT_PICKLE
+        disk.close()
+
+        meta_page_id = convert_file(temp_file_path)
+        assert meta_page_id == btree.meta_page_id
+        assert os.path.exists(temp_file_path + ".bak")
+        assert convert_file(temp_file_path) is None
+
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(16))
+        new = BPlusTree(meta_page_id)
+        results = new.search_range(bufmgr, struct.pack('>Q', 0), struct.pack('>Q', 49))
+        assert new.format_version == CURRENT_FORMAT_VERSION
+        assert results == [(struct.pack('>Q', key), b"value-%d" % key) for key in range(50)]
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+        if os.path.exists(temp_file_path + ".bak"):
+            os.remove(temp_file_path + ".bak")
+
+@pytest.mark.parametrize("format_version", [FORMAT_PICKLE, CURRENT_FORMAT_VERSION])
+def test_nodes_fill_pages_with_variable_length_pairs(format_version):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(256))
+        btree = BPlusTree.create(bufmgr, format_version)
+        rng = random.Random(7)
+        # ページの上限に近い大きさのペアを含む、長さのばらばらなキーと値
+        max_size = btree.max_pair_size()
+        expected = {}
+        for i in rng.sample(range(3000), 600):
+            key = b"%08d" % i + bytes(rng.choice([0, 10, 100, 700]))
+            value = bytes([i % 251]) * rng.choice([0, 5, 50, 400])
+            if rng.random() < 0.05:
+                # ちょうど上限の大きさのペア
+                value = bytes([i % 251]) * (max_size - btree.pair_size(Pair(key, b"")))
+                # pickle は値の長さによって直列化のバイト数が少し変わる
+                while btree.pair_size(Pair(key, value)) > max_size:
+                    value = value[:-1]
+            btree.insert(bufmgr, key, value)
+            expected[key] = value
+
+        for key, value in expected.items():
+            assert btree.get(bufmgr, key) == (key, value)
+        results = btree.search_range(bufmgr, b"", b"\xff")
+        assert results == sorted(expected.items())
+
+        # ノードはページに収まるだけ詰められるので、データ量に見合ったページ数で済む
+        data_size = sum(btree.pair_size(Pair(key, value)) for key, value in expected.items())
+        assert disk.next_page_id < 3 * data_size // PAGE_SIZE + 4
+
+        # 大きすぎるペアは木を変更せずに拒否する
+        key = b"too-large"
+        with pytest.raises(NodeOverflowError):
+            btree.insert(bufmgr, key, bytes(max_size))
+        assert btree.get(bufmgr, key) is None
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+
+def test_ascending_inserts_fill_leaves_to_fill_factor():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        leaf_pages = {}
+        for fill_factor in (0.5, 0.9):
+            disk = DiskManager.open(temp_file_path)
+            bufmgr = BufferPoolManager(disk, BufferPool(256))
+            btree = BPlusTree.create(bufmgr, fill_factor=fill_factor)
+            for i in range(2000):
+                btree.insert(bufmgr, struct.pack('>Q', i), bytes(100))
+            assert len(btree.search_range(bufmgr, struct.pack('>Q', 0), struct.pack('>Q', 1999))) == 2000
+            leaf_pages[fill_factor] = disk.next_page_id
+            disk.close()
+            os.remove(temp_file_path)
+        # 昇順の挿入では、fill_factor が大きいほど葉が詰まって少ないページで済む
+        assert leaf_pages[0.9] < leaf_pages[0.5] * 0.65
+        with pytest.raises(ValueError):
+            BPlusTree.create(bufmgr, fill_factor=0.3)
+    finally:
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+
+def test_node_count_limits_still_split_small_trees():
+    class SmallTree(BPlusTree):
+        LEAF_NODE_MAX_PAIRS = 2
+        BRANCH_NODE_MAX_KEYS = 2
+
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(64))
+        btree = SmallTree(BPlusTree.create(bufmgr).meta_page_id)
+        for i in (6, 3, 8, 4, 1, 7, 2, 5, 9, 0):
+            btree.insert(bufmgr, struct.pack('>Q', i), b"value%d" % i)
+        assert disk.next_page_id > 10
+        for i in range(10):
+            assert btree.get(bufmgr, struct.pack('>Q', i)) == (struct.pack('>Q', i), b"value%d" % i)
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
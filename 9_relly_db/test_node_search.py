@@ -0,0 +1,82 @@
+import math
+import os
+import random
+import struct
+import tempfile
+from bisect import bisect_left, bisect_right
+from buffer import BufferPool, BufferPoolManager
+from disk import DiskManager, PageId, PAGE_SIZE
+from btree import BPlusTree, BranchNode, FORMAT_SLOTTED, LeafNode, Pair
+
+def test_binary_search_matches_linear_scan():
+    rng = random.Random(3)
+    keys = sorted({bytes(rng.randrange(256) for _ in range(rng.randrange(1, 12))) for _ in range(200)})
+    page = memoryview(bytearray(PAGE_SIZE))
+    LeafNode.write(page, [Pair(key, b"v") for key in keys])
+    branch_page = memoryview(bytearray(PAGE_SIZE))
+    BranchNode.write(branch_page, keys, [PageId(i) for i in range(len(keys) + 1)])
+
+    probes = keys + [b"", b"\xff" * 12] + [key + b"\x00" for key in keys[::7]]
+    for probe in probes:
+        leaf = LeafNode(page)
+        assert leaf.lower_bound(probe) == bisect_left(keys, probe)
+        # 比較はノードのエントリ数の対数回で済む
+        assert leaf.comparisons <= math.ceil(math.log2(len(keys) + 1))
+        assert (leaf.find(probe) is not None) == (probe in keys)
+        branch = BranchNode(branch_page)
+        index = branch.child_index(probe)
+        assert index == bisect_right(keys, probe) and branch.child(index) == PageId(index)
+        assert branch.comparisons <= math.ceil(math.log2(len(keys) + 1))
+
+def test_split_point_matches_exhaustive_search():
+    btree = BPlusTree(PageId(0), FORMAT_SLOTTED)
+    rng = random.Random(5)
+
+    def exhaustive(sizes, fits, ratio, promote):
+        target = sum(sizes) * ratio
+        candidates = [index for index in range(1, len(sizes) - (1 if promote else 0))
+                      if fits(sizes[:index]) and fits(sizes[index + 1:] if promote else sizes[index:])]
+        return min(candidates, key=lambda index: abs(sum(sizes[:index]) - target))
+
+    for _ in range(200):
+        sizes = [rng.choice([10, 50, 300, 1300]) for _ in range(rng.randrange(3, 60))]
+        fits = btree.leaf_fits if rng.random() < 0.5 else btree.branch_fits
+        promote = fits == btree.branch_fits
+        if sum(sizes) <= PAGE_SIZE:
+            continue
+        ratio = rng.choice([0.5, 0.9])
+        try:
+            expected = exhaustive(sizes, fits, ratio, promote)
+        except ValueError:
+            continue
+        assert btree.split_point(sizes, fits, ratio, promote) == expected
+
+def test_search_stats_count_comparisons_per_level():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(256))
+        btree = BPlusTree.create(bufmgr)
+        keys = list(range(0, 20000, 2))
+        random.Random(11).shuffle(keys)
+        for key in keys:
+            btree.insert(bufmgr, struct.pack('>Q', key), b"value")
+
+        stats = btree.enable_search_stats()
+        for key in range(0, 200):
+            result = btree.get(bufmgr, struct.pack('>Q', key))
+            assert (result is not None) == (key % 2 == 0)
+        levels = stats.snapshot()
+        # ルートからリーフまで、検索ごとに各レベルのノードを1つずつ訪れる
+        assert len(levels) >= 2 and all(level["nodes"] == 200 for level in levels)
+        for level in levels:
+            assert level["comparisons_per_node"] <= math.log2(level["entries_per_node"] + 1) + 1
+
+        # 範囲スキャンは開始キーの位置から読み始め、終了キーで止まる
+        results = btree.search_range(bufmgr, struct.pack('>Q', 9001), struct.pack('>Q', 9011))
+        assert [struct.unpack('>Q', key)[0] for key, _ in results] == [9002, 9004, 9006, 9008, 9010]
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
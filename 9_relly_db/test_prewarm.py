@@ -0,0 +1,101 @@
+import os
+import tempfile
+import pytest
+from buffer import BufferPool, BufferPoolManager
+from disk import DiskManager, PAGE_SIZE
+from prewarm import load_prewarm_file, prewarm_file_path
+from replacement import LRU
+
+def _write_pages(disk, num_pages):
+    page_ids = []
+    for i in range(num_pages):
+        page_id = disk.allocate_page()
+        disk.write_page_data(page_id, bytes([i + 1]) + bytes(PAGE_SIZE - 1))
+        page_ids.append(page_id)
+    return page_ids
+
+@pytest.mark.parametrize("background", [False, True])
+def test_prewarm_restores_resident_pages_after_restart(background):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+    sidecar_path = prewarm_file_path(temp_file_path)
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        page_ids = _write_pages(disk, 20)
+        bufmgr = BufferPoolManager(disk, BufferPool(6, LRU()))
+        bufmgr.start_prewarm(sidecar_path)
+        for i in (3, 4, 5, 6, 7, 8, 9, 12, 15, 18):
+            with bufmgr.fetch_page(page_ids[i]):
+                pass
+        # 停止するときに、最近使われたページから順に保存される
+        bufmgr.stop_prewarm()
+        assert load_prewarm_file(sidecar_path) == [page_ids[i] for i in (18, 15, 12, 9, 8, 7)]
+        disk.close()
+
+        # 再起動: 小さなバッファプールには、よく使われていたページから空いているフレームの分だけ読み込む
+        disk = DiskManager.open(temp_file_path)
+        bufmgr = BufferPoolManager(disk, BufferPool(4))
+        bufmgr.enable_stats()
+        prewarmer = bufmgr.start_prewarm(sidecar_path, background=background)
+        assert prewarmer.loaded.wait(5)
+        assert prewarmer.loaded_pages == 4
+        assert set(bufmgr.page_table) == {page_ids[i] for i in (18, 15, 12, 9)}
+        for i in (18, 15, 12, 9):
+            with bufmgr.fetch_page(page_ids[i]) as buffer:
+                assert buffer.page[:1] == bytes([i + 1])
+        stats = bufmgr.stats()
+        assert stats["counters"].get("miss", 0) == 0
+        assert stats["counters"]["prewarm_pages"] == 4
+        bufmgr.stop_prewarm()
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+        if os.path.exists(sidecar_path):
+            os.remove(sidecar_path)
+
+def test_prewarm_does_not_overwrite_pages_loaded_meanwhile():
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+    sidecar_path = prewarm_file_path(temp_file_path)
+
+    try:
+        disk = DiskManager.open(temp_file_path)
+        page_ids = _write_pages(disk, 4)
+        bufmgr = BufferPoolManager(disk, BufferPool(4))
+        for page_id in page_ids:
+            with bufmgr.fetch_page(page_id):
+                pass
+        bufmgr.start_prewarm(sidecar_path)
+        bufmgr.stop_prewarm()
+
+        bufmgr = BufferPoolManager(disk, BufferPool(4))
+        # 読み込みの途中でフォアグラウンドがページを読んで書き換えたら、プリウォームで読んだ古い内容は捨てる
+        read_pages = disk.read_pages
+        def read_pages_and_modify(pages):
+            read_pages(pages)
+            buffer = bufmgr.fetch_page(page_ids[0])
+            buffer.page[:1] = b"x"
+            bufmgr.unpin_page(page_ids[0], is_dirty=True)
+        disk.read_pages = read_pages_and_modify
+        prewarmer = bufmgr.start_prewarm(sidecar_path)
+        disk.read_pages = read_pages
+        assert prewarmer.loaded_pages == 3
+        with bufmgr.fetch_page(page_ids[0]) as buffer:
+            assert buffer.page[:1] == b"x"
+        assert bufmgr.pool.free_frames() == 0
+        bufmgr.stop_prewarm()
+
+        # 解放されたページはサイドカーファイルに残っていても読まない
+        bufmgr.free_page(page_ids[3])
+        bufmgr = BufferPoolManager(disk, BufferPool(4))
+        prewarmer = bufmgr.start_prewarm(sidecar_path)
+        assert prewarmer.loaded_pages == 3
+        assert page_ids[3] not in bufmgr.page_table
+        with bufmgr.create_page() as buffer:
+            assert buffer.page_id == page_ids[3]
+        disk.close()
+    finally:
+        os.remove(temp_file_path)
+        if os.path.exists(sidecar_path):
+            os.remove(sidecar_path)
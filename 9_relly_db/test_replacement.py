@@ -0,0 +1,88 @@
+import os
+import tempfile
+import pytest
+from buffer import BufferPool, BufferPoolManager, NoFreeBufferError
+from disk import DiskManager, PAGE_SIZE
+from replacement import POLICIES
+
+def _open_disk(temp_file_path, num_pages):
+    disk = DiskManager.open(temp_file_path)
+    page_ids = []
+    for i in range(num_pages):
+        page_id = disk.allocate_page()
+        disk.write_page_data(page_id, bytes([i + 1]) + bytes(PAGE_SIZE - 1))
+        page_ids.append(page_id)
+    return disk, page_ids
+
+@pytest.mark.parametrize("name", sorted(POLICIES))
+def test_policy_returns_correct_pages_and_skips_pinned(name):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk, page_ids = _open_disk(temp_file_path, 10)
+        bufmgr = BufferPoolManager(disk, BufferPool(4, POLICIES[name]()))
+        pinned = bufmgr.fetch_page(page_ids[0])
+        for _ in range(3):
+            for i in (1, 2, 3, 1, 4, 5, 2, 6, 7, 8, 9, 1):
+                with bufmgr.fetch_page(page_ids[i]) as buffer:
+                    assert buffer.page[:1] == bytes([i + 1])
+        assert page_ids[0] in bufmgr.page_table
+        assert pinned.page[:1] == b"\x01"
+
+        # 全フレームがピン留めされていれば置換できない
+        others = [bufmgr.fetch_page(page_id) for page_id in page_ids[1:4]]
+        with pytest.raises(NoFreeBufferError):
+            bufmgr.fetch_page(page_ids[4])
+        for buffer in others:
+            bufmgr.unpin_page(buffer.page_id)
+        bufmgr.free_page(page_ids[1])
+        with bufmgr.create_page() as buffer:
+            assert buffer.page_id == page_ids[1]
+
+    finally:
+        os.remove(temp_file_path)
+
+@pytest.mark.parametrize("name", ["lru-k", "2q", "arc"])
+def test_scan_does_not_flush_hot_pages(name):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk, page_ids = _open_disk(temp_file_path, 26)
+        bufmgr = BufferPoolManager(disk, BufferPool(8, POLICIES[name]()))
+        hot = page_ids[:2]
+        scan = page_ids[2:]
+        # 何度も使われるページと、1回だけ読まれるスキャンを交互に行う
+        for round in range(3):
+            for page_id in hot * 3:
+                with bufmgr.fetch_page(page_id):
+                    pass
+            for page_id in scan[round * 8:(round + 1) * 8]:
+                with bufmgr.fetch_page(page_id):
+                    pass
+        assert all(page_id in bufmgr.page_table for page_id in hot)
+
+    finally:
+        os.remove(temp_file_path)
+
+
+@pytest.mark.parametrize("name", sorted(POLICIES))
+def test_policy_follows_pool_resize(name):
+    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
+        temp_file_path = temp_file.name
+
+    try:
+        disk, page_ids = _open_disk(temp_file_path, 12)
+        pool = BufferPool(3, POLICIES[name]())
+        bufmgr = BufferPoolManager(disk, pool)
+        for size in (6, 2, 5, 1, 4):
+            bufmgr.resize(size)
+            assert len(pool.policy.pages) == size
+            for i in (0, 1, 2, 3, 0, 4, 5, 6, 0, 7, 8, 9, 10, 11, 0):
+                with bufmgr.fetch_page(page_ids[i]) as buffer:
+                    assert buffer.page[:1] == bytes([i + 1])
+            assert len(bufmgr.page_table) == size
+            assert sorted(pool.policy.candidates()) == list(range(size))
+    finally:
+        os.remove(temp_file_path)